@@ -0,0 +1,334 @@
+r"""
+async_transis_kinesis_connector.py is an asyncio execution engine for the transis kinesis connector.
+
+The detector count stream and the transis REST endpoints are read with a small asyncio HTTP/1.1 client, so the stream and any
+number of REST pollers run in one event loop. Kinesis and DI framework calls are blocking boto3/psycopg2 calls, they are run in
+the loop's executor and bounded by semaphores.
+"""
+import asyncio
+import base64
+import json
+import logging
+import requests
+from urllib.parse import urlencode, urlsplit
+from transis_consumer import TransisStreamFramer
+from transis_response_models import TransisResponse, DetectorCountBatch
+from transis_kinesis_connector import transform_transis_response
+
+log = logging.getLogger(__name__)
+
+class AsyncTransisHTTPClient:
+    """A minimal asyncio HTTP/1.1 client for the transis GET endpoints.
+
+    Attributes:
+        connection_details (dict): hostname, port, username and password of transis
+        timeout            (int) : seconds to wait for each read before the connection is treated as dead
+        chunk_size         (int) : the most bytes returned by each read of the body
+    """
+    def __init__(self, connection_details, timeout=20*60, chunk_size=64*1024):
+        self.connection_details = connection_details
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+
+    def get_request_bytes(self, url, params):
+        """Returns the HTTP request for a GET of the url with the query string params"""
+        split_url = urlsplit(url)
+        query = split_url.query
+        if params:
+            query = f"{query}&{urlencode(params)}" if query else urlencode(params)
+        target = f"{split_url.path}?{query}" if query else split_url.path
+        credentials = base64.b64encode(f'{self.connection_details["username"]}:{self.connection_details["password"]}'.encode('utf-8')).decode('ascii')
+        return (f"GET {target} HTTP/1.1\r\n"
+                f"Host: {split_url.netloc}\r\n"
+                f"Authorization: Basic {credentials}\r\n"
+                'Content-type: text/xml;charset="utf-8"\r\n'
+                "Connection: close\r\n\r\n").encode('utf-8')
+
+    async def iter_content(self, url, **params):
+        """Async generator to yield the body of a GET request in chunks as it is recieved
+
+        Arguments:
+            url {str} -- full transis http endpoint
+        Raises:
+            requests.exceptions.HTTPError -- if transis responds with an error status
+            requests.exceptions.ConnectionError -- if the connection fails or no data is recieved within the timeout
+        """
+        split_url = urlsplit(url)
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(split_url.hostname, split_url.port or 80), self.timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise requests.exceptions.ConnectionError(f"Could not connect to {split_url.netloc}: {e}")
+        try:
+            writer.write(self.get_request_bytes(url, params))
+            await writer.drain()
+            status_line = await self.__read(reader.readline())
+            parts = status_line.decode('latin-1').split(" ", 2)
+            if len(parts) < 2 or not parts[1].isdigit():
+                raise requests.exceptions.ConnectionError(f"Invalid HTTP status line from {split_url.netloc}: {status_line!r}")
+            status = int(parts[1])
+            headers = {}
+            while True:
+                line = await self.__read(reader.readline())
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode('latin-1').partition(":")
+                headers[name.strip().lower()] = value.strip()
+            if status >= 400:
+                raise requests.exceptions.HTTPError(f"{status} Error: {parts[2].strip() if len(parts) > 2 else ''} for url: {url}")
+            if "chunked" in headers.get("transfer-encoding", "").lower():
+                async for chunk in self.__iter_chunked(reader):
+                    yield chunk
+            elif "content-length" in headers:
+                remaining = int(headers["content-length"])
+                while remaining > 0:
+                    chunk = await self.__read(reader.read(min(self.chunk_size, remaining)))
+                    if not chunk:
+                        raise requests.exceptions.ConnectionError("Connection closed before the whole body was recieved")
+                    remaining -= len(chunk)
+                    yield chunk
+            else:
+                while True:
+                    chunk = await self.__read(reader.read(self.chunk_size))
+                    if not chunk:
+                        break
+                    yield chunk
+        finally:
+            writer.close()
+
+    async def __iter_chunked(self, reader):
+        while True:
+            size_line = await self.__read(reader.readline())
+            try:
+                size = int(size_line.split(b";")[0].strip(), 16)
+            except ValueError:
+                raise requests.exceptions.ConnectionError(f"Invalid chunk size in chunked response: {size_line!r}")
+            if size == 0:
+                while (await self.__read(reader.readline())) not in (b"\r\n", b"\n", b""):
+                    pass
+                return
+            while size > 0:
+                chunk = await self.__read(reader.read(min(self.chunk_size, size)))
+                if not chunk:
+                    raise requests.exceptions.ConnectionError("Connection closed in the middle of a chunk")
+                size -= len(chunk)
+                yield chunk
+            await self.__read(reader.readline())
+
+    async def __read(self, read_coroutine):
+        try:
+            return await asyncio.wait_for(read_coroutine, self.timeout)
+        except asyncio.TimeoutError:
+            raise requests.exceptions.ConnectionError(f"No data was recieved from transis for {self.timeout} seconds")
+        except (OSError, asyncio.IncompleteReadError) as e:
+            raise requests.exceptions.ConnectionError(e)
+
+    async def get(self, url, **params):
+        """Returns the whole body of a GET request"""
+        body = bytearray()
+        async for chunk in self.iter_content(url, **params):
+            body += chunk
+        return bytes(body)
+
+
+class AsyncTransisKinesisConnector:
+    """Runs the transis to kinesis connector, and optionally transis REST pollers, in one asyncio event loop.
+
+    Documents are read from the stream continuously and handed to a publisher task through a bounded queue. The publisher handles
+    one document at a time, its put_records() calls run concurrently in the executor.
+
+    Attributes:
+        transis_consumer        (TransisConsumer)        : provides the transis connection details, endpoints and document parsing
+        kinesis_producer        (KinesisProducer)        : encodes, batches and sends the records to kinesis
+        di_framework_client     (DIFramework)            : Data Integration client to manage job status logging
+        compact_records         (bool)                   : send DetectorCountBatch records instead of DetectorCountMessage.to_dict() records
+        enricher                (TopologyEnricher)       : adds the detector topology to the records, compact_records is ignored if set
+        transform_in_executor   (bool)                   : parse and transform documents in the executor rather than in the event loop
+        http_client             (AsyncTransisHTTPClient) : the asyncio client used to read transis
+        max_concurrent_puts     (int)                    : the most put_records() calls in flight at once
+        max_concurrent_di_calls (int)                    : the most DI framework calls in flight at once
+        max_pending_documents   (int)                    : the most documents waiting to be published before the stream is paused
+    """
+    def __init__(self, transis_consumer, kinesis_producer, di_framework_client, compact_records=False, transform_in_executor=True,
+                 max_concurrent_puts=4, max_concurrent_di_calls=1, max_pending_documents=12, http_client=None, enricher=None):
+        self.transis_consumer = transis_consumer
+        self.kinesis_producer = kinesis_producer
+        self.di_framework_client = di_framework_client
+        self.compact_records = compact_records
+        self.enricher = enricher
+        self.transform_in_executor = transform_in_executor
+        self.http_client = http_client if http_client else AsyncTransisHTTPClient(transis_consumer.connection_details,
+                                                                                 transis_consumer.stream_timeout,
+                                                                                 transis_consumer.stream_chunk_size)
+        self.max_concurrent_puts = max_concurrent_puts
+        self.max_concurrent_di_calls = max_concurrent_di_calls
+        self.max_pending_documents = max_pending_documents
+        self.__pollers = []
+
+    def add_poller(self, endpoint, interval, callback, **params):
+        """Adds a transis REST endpoint that will be polled while the connector runs
+
+        Arguments:
+            endpoint {str} -- name of the endpoint in TransisConsumer.endpoints e.g. getAllVMS
+            interval {float} -- seconds between the start of each poll
+            callback {callable} -- called with the list of TransisResponse objects from each poll, coroutine functions are awaited
+        """
+        self.__pollers.append((endpoint, interval, callback, params))
+
+    async def run_forever(self):
+        """Runs the detector count stream and all the pollers until the stream ends or one of them fails"""
+        tasks = [asyncio.ensure_future(self.run())]
+        tasks += [asyncio.ensure_future(self.poll(*poller)) for poller in self.__pollers]
+        try:
+            await tasks[0]
+        finally:
+            for task in tasks[1:]:
+                task.cancel()
+            await asyncio.gather(*tasks[1:], return_exceptions=True)
+
+    async def run(self):
+        """Processes the detector count stream managing the starting, ending and logging of DI jobs"""
+        self.__put_semaphore = asyncio.Semaphore(self.max_concurrent_puts)
+        self.__di_semaphore = asyncio.Semaphore(self.max_concurrent_di_calls)
+        documents = asyncio.Queue(maxsize=self.max_pending_documents)
+        publisher = asyncio.ensure_future(self.__publish_documents(documents))
+        try:
+            async for document in self.get_detector_count_documents():
+                put = asyncio.ensure_future(documents.put(document))
+                await asyncio.wait([publisher, put], return_when=asyncio.FIRST_COMPLETED)
+                if publisher.done():
+                    put.cancel()
+                    break
+            if not publisher.done():
+                await documents.put(None)
+            await publisher
+        finally:
+            publisher.cancel()
+
+    async def get_detector_count_documents(self):
+        """Async generator to yield each raw xml document from the detector count stream, reconnecting if transis stops sending"""
+        reconnect_attempts_remaining = self.transis_consumer.max_transis_reconnects
+        while True:
+            framer = TransisStreamFramer(max_document_size=self.transis_consumer.max_document_size)
+            try:
+                log.info("Waiting for detector count stream to recieve data, this may take around 10 minutes.")
+                async for chunk in self.http_client.iter_content(self.transis_consumer.endpoints["streamDetectorCount"]):
+                    for document in framer.feed(chunk):
+                        reconnect_attempts_remaining = self.transis_consumer.max_transis_reconnects
+                        yield document
+                return
+            except requests.exceptions.ConnectionError as e:
+                if reconnect_attempts_remaining > 0:
+                    log.error(f"Transis has not responded ({e}), will attempt to reconnect {reconnect_attempts_remaining} more time(s)")
+                    reconnect_attempts_remaining -= 1
+                else:
+                    raise Exception(f"{self.transis_consumer.max_transis_reconnects} attempts to reconnect to transis were made without success.")
+
+    async def __publish_documents(self, documents):
+        loop = asyncio.get_running_loop()
+        while True:
+            document = await documents.get()
+            if document is None:
+                return
+            if self.transform_in_executor:
+                transformed = await loop.run_in_executor(None, self.transform_document, document)
+            else:
+                transformed = self.transform_document(document)
+            if transformed is None:
+                continue
+            records, response = transformed
+            await self.call_di_framework(self.di_framework_client.start_job)
+            response.update(await self.push_records(records))
+            log.info(response)
+            await self.call_di_framework(self.di_framework_client.log_job_status, json.dumps(response))
+            await self.call_di_framework(self.di_framework_client.end_job)
+
+    def transform_document(self, document):
+        """Returns the records and response details of a raw detector count document, or None if it has no detector count messages"""
+        transis_response = self.transis_consumer.parse_detector_count_document(document)
+        if not transis_response:
+            return None
+        return transform_transis_response(transis_response, self.compact_records, self.enricher)
+
+    async def call_di_framework(self, function, *args):
+        """Runs a blocking DI framework call in the executor, bounded by the DI semaphore"""
+        async with self.__di_semaphore:
+            return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+    async def push_records(self, records):
+        """Encodes the records and sends their put_records() batches concurrently, bounded by the put semaphore
+
+        Note:
+            A batch is only taken from the producer's batcher once the semaphore has room for it, so the batch size adapts to the
+            throttling reported by the calls that have already returned.
+
+        Returns:
+            {Dict} -- the same summary as KinesisProducer.push_transis_detector_count_records()
+        """
+        loop = asyncio.get_running_loop()
+        producer = self.kinesis_producer
+        replay_summary = None
+        if producer.spool and producer.spool.pending_records():
+            replay_summary = await loop.run_in_executor(None, producer.replay_spool, self.di_framework_client, None, producer.replay_limit)
+        kinesis_records, duplicate_records, site_intervals = await loop.run_in_executor(None, self.encode_records, records)
+        spool_sequences = await loop.run_in_executor(None, producer.spool_records, kinesis_records) if producer.spool else None
+
+        async def put_batch(records_batch):
+            try:
+                result = await loop.run_in_executor(None, producer.put_records_with_retries, records_batch, self.di_framework_client)
+            finally:
+                self.__put_semaphore.release()
+            producer.ack_sent_records(result, spool_sequences, site_intervals)
+            return result
+
+        puts = []
+        batches = producer.batcher.batches(kinesis_records)
+        while True:
+            await self.__put_semaphore.acquire()
+            records_batch = next(batches, None)
+            if records_batch is None:
+                self.__put_semaphore.release()
+                break
+            puts.append(asyncio.ensure_future(put_batch(records_batch)))
+        results = await asyncio.gather(*puts)
+        summary = {"kinesis_records": len(kinesis_records), "put_records_calls": 0, "retried_records": 0, "dropped_records": 0}
+        for result in results:
+            for key in ("put_records_calls", "retried_records", "dropped_records"):
+                summary[key] += result[key]
+        producer.add_replay_summary(summary, replay_summary)
+        return producer.add_duplicate_count(summary, duplicate_records)
+
+    def encode_records(self, records):
+        """Returns the kinesis records for the records returned by transform_document(), aggregated and compressed as the producer
+        is configured to, the number of duplicate records that were dropped and the site intervals of the kinesis records by id(),
+        see KinesisProducer.encode_detector_count_records()"""
+        site_intervals = {}
+        if isinstance(records, DetectorCountBatch):
+            kinesis_records = self.kinesis_producer.encode_detector_count_batch(records, site_intervals=site_intervals)
+        else:
+            kinesis_records = self.kinesis_producer.encode_detector_count_records(records, site_intervals=site_intervals)
+        duplicate_records = len(records) - len(kinesis_records)
+        return self.kinesis_producer.prepare_kinesis_records(kinesis_records, site_intervals), duplicate_records, site_intervals
+
+    async def get_transis_responses(self, endpoint, **params):
+        """Returns every TransisResponse in the body of a transis REST endpoint"""
+        framer = TransisStreamFramer(max_document_size=self.transis_consumer.max_document_size)
+        responses = []
+        async for chunk in self.http_client.iter_content(self.transis_consumer.endpoints[endpoint], **params):
+            responses.extend(TransisResponse(document) for document in framer.feed(chunk))
+        responses.extend(TransisResponse(document) for document in framer.feed(b"\x00"))
+        return responses
+
+    async def poll(self, endpoint, interval, callback, params):
+        """Polls a transis REST endpoint every interval seconds until cancelled, errors are logged and the next poll still happens"""
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            try:
+                result = callback(await self.get_transis_responses(endpoint, **params))
+                if asyncio.iscoroutine(result):
+                    await result
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.error(f"An error occured when polling {endpoint}: {e}")
+            await asyncio.sleep(max(0, interval - (loop.time() - started)))
@@ -0,0 +1,202 @@
+r"""
+backfill.py sends historical transis data to kinesis through the same producer as the live detector count stream.
+
+The date range is split into windows that are fetched from the getWithinDates endpoint by a pool of threads and parsed by a pool of
+processes. Completed windows are recorded in a checkpoint file so an interrupted backfill resumes where it stopped.
+
+Run with: python backfill.py --start 2019-10-01T00:00:00+10:00 --end 2019-10-02T00:00:00+10:00 --checkpoint backfill.json
+"""
+import argparse
+import collections
+import datetime
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from transis_response_models import TransisResponse
+
+log = logging.getLogger(__name__)
+
+def split_date_range(start_date, end_date, window_minutes):
+    """Returns the (start, end) of each window in a date range, formatted as transis dates e.g 2019-10-20T21:43:32.000+11:00
+
+    Arguments:
+        start_date {str} -- ISO 8601 date with a UTC offset
+        end_date {str} -- ISO 8601 date with a UTC offset
+        window_minutes {int} -- length of each window, the last window ends at end_date
+    """
+    start = datetime.datetime.fromisoformat(start_date)
+    end = datetime.datetime.fromisoformat(end_date)
+    if end <= start:
+        raise ValueError(f"The backfill end date {end_date} is not after the start date {start_date}")
+    windows = []
+    while start < end:
+        window_end = min(end, start + datetime.timedelta(minutes=window_minutes))
+        windows.append((start.isoformat(timespec="milliseconds"), window_end.isoformat(timespec="milliseconds")))
+        start = window_end
+    return windows
+
+def parse_detector_count_records(byte_string):
+    """Returns the detector count record Dicts in the body of a getWithinDates request, this runs in the parsing processes
+
+    Raises:
+        Exception -- if transis has responded with an error
+    """
+    records = []
+    for document in [d for d in byte_string.split(b"\x00") if d.strip()]:
+        transis_response = TransisResponse(document, keep_byte_string=False)
+        err_msg = transis_response.is_error()
+        if err_msg:
+            raise Exception(err_msg)
+        if transis_response.has_detector_count_messages():
+            records.extend(e.to_dict() for e in transis_response.detector_count_messages.detector_count_message_list)
+    return records
+
+
+class BackfillCheckpoint:
+    """Records the windows of a backfill that have been sent to kinesis in a json file.
+
+    Attributes:
+        path      (str) : the checkpoint file, None to not keep a checkpoint
+        completed (set) : the start dates of the completed windows
+    """
+    def __init__(self, path, start_date, end_date, window_minutes, types):
+        self.path = path
+        self.backfill = {"start_date": start_date, "end_date": end_date, "window_minutes": window_minutes, "types": types}
+        self.completed = set()
+        if path and os.path.exists(path):
+            with open(path, "r") as file_handle:
+                checkpoint = json.load(file_handle)
+            if checkpoint["backfill"] != self.backfill:
+                raise Exception(f"The checkpoint {path} is for a different backfill {checkpoint['backfill']}, remove it or use another path")
+            self.completed = set(checkpoint["completed"])
+            log.info(f"Resuming the backfill from {path}, {len(self.completed)} windows are already complete")
+
+    def mark_completed(self, window):
+        """Records that a window has been sent and saves the checkpoint, replacing the previous file in one step"""
+        self.completed.add(window[0])
+        if self.path:
+            temporary_path = f"{self.path}.tmp"
+            with open(temporary_path, "w") as file_handle:
+                json.dump({"backfill": self.backfill, "completed": sorted(self.completed)}, file_handle)
+            os.replace(temporary_path, self.path)
+
+
+class Backfill:
+    """Fetches, parses and sends the detector counts of a date range to kinesis.
+
+    Up to fetch_workers windows are being fetched or parsed at once. Windows are sent to kinesis in date order, each window is a DI job.
+
+    Attributes:
+        transis_consumer    (TransisConsumer): fetches each window from transis
+        kinesis_producer    (KinesisProducer): sends the records to kinesis
+        di_framework_client (DIFramework)    : Data Integration client to manage job status logging
+        types               (str)            : the transis data types to request
+        window_minutes      (int)            : length of each window
+        fetch_workers       (int)            : the most windows fetched at once
+        parse_workers       (int)            : processes used to parse the windows, 0 parses them in the fetching threads
+        checkpoint_path     (str)            : file the completed windows are recorded in, None to not keep a checkpoint
+    """
+    def __init__(self, transis_consumer, kinesis_producer, di_framework_client, types="DetectorCount", window_minutes=60,
+                 fetch_workers=4, parse_workers=None, checkpoint_path=None):
+        self.transis_consumer = transis_consumer
+        self.kinesis_producer = kinesis_producer
+        self.di_framework_client = di_framework_client
+        self.types = types
+        self.window_minutes = window_minutes
+        self.fetch_workers = fetch_workers
+        self.parse_workers = parse_workers if parse_workers is not None else os.cpu_count()
+        self.checkpoint_path = checkpoint_path
+
+    def run(self, start_date, end_date):
+        """Backfills the date range, skipping the windows that the checkpoint has recorded as complete
+
+        Returns:
+            {Dict} -- counts of the windows that were sent, skipped and failed and the records that were sent
+        """
+        checkpoint = BackfillCheckpoint(self.checkpoint_path, start_date, end_date, self.window_minutes, self.types)
+        windows = [w for w in split_date_range(start_date, end_date, self.window_minutes) if w[0] not in checkpoint.completed]
+        summary = {"windows": len(windows) + len(checkpoint.completed), "skipped_windows": len(checkpoint.completed),
+                   "completed_windows": 0, "failed_windows": 0, "records": 0}
+        # the transis session is shared by the fetching threads, so it is started before them rather than lazily by the first request
+        self.transis_consumer.start_transis_http_session()
+        process_pool = ProcessPoolExecutor(max_workers=self.parse_workers) if self.parse_workers else None
+        try:
+            with ThreadPoolExecutor(max_workers=self.fetch_workers, thread_name_prefix="backfill-fetch") as thread_pool:
+                pending = collections.deque()
+                remaining_windows = iter(windows)
+                for window in remaining_windows:
+                    pending.append((window, thread_pool.submit(self.fetch_and_parse_window, window, process_pool)))
+                    if len(pending) >= self.fetch_workers:
+                        break
+                while pending:
+                    window, future = pending.popleft()
+                    next_window = next(remaining_windows, None)
+                    if next_window:
+                        pending.append((next_window, thread_pool.submit(self.fetch_and_parse_window, next_window, process_pool)))
+                    try:
+                        records = future.result()
+                        self.publish_window(window, records)
+                    except Exception as e:
+                        log.error(f"Could not backfill the window {window[0]} to {window[1]}, it will be retried when the backfill is run again: {e}")
+                        summary["failed_windows"] += 1
+                        continue
+                    checkpoint.mark_completed(window)
+                    summary["completed_windows"] += 1
+                    summary["records"] += len(records)
+                    log.info(f"Backfilled {window[0]} to {window[1]}, {summary['completed_windows'] + summary['skipped_windows']} of {summary['windows']} windows complete")
+        finally:
+            if process_pool:
+                process_pool.shutdown()
+        return summary
+
+    def fetch_and_parse_window(self, window, process_pool=None):
+        """Returns the detector count records of a window, parsed in the process pool if there is one"""
+        byte_string = self.transis_consumer.get_raw_data_within_dates(self.types, window[0], window[1])
+        if process_pool:
+            return process_pool.submit(parse_detector_count_records, byte_string).result()
+        return parse_detector_count_records(byte_string)
+
+    def publish_window(self, window, records):
+        """Sends the records of a window to kinesis as one DI job"""
+        if not records:
+            return
+        self.di_framework_client.start_job()
+        response = {"backfill_window_start": window[0], "backfill_window_end": window[1], "records_in_xml_doc": len(records)}
+        response.update(self.kinesis_producer.push_transis_detector_count_records(records, self.di_framework_client))
+        log.info(response)
+        self.di_framework_client.log_job_status(json.dumps(response))
+        self.di_framework_client.end_job()
+
+
+def main():
+    import main as connector_main
+    import utils
+    from transis_consumer import TransisConsumer
+    parser = argparse.ArgumentParser(description="Backfill historical transis data into kinesis")
+    parser.add_argument("--start", required=True, help="ISO 8601 start date with a UTC offset e.g. 2019-10-01T00:00:00+10:00")
+    parser.add_argument("--end", required=True, help="ISO 8601 end date with a UTC offset")
+    parser.add_argument("--types", default="DetectorCount", help="the transis data types to backfill")
+    parser.add_argument("--window-minutes", type=int, default=60, help="length of each window that is requested from transis")
+    parser.add_argument("--fetch-workers", type=int, default=4, help="the most windows fetched at once")
+    parser.add_argument("--parse-workers", type=int, default=None, help="processes used to parse windows, 0 parses them in the fetching threads")
+    parser.add_argument("--checkpoint", default=None, help="file the completed windows are recorded in so the backfill can be resumed")
+    args = parser.parse_args()
+    config = utils.get_config()
+    di_framework_client = connector_main.build_di_framework_client(config)
+    kinesis_producer = None
+    try:
+        kinesis_producer = connector_main.build_kinesis_producer(config)
+        backfill = Backfill(TransisConsumer(config["transis_config_prod"]), kinesis_producer, di_framework_client,
+                            args.types, args.window_minutes, args.fetch_workers, args.parse_workers, args.checkpoint)
+        summary = backfill.run(args.start, args.end)
+        log.info(summary)
+        if summary["failed_windows"]:
+            raise SystemExit(1)
+    finally:
+        if kinesis_producer:
+            kinesis_producer.close()
+        di_framework_client.close_db_connection()
+
+if __name__ == '__main__':
+    main()
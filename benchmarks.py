@@ -0,0 +1,321 @@
+r"""
+benchmarks.py is a microbenchmark suite for the hot paths of the transis-kinesis-connection service.
+
+A WorkloadGenerator builds DetectorCount push streams and getCurrentTopology documents at a configurable scale. Each benchmark is
+run repeat times and reports its throughput, latency percentiles and peak memory. Results can be saved as json and compared with
+the results of another commit.
+
+Run with: python benchmarks.py --sites 5000 --output results.json --compare baseline.json
+"""
+import argparse
+import datetime
+import json
+import platform
+import random
+import subprocess
+import time
+import tracemalloc
+import utils
+import transis_response_models
+import record_codecs
+from kinesis_aggregation import RecordAggregator
+from kinesis_producer import KinesisProducer
+from transis_consumer import TransisStreamFramer
+
+XML_DECLARATION = '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+TRANSIS_RESPONSE_START = '<ns2:TransisResponse error="false" xmlns:ns2="http://model.transis.rta.nsw.gov.au/">'
+REGIONS = ["ROZ", "PAR", "LIV", "BLK", "HOR", "CBD"]
+
+def generate_detector_count_document(num_sites, num_detectors=24, date="2019-10-03T15:43:00+10:00", region="ROZ"):
+    """Returns a transis DetectorCount xml document as bytes with num_sites DetectorCountMessage elements"""
+    detectors = "".join(f'<Detector Did="{d}" count="{d % 7}"/>' for d in range(1, num_detectors + 1))
+    messages = "".join(f'<ns2:DetectorCountMessage Sid="{site_id}" date="{date}" reg="{region}"><Detectors>{detectors}</Detectors></ns2:DetectorCountMessage>'
+                       for site_id in range(1, num_sites + 1))
+    return (f'{XML_DECLARATION}{TRANSIS_RESPONSE_START}'
+            f'<DetectorCountMessages>{messages}</DetectorCountMessages></ns2:TransisResponse>').encode("utf-8")
+
+
+class WorkloadGenerator:
+    """Generates transis documents shaped like the production network, the same seed always generates the same documents.
+
+    Sites have between half and all of detectors_per_site detectors, counts are drawn from a daily profile and every document of a
+    stream is the next 5 minute interval.
+
+    Attributes:
+        sites                (int): number of sites in each document
+        detectors_per_site   (int): the most detectors a site has
+        documents_per_stream (int): number of DetectorCount documents in a push stream
+        seed                 (int): seed of the random number generator
+    """
+    def __init__(self, sites=5000, detectors_per_site=24, documents_per_stream=12, seed=0, start_date="2019-10-03T15:43:00+10:00"):
+        self.sites = sites
+        self.detectors_per_site = detectors_per_site
+        self.documents_per_stream = documents_per_stream
+        self.seed = seed
+        self.start_date = datetime.datetime.fromisoformat(start_date)
+        site_random = random.Random(seed)
+        self.site_detectors = [site_random.randint(max(1, detectors_per_site // 2), detectors_per_site) for _ in range(sites)]
+        self.site_regions = [site_random.choice(REGIONS) for _ in range(sites)]
+
+    def get_parameters(self):
+        return {"sites": self.sites, "detectors_per_site": self.detectors_per_site, "documents_per_stream": self.documents_per_stream, "seed": self.seed}
+
+    def interval_date(self, index):
+        """Returns the transis date of the index-th interval of the stream"""
+        return (self.start_date + datetime.timedelta(minutes=5 * index)).isoformat()
+
+    def detector_count_document(self, index=0):
+        """Returns the DetectorCount document of the index-th interval of the stream as bytes"""
+        count_random = random.Random(self.seed * 1000003 + index)
+        date = self.interval_date(index)
+        interval_end = datetime.datetime.fromisoformat(date)
+        peak = 60 - 40 * abs(12 - interval_end.hour) / 12
+        messages = []
+        for site_index in range(self.sites):
+            detectors = "".join(f'<Detector Did="{d}" count="{max(0, int(count_random.gauss(peak, peak / 3)))}"/>'
+                                for d in range(1, self.site_detectors[site_index] + 1))
+            messages.append(f'<ns2:DetectorCountMessage Sid="{site_index + 1}" date="{date}" reg="{self.site_regions[site_index]}">'
+                            f'<Detectors>{detectors}</Detectors></ns2:DetectorCountMessage>')
+        return (f'{XML_DECLARATION}{TRANSIS_RESPONSE_START}'
+                f'<DetectorCountMessages>{"".join(messages)}</DetectorCountMessages></ns2:TransisResponse>').encode("utf-8")
+
+    def detector_count_stream(self):
+        """Returns the bytes of a push stream of documents_per_stream null byte delimited DetectorCount documents"""
+        return b"".join(self.detector_count_document(index) + b"\x00" for index in range(self.documents_per_stream))
+
+    def topology_document(self):
+        """Returns a getCurrentTopology document as bytes with a SiteLayout of every site"""
+        layouts = []
+        for site_index in range(self.sites):
+            site_id = site_index + 1
+            arms = "".join(f'<Arm aId="{a}" dir="{"NESW"[a - 1]}" name="Street {site_id}-{a}"/>' for a in range(1, 5))
+            detectors = "".join(f'<Detector dId="{d}" aId="{(d - 1) % 4 + 1}" lane="{(d - 1) // 4 + 1}" type="stopline"/>'
+                                for d in range(1, self.site_detectors[site_index] + 1))
+            streets = "".join(f'<Street stId="{s}" name="Street {site_id}-{s}"/>' for s in (1, 2))
+            sgs = "".join(f'<SG sgNo="{g}" aId="{(g - 1) % 4 + 1}"/>' for g in range(1, 9))
+            phases = "".join(f'<Phase name="{p}"><SGNos><SGNo>{i}</SGNo><SGNo>{i + 4}</SGNo></SGNos></Phase>' for i, p in enumerate("ABCD", 1))
+            layouts.append(f'<SiteLayout sId="{site_id}" name="Site {site_id}" reg="{self.site_regions[site_index]}">'
+                           f'<Arms>{arms}</Arms><Detectors>{detectors}</Detectors><Streets>{streets}</Streets>'
+                           f'<SGs>{sgs}</SGs><Phases>{phases}</Phases></SiteLayout>')
+        return (f'{XML_DECLARATION}{TRANSIS_RESPONSE_START}'
+                f'<SiteLayouts>{"".join(layouts)}</SiteLayouts></ns2:TransisResponse>').encode("utf-8")
+
+
+def percentile(samples, percent):
+    """Returns the percentile of a list of samples, interpolating between the closest ranks"""
+    ordered = sorted(samples)
+    rank = (len(ordered) - 1) * percent / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (rank - lower)
+
+def tail_percentile(samples, percent):
+    """Returns the percentile of a list of samples, or None if there are too few samples for any to lie above it e.g. p99 needs 100"""
+    if len(samples) * (100 - percent) < 100:
+        return None
+    return percentile(samples, percent)
+
+def time_function(function, repeat):
+    """Returns the best wall clock time in seconds of repeat calls to function"""
+    return min(time_samples(function, repeat))
+
+def time_samples(function, repeat):
+    """Returns the wall clock time in seconds of each of repeat calls to function"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+def measure(name, function, items, repeat=5):
+    """Times repeat calls to function and measures its peak memory in one more call traced by tracemalloc
+
+    Arguments:
+        name {str} -- name of the benchmark
+        function {function} -- processes the workload once
+        items {int} -- the units of work in one call e.g. documents or sites, used for the throughput
+    Returns:
+        {dict} -- the latency percentiles in seconds, items per second at the median latency and the peak memory in bytes. The p90
+                  and p99 are None unless repeat is at least 10 and 100, see tail_percentile()
+    """
+    samples = time_samples(function, repeat)
+    tracemalloc.start()
+    try:
+        function()
+        _, peak_memory_bytes = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    p50 = percentile(samples, 50)
+    return {
+        "name": name,
+        "items": items,
+        "repeat": repeat,
+        "p50_seconds": p50,
+        "p90_seconds": tail_percentile(samples, 90),
+        "p99_seconds": tail_percentile(samples, 99),
+        "max_seconds": max(samples),
+        "items_per_second": items / p50 if p50 else None,
+        "peak_memory_bytes": peak_memory_bytes
+    }
+
+def run_suite(workload, repeat=5, chunk_size=64*1024):
+    """Runs every benchmark of the hot paths against the documents of a workload
+
+    Returns:
+        {list} -- the measure() result of each benchmark
+    """
+    stream = workload.detector_count_stream()
+    chunks = [stream[i:i + chunk_size] for i in range(0, len(stream), chunk_size)]
+    document = workload.detector_count_document()
+    transis_response = transis_response_models.TransisResponse(document)
+    messages = transis_response.detector_count_messages.detector_count_message_list
+    records = [m.to_dict() for m in messages]
+    batch = transis_response.detector_count_batch
+    producer = KinesisProducer("region_name", "stream_name", None)
+    aggregating_producer = KinesisProducer("region_name", "stream_name", None, aggregator=RecordAggregator())
+    site_layouts = transis_response_models.TransisResponse(workload.topology_document()).site_layouts
+
+    def frame_stream():
+        framer = TransisStreamFramer()
+        return list(framer.frame(iter(chunks)))
+
+    def parse_document():
+        return transis_response_models.TransisResponse(document).detector_count_messages.detector_count_message_list
+
+    def encode_and_batch(kinesis_producer, encode):
+        return list(kinesis_producer.batcher.batches(kinesis_producer.prepare_kinesis_records(encode())))
+
+    return [
+        measure("stream_framing", frame_stream, workload.documents_per_stream, repeat),
+        measure("transis_response_parsing", parse_document, workload.sites, repeat),
+        measure("detector_count_message_to_dict", lambda: [m.to_dict() for m in messages], workload.sites, repeat),
+        measure("detector_count_batch_parsing", lambda: transis_response_models.TransisResponse(document).detector_count_batch, workload.sites, repeat),
+        measure("producer_encode_and_batch_records", lambda: encode_and_batch(producer, lambda: producer.encode_detector_count_records(records)),
+                workload.sites, repeat),
+        measure("producer_encode_and_batch_batch", lambda: encode_and_batch(producer, lambda: producer.encode_detector_count_batch(batch)),
+                workload.sites, repeat),
+        measure("producer_encode_aggregate_and_batch", lambda: encode_and_batch(aggregating_producer, lambda: aggregating_producer.encode_detector_count_batch(batch)),
+                workload.sites, repeat),
+        measure("site_layouts_detectors_csv_string", lambda: site_layouts.get_csv_string("detectors"), workload.sites, repeat),
+        measure("site_layouts_phases_csv_string", lambda: site_layouts.get_csv_string("phases"), workload.sites, repeat)
+    ]
+
+def benchmark_detector_count_transform(num_sites, repeat=5):
+    """Times DetectorCountMessage.to_dict over a whole batch with the strptime timestamp parsing and with the cached parsing
+
+    Returns:
+        {dict} -- seconds per batch for each timestamp implementation
+    """
+    transis_response = transis_response_models.TransisResponse(generate_detector_count_document(num_sites))
+    messages = transis_response.detector_count_messages.detector_count_message_list
+    transform = lambda: [m.to_dict() for m in messages]
+
+    cached_get_epoc_from_timestamp_string = utils.get_epoc_from_timestamp_string
+    utils.get_epoc_from_timestamp_string = utils.parse_epoc_with_strptime
+    try:
+        strptime_seconds = time_function(transform, repeat)
+    finally:
+        utils.get_epoc_from_timestamp_string = cached_get_epoc_from_timestamp_string
+    cached_seconds = time_function(transform, repeat)
+    return {
+        "sites": num_sites,
+        "strptime_seconds_per_batch": strptime_seconds,
+        "cached_seconds_per_batch": cached_seconds,
+        "speedup": strptime_seconds / cached_seconds
+    }
+
+def benchmark_record_codecs(num_sites, repeat=5, max_aggregated_record_size=51200):
+    """Times encoding a whole batch with each record codec and measures the bytes each sends for one collection interval
+
+    Codecs whose optional package is not installed are left out.
+
+    Returns:
+        {list} -- a Dict per codec of the seconds to encode the batch, its bytes per interval, and its bytes once aggregated and gzipped
+    """
+    transis_response = transis_response_models.TransisResponse(generate_detector_count_document(num_sites))
+    batch = transis_response.detector_count_batch
+    records = list(batch.iter_records())
+    aggregator = RecordAggregator(max_aggregated_record_size)
+    results = []
+    for name in record_codecs.CODECS:
+        try:
+            codec = record_codecs.create_codec(name)
+        except Exception:
+            continue
+        encode = lambda: [codec.encode(record) for record in records]
+        encoded = encode()
+        aggregated = aggregator.aggregate([{"PartitionKey": record["siteId"], "Data": data} for record, data in zip(records, encoded)])
+        results.append({
+            "codec": name,
+            "sites": num_sites,
+            "encode_seconds_per_batch": time_function(encode, repeat),
+            "encode_batch_seconds_per_batch": time_function(lambda: [codec.encode_batch_record(batch, i) for i in range(len(batch))], repeat),
+            "bytes_per_interval": sum(len(data) for data in encoded),
+            "aggregated_gzip_bytes_per_interval": sum(len(r["Data"]) for r in record_codecs.compress_kinesis_records(aggregated))
+        })
+    return results
+
+def get_commit():
+    """Returns the git commit of the working directory, None if it is not a git checkout"""
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare_results(results, baseline):
+    """Returns the change in median latency and peak memory of each benchmark against the results of a baseline run
+
+    Returns:
+        {list} -- a Dict per benchmark in both runs with the ratio of each to the baseline, above 1 is slower or bigger
+    """
+    baseline_results = {result["name"]: result for result in baseline["results"]}
+    comparisons = []
+    for result in results["results"]:
+        baseline_result = baseline_results.get(result["name"])
+        if not baseline_result:
+            continue
+        comparisons.append({
+            "name": result["name"],
+            "p50_ratio": result["p50_seconds"] / baseline_result["p50_seconds"],
+            "peak_memory_ratio": result["peak_memory_bytes"] / baseline_result["peak_memory_bytes"] if baseline_result["peak_memory_bytes"] else None
+        })
+    return comparisons
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks for the transis kinesis connector")
+    parser.add_argument("--sites", type=int, default=5000, help="number of sites in each generated document")
+    parser.add_argument("--detectors", type=int, default=24, help="the most detectors a generated site has")
+    parser.add_argument("--documents", type=int, default=12, help="number of DetectorCount documents in the generated push stream")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the workload generator")
+    parser.add_argument("--repeat", type=int, default=5, help="number of times each benchmark is run, at least 100 to report a p99")
+    parser.add_argument("--output", default=None, help="file the results are saved to as json")
+    parser.add_argument("--compare", default=None, help="json results of an earlier run to compare against")
+    args = parser.parse_args()
+    workload = WorkloadGenerator(args.sites, args.detectors, args.documents, args.seed)
+    results = {
+        "commit": get_commit(),
+        "python": platform.python_version(),
+        "created": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "workload": workload.get_parameters(),
+        "results": run_suite(workload, args.repeat),
+        "timestamp_parsing": benchmark_detector_count_transform(args.sites, args.repeat),
+        "record_codecs": benchmark_record_codecs(args.sites, args.repeat)
+    }
+    for result in results["results"]:
+        p99 = f'{result["p99_seconds"]*1000:9.2f}ms' if result["p99_seconds"] is not None else f'{"n/a":>11}'
+        print(f'{result["name"]:<40} p50 {result["p50_seconds"]*1000:9.2f}ms  p99 {p99}  '
+              f'{result["items_per_second"]:12.0f}/s  peak {result["peak_memory_bytes"]/1024/1024:8.1f}MiB')
+    print(results["timestamp_parsing"])
+    for result in results["record_codecs"]:
+        print(result)
+    if args.compare:
+        with open(args.compare, "r") as file_handle:
+            for comparison in compare_results(results, json.load(file_handle)):
+                print(comparison)
+    if args.output:
+        with open(args.output, "w") as file_handle:
+            json.dump(results, file_handle, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -1,49 +1,147 @@
 import psycopg2
+import psycopg2.pool
 import json
+import itertools
+import logging
+import metrics
+import queue
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# The DI framework stored procedures that are called through server side prepared statements, by statement name. The parameter
+# types are given so postgres does not have to pick between the overloads of end_job from untyped parameters.
+PREPARED_STATEMENTS = {
+    "di_strt_job": (("text",), "strt_job($1)"),
+    "di_log_job_stus": (("text", "integer", "text"), "log_job_stus($1, $2, $3)"),
+    "di_end_job": (("text", "integer"), "end_job($1, $2)"),
+    "di_error_job": (("text", "text", "integer", "integer"), "end_job($1, $2, $3, $4)")
+}
 
 class DIFramework:
     """A wrapper class to allow for the creation, deletion and logging of jobs in the Data Integration Framework.
 
+    Connections are kept open in a pool between jobs. A pooled connection that has been idle for more than health_check_interval
+    seconds is checked before it is used, and a call whose connection broke before it was sent is made again on a new connection.
+    When all max_connections connections are in use, a caller waits up to connection_wait_timeout seconds for one to be given back.
+    The stored procedures are called through prepared statements with the values passed as parameters.
+
     Attributes:
         connection_details          (dict): Connection details for the database
         schema_name                  (str): Schema name of where the di framework tables are created.
         job_name                     (str): Name of the job being started
-        __connection (psycopg2.connection): Connection to the database where the di framework is located
+        min_connections              (int): Connections the pool opens when it is created
+        max_connections              (int): The most connections the pool will have open at once
+        health_check_interval      (float): Seconds a connection can be idle before it is checked with SELECT 1
+        connection_wait_timeout    (float): The most seconds to wait for a connection when they are all in use
 
     """
-    def __init__(self,config):
+    def __init__(self,config,min_connections=1,max_connections=4,health_check_interval=60,connection_wait_timeout=60):
         self.connection_details = config["connection_details"]
         self.schema_name = config["schema_name"]
         self.job_name = config["job_name"]
-    
-    
+        self.min_connections = min_connections
+        self.max_connections = max_connections
+        self.health_check_interval = health_check_interval
+        self.connection_wait_timeout = connection_wait_timeout
+        self.__pool = None
+        self.__connection_slots = threading.BoundedSemaphore(max_connections)
+        self.__pool_lock = threading.Lock()
+        self.__prepared_statements = {}
+        self.__last_used = {}
+        self.__active_job_id = None
+
+    def get_connection_pool(self):
+        """Returns the connection pool, creating it the first time it is needed or after it has been closed"""
+        with self.__pool_lock:
+            if self.__pool is None or self.__pool.closed:
+                self.__pool = psycopg2.pool.ThreadedConnectionPool(self.min_connections, self.max_connections,
+                                                                   host=self.connection_details["host"],
+                                                                   database=self.connection_details["database"],
+                                                                   user=self.connection_details["user"],
+                                                                   password=self.connection_details["password"])
+            return self.__pool
+
     def start_db_connection(self):
-        """Starts the database connection to where there DI framework tables are"""
-        connection = psycopg2.connect(host=self.connection_details["host"]
-                                 ,database=self.connection_details["database"]
-                                     ,user=self.connection_details["user"]
-                                 ,password=self.connection_details["password"])
-        connection.autocommit = True
-        return connection
-    
-    def close_db_connection(self):
+        """Returns a healthy connection from the pool to where there DI framework tables are, it must be given back with release_db_connection()
+
+        Raises:
+            Exception -- if no connection is given back within connection_wait_timeout or a working connection can not be made
+        """
+        # the pool raises a PoolError rather than waiting when all its connections are in use, so callers wait for a slot here first
+        if not self.__connection_slots.acquire(timeout=self.connection_wait_timeout):
+            raise Exception(f"All {self.max_connections} connections to the DI framework database have been in use for {self.connection_wait_timeout} seconds")
+        try:
+            pool = self.get_connection_pool()
+            for _ in range(self.max_connections + 1):
+                connection = pool.getconn()
+                if self.is_connection_healthy(connection):
+                    return connection
+                log.warning("Discarding a broken connection to the DI framework database")
+                self.__put_connection(connection, broken=True)
+        except Exception:
+            self.__connection_slots.release()
+            raise
+        self.__connection_slots.release()
+        raise Exception("Could not get a working connection to the DI framework database")
+
+    def is_connection_healthy(self, connection):
+        """Returns True if the connection is open, connections that have been idle longer than health_check_interval are checked with SELECT 1"""
+        if connection.closed:
+            return False
         try:
-            self.__connection.close()
-        except AttributeError:
+            if not connection.autocommit:
+                connection.autocommit = True
+            last_used = self.__last_used.get(connection)
+            if last_used is not None and time.monotonic() - last_used < self.health_check_interval:
+                return True
+            cursor = connection.cursor()
+            cursor.execute("SELECT 1")
+            cursor.close()
+        except psycopg2.Error:
+            return False
+        self.__last_used[connection] = time.monotonic()
+        return True
+
+    def release_db_connection(self, connection, broken=False):
+        """Gives a connection from start_db_connection() back to the pool, broken connections are closed"""
+        try:
+            self.__put_connection(connection, broken)
+        finally:
+            self.__connection_slots.release()
+
+    def __put_connection(self, connection, broken):
+        """Puts a connection back in the pool without freeing its slot"""
+        if broken:
+            self.__prepared_statements.pop(connection, None)
+            self.__last_used.pop(connection, None)
+        else:
+            self.__last_used[connection] = time.monotonic()
+        try:
+            self.get_connection_pool().putconn(connection, close=broken)
+        except psycopg2.pool.PoolError:
             pass
-    
+
+    def close_db_connection(self):
+        """Closes every connection in the pool"""
+        with self.__pool_lock:
+            if self.__pool is not None and not self.__pool.closed:
+                self.__pool.closeall()
+            self.__pool = None
+        self.__prepared_statements = {}
+        self.__last_used = {}
+
     def start_job(self):
         """Starts a job instance, return a response wich includes the job_id needed for closing and updating jobs"""
-        self.__connection = self.start_db_connection()        
-        sql_statement = f"SELECT {self.schema_name}.strt_job('{self.job_name}')"
-        response = self.call_di_framework(sql_statement)
+        response = self.call_di_framework("di_strt_job", self.job_name)
         response_json = json.loads(response[0])
         self.__active_job_id = self.get_value_from_response(response_json, "job_id")
         return response_json
 
     def get_value_from_response(self,response,key):
         """Returns the value from DI Framework response, given a key
-        
+
         Arguments:
             response {json} -- response from the DI framework
             key {str} -- key required
@@ -56,15 +154,14 @@ class DIFramework:
 
     def log_job_status(self,status_desc,job_id=None):
         """Updates the status of a job, returning True if sucessfully logged and False if failed
-        
+
         Arguments:
             job_id {str} -- job id number
             status_desc {str} -- Short description of the status of the job
         """
         if not job_id:
             job_id = self.__active_job_id
-        sql_statement = f"SELECT {self.schema_name}.log_job_stus('{self.job_name}', {job_id}, '{status_desc}')"
-        response = self.call_di_framework(sql_statement)
+        response = self.call_di_framework("di_log_job_stus", self.job_name, job_id, status_desc)
         # The response from this in a malformed JSON string, so we will just look for the word success
         if 'success' in response[0]:
             return True
@@ -73,44 +170,222 @@ class DIFramework:
 
     def end_job(self,job_id=None):
         """Ends a job to denote a sucessfull completion of the job
-        
+
         Arguments:
             job_id {str} -- job id number
         """
         if not job_id:
-            job_id = self.__active_job_id        
-        sql_statement = f"SELECT {self.schema_name}.end_job('{self.job_name}', {job_id})"
-        response = self.call_di_framework(sql_statement)
-        self.__connection.close()
+            job_id = self.__active_job_id
+        response = self.call_di_framework("di_end_job", self.job_name, job_id)
         self.__active_job_id = None
         return json.loads(response[0])
 
     def error_job(self,error_message,job_id=None,job_status_cd="-1"):
         """Logs an error for a given job
-        
+
         Arguments:
             job_id {str} -- job id number
             error_message {str} -- Short description of the error
-        
+
         Keyword Arguments:
             job_status_cd {str} -- optional error code (default: {"-1"})
         """
         if not job_id:
-            job_id = self.__active_job_id        
-        sql_statement = f"SELECT {self.schema_name}.end_job('{self.job_name}', '{error_message}', {job_id}, {job_status_cd})"
-        response = self.call_di_framework(sql_statement)
-        self.__connection.close()
+            job_id = self.__active_job_id
+        response = self.call_di_framework("di_error_job", self.job_name, error_message, job_id, job_status_cd)
         self.__active_job_id = None
         return json.loads(response[0])
-    
-    def call_di_framework(self,sql_statement):
+
+    def prepare_statement(self, connection, statement_name):
+        """Prepares one of the PREPARED_STATEMENTS on the connection if it has not already been prepared there"""
+        prepared = self.__prepared_statements.setdefault(connection, set())
+        if statement_name not in prepared:
+            cursor = connection.cursor()
+            parameter_types, call = PREPARED_STATEMENTS[statement_name]
+            cursor.execute(f"PREPARE {statement_name} ({', '.join(parameter_types)}) AS SELECT {self.schema_name}.{call}")
+            cursor.close()
+            prepared.add(statement_name)
+
+    def call_di_framework(self,statement_name,*params):
         """Returns the response from a call to a stored proc in the di framework
-        
+
+        Note:
+            If the connection breaks before the call is sent it is made once more on a new connection. Once the EXECUTE has been sent
+            the stored proc may have run, so the call is not made again e.g. a second strt_job would start a second job.
+
         Arguments:
-            sql_statement {str} -- the select statement to be executed
+            statement_name {str} -- the name of the stored proc's prepared statement in PREPARED_STATEMENTS
+            params -- the values passed to the stored proc
+        """
+        for attempt in range(2):
+            connection = self.start_db_connection()
+            sent = False
+            try:
+                with metrics.DI_CALL_SECONDS.labels(statement_name).time():
+                    self.prepare_statement(connection, statement_name)
+                    cursor = connection.cursor()
+                    sent = True
+                    cursor.execute(f"EXECUTE {statement_name} ({', '.join(['%s'] * len(params))})", params)
+                    response = cursor.fetchone()
+                    cursor.close()
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                self.release_db_connection(connection, broken=True)
+                if attempt or sent:
+                    raise e
+                log.warning(f"The connection to the DI framework database broke, reconnecting: {e}")
+                continue
+            except Exception as e:
+                self.release_db_connection(connection)
+                raise e
+            self.release_db_connection(connection)
+            return response
+
+
+class DIJobWriter:
+    """Writes DI framework job events from a background thread, so the stream is not held up by round trips to the database.
+
+    It has the same job methods as DIFramework and can be passed to the connector and producer in its place. Each call puts an event
+    in a queue and returns straight away. The writer thread takes the events in batches of up to max_batch_size and writes them in the
+    order they were queued, so the start, logs and end of a job stay in order. Consecutive status logs of the same job in a batch are
+    coalesced into one log_job_status() call with the statuses on seperate lines.
+
+    Note:
+        Jobs are identified by a local job number until the writer thread has started them, start_job() returns this number and it
+        can be passed as the job_id of the other methods.
+
+    Attributes:
+        di_framework_client (DIFramework): the client the events are written with
+        max_batch_size      (int)        : the most events taken from the queue at once
+        flush_interval      (float)      : seconds to wait for more events to fill a batch
+        max_queue_size      (int)        : the most events waiting to be written, events are dropped when the queue is full
+        shutdown_timeout    (float)      : the most seconds close() waits for the queued events to be written
+        failed_events       (int)        : events that could not be written
+        dropped_events      (int)        : events dropped because the queue was full
+        unwritten_events    (int)        : events still queued when close() gave up waiting for them to be written
+    """
+    def __init__(self, di_framework_client, max_batch_size=100, flush_interval=0.5, max_queue_size=10000, shutdown_timeout=30):
+        self.di_framework_client = di_framework_client
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval
+        self.max_queue_size = max_queue_size
+        self.shutdown_timeout = shutdown_timeout
+        self.failed_events = 0
+        self.dropped_events = 0
+        self.unwritten_events = 0
+        self.__events = queue.Queue(maxsize=max_queue_size)
+        self.__job_numbers = itertools.count(1)
+        self.__job_ids = {}
+        self.__active_job = None
+        self.__thread = None
+        self.__thread_lock = threading.Lock()
+
+    def start_job(self):
+        """Queues the start of a job, returning the local job number"""
+        job = next(self.__job_numbers)
+        self.__active_job = job
+        self.__put(("start", job))
+        return job
+
+    def log_job_status(self, status_desc, job_id=None):
+        """Queues a status log of a job, returning True if it was queued"""
+        return self.__put(("log", job_id or self.__active_job, status_desc))
+
+    def end_job(self, job_id=None):
+        """Queues the successful end of a job"""
+        self.__put(("end", job_id or self.__active_job))
+        self.__active_job = None
+
+    def error_job(self, error_message, job_id=None, job_status_cd="-1"):
+        """Queues the end of a job with an error"""
+        self.__put(("error", job_id or self.__active_job, error_message, job_status_cd))
+        self.__active_job = None
+
+    def pending_events(self):
+        """Returns the number of events waiting to be written"""
+        return self.__events.qsize()
+
+    def close(self):
+        """Writes the queued events and stops the writer thread, waiting at most shutdown_timeout seconds
+
+        Returns:
+            {bool} -- True if every queued event was written
         """
-        cursor = self.__connection.cursor()
-        cursor.execute(sql_statement)        
-        response = cursor.fetchone()
-        cursor.close()
-        return response        
+        with self.__thread_lock:
+            thread = self.__thread
+            self.__thread = None
+        if thread is None:
+            return self.__events.empty()
+        deadline = time.monotonic() + self.shutdown_timeout
+        try:
+            self.__events.put(None, timeout=self.shutdown_timeout)
+            thread.join(max(0, deadline - time.monotonic()))
+        except queue.Full:
+            pass
+        if thread.is_alive():
+            self.unwritten_events += self.pending_events()
+            log.error(f"The DI job writer did not finish within {self.shutdown_timeout} seconds, {self.pending_events()} job events were not written")
+            return False
+        return True
+
+    def close_db_connection(self):
+        """Writes the queued events then closes the DI framework's database connections"""
+        self.close()
+        self.di_framework_client.close_db_connection()
+
+    def __put(self, event):
+        with self.__thread_lock:
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__write_events, name="di-job-writer", daemon=True)
+                self.__thread.start()
+        try:
+            self.__events.put_nowait(event)
+            return True
+        except queue.Full:
+            self.dropped_events += 1
+            log.error(f"The DI job writer queue is full, dropped a {event[0]} event of job {event[1]}")
+            return False
+
+    def __write_events(self):
+        while True:
+            batch = [self.__events.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while batch[-1] is not None and len(batch) < self.max_batch_size:
+                try:
+                    batch.append(self.__events.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            self.write_batch([event for event in batch if event is not None])
+            if batch[-1] is None:
+                return
+
+    def write_batch(self, events):
+        """Writes a batch of job events to the DI framework in order, coalescing consecutive status logs of the same job"""
+        coalesced = []
+        for event in events:
+            previous = coalesced[-1] if coalesced else None
+            if event[0] == "log" and previous and previous[0] == "log" and previous[1] == event[1]:
+                coalesced[-1] = ("log", event[1], f"{previous[2]}\n{event[2]}")
+            else:
+                coalesced.append(event)
+        for event in coalesced:
+            try:
+                self.write_event(event)
+            except Exception as e:
+                self.failed_events += 1
+                log.error(f"Could not write the {event[0]} event of DI job {event[1]}: {e}")
+
+    def write_event(self, event):
+        """Writes one job event with the DI framework client"""
+        kind, job = event[0], event[1]
+        if kind == "start":
+            response = self.di_framework_client.start_job()
+            self.__job_ids[job] = self.di_framework_client.get_value_from_response(response, "job_id")
+            return
+        if job not in self.__job_ids:
+            raise Exception(f"job {job} was not started")
+        if kind == "log":
+            self.di_framework_client.log_job_status(event[2], job_id=self.__job_ids[job])
+        elif kind == "end":
+            self.di_framework_client.end_job(job_id=self.__job_ids.pop(job))
+        elif kind == "error":
+            self.di_framework_client.error_job(event[2], job_id=self.__job_ids.pop(job), job_status_cd=event[3])
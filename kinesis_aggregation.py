@@ -0,0 +1,241 @@
+r"""
+kinesis_aggregation.py packs many kinesis records into KPL (Kinesis Producer Library) aggregated records and unpacks them again.
+
+An aggregated record is the KPL magic number, followed by a protobuf encoded AggregatedRecord message and the MD5 digest of that message.
+KCL consumers, including amazon-kclpy through the MultiLangDaemon, de-aggregate these records transparently.
+
+    message AggregatedRecord {
+        repeated string partition_key_table     = 1;
+        repeated string explicit_hash_key_table = 2;
+        repeated Record records                 = 3;
+    }
+    message Record {
+        required uint64 partition_key_index     = 1;
+        optional uint64 explicit_hash_key_index = 2;
+        required bytes  data                    = 3;
+        repeated Tag    tags                    = 4;
+    }
+"""
+import bisect
+import hashlib
+import utils
+
+KPL_MAGIC = b'\xf3\x89\x9a\xc2'
+DIGEST_SIZE = 16
+MAX_KINESIS_RECORD_SIZE = 1024*1024
+
+def encode_varint(value):
+    """Returns the protobuf base 128 varint encoding of a non negative int"""
+    encoded = bytearray()
+    while value > 0x7f:
+        encoded.append((value & 0x7f) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+def decode_varint(buffer, position):
+    """Returns the int encoded as a varint at position in the buffer and the position after it"""
+    result = 0
+    shift = 0
+    while True:
+        if position >= len(buffer):
+            raise ValueError("Truncated varint in aggregated record")
+        byte = buffer[position]
+        position += 1
+        result |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return result, position
+        shift += 7
+
+def encode_length_delimited(field_number, value):
+    """Returns a protobuf length delimited field"""
+    return encode_varint(field_number << 3 | 2) + encode_varint(len(value)) + value
+
+def length_delimited_size(value_size):
+    """Returns the encoded size of a length delimited field with a single byte key"""
+    return 1 + len(encode_varint(value_size)) + value_size
+
+def iter_fields(buffer):
+    """Generator to yield the (field number, wire type, value) of every field in a protobuf message"""
+    position = 0
+    while position < len(buffer):
+        key, position = decode_varint(buffer, position)
+        field_number, wire_type = key >> 3, key & 0x7
+        if wire_type == 0:
+            value, position = decode_varint(buffer, position)
+        elif wire_type == 2:
+            length, position = decode_varint(buffer, position)
+            value = bytes(buffer[position:position + length])
+            if len(value) != length:
+                raise ValueError("Truncated field in aggregated record")
+            position += length
+        elif wire_type == 1:
+            value, position = bytes(buffer[position:position + 8]), position + 8
+        elif wire_type == 5:
+            value, position = bytes(buffer[position:position + 4]), position + 4
+        else:
+            raise ValueError(f"Unsupported protobuf wire type {wire_type} in aggregated record")
+        yield field_number, wire_type, value
+
+
+class AggregatedRecordBuilder:
+    """Collects kinesis records that belong in the same shard into one KPL aggregated record.
+
+    Attributes:
+        records (list): the kinesis records that have been added
+        size    (int) : the size in bytes of the aggregated record that would be built from the records
+    """
+    def __init__(self):
+        self.records = []
+        self.size = len(KPL_MAGIC) + DIGEST_SIZE
+        self.__partition_keys = {}
+        self.__explicit_hash_keys = {}
+        self.__encoded_records = []
+
+    def size_with(self, kinesis_record):
+        """Returns the size of the aggregated record if kinesis_record was added"""
+        return self.size + self.__added_size(kinesis_record)[0]
+
+    def __added_size(self, kinesis_record):
+        partition_key = kinesis_record["PartitionKey"].encode('utf-8')
+        explicit_hash_key = kinesis_record.get("ExplicitHashKey")
+        added_size = 0
+        partition_key_index = self.__partition_keys.get(partition_key)
+        if partition_key_index is None:
+            partition_key_index = len(self.__partition_keys)
+            added_size += length_delimited_size(len(partition_key))
+        record_size = 1 + len(encode_varint(partition_key_index)) + length_delimited_size(len(kinesis_record["Data"]))
+        if explicit_hash_key:
+            explicit_hash_key = explicit_hash_key.encode('utf-8')
+            explicit_hash_key_index = self.__explicit_hash_keys.get(explicit_hash_key)
+            if explicit_hash_key_index is None:
+                explicit_hash_key_index = len(self.__explicit_hash_keys)
+                added_size += length_delimited_size(len(explicit_hash_key))
+            record_size += 1 + len(encode_varint(explicit_hash_key_index))
+        return added_size + length_delimited_size(record_size), partition_key, explicit_hash_key
+
+    def add(self, kinesis_record):
+        """Adds a kinesis record with PartitionKey, Data and an optional ExplicitHashKey"""
+        added_size, partition_key, explicit_hash_key = self.__added_size(kinesis_record)
+        partition_key_index = self.__partition_keys.setdefault(partition_key, len(self.__partition_keys))
+        encoded_record = encode_varint(1 << 3) + encode_varint(partition_key_index)
+        if explicit_hash_key:
+            explicit_hash_key_index = self.__explicit_hash_keys.setdefault(explicit_hash_key, len(self.__explicit_hash_keys))
+            encoded_record += encode_varint(2 << 3) + encode_varint(explicit_hash_key_index)
+        encoded_record += encode_length_delimited(3, kinesis_record["Data"])
+        self.__encoded_records.append(encoded_record)
+        self.records.append(kinesis_record)
+        self.size += added_size
+
+    def build(self):
+        """Returns the kinesis record for all the records that have been added
+
+        Note:
+            A single record is returned as it is, as aggregating it would only add overhead.
+        """
+        if len(self.records) == 1:
+            return self.records[0]
+        message = b"".join(
+            [encode_length_delimited(1, partition_key) for partition_key in self.__partition_keys] +
+            [encode_length_delimited(2, explicit_hash_key) for explicit_hash_key in self.__explicit_hash_keys] +
+            [encode_length_delimited(3, encoded_record) for encoded_record in self.__encoded_records])
+        first_record = self.records[0]
+        kinesis_record = {
+            "PartitionKey": first_record["PartitionKey"],
+            "Data": KPL_MAGIC + message + hashlib.md5(message).digest()
+        }
+        if first_record.get("ExplicitHashKey"):
+            kinesis_record["ExplicitHashKey"] = first_record["ExplicitHashKey"]
+        return kinesis_record
+
+
+class RecordAggregator:
+    """Packs kinesis records into KPL aggregated records of up to max_aggregated_record_size bytes.
+
+    KCL consumers drop de-aggregated records whose hash key is outside of the shard they were read from, so records are only
+    aggregated with records that land in the same shard. If the stream's shards are known the records are grouped by shard,
+    otherwise they are grouped by their ExplicitHashKey or PartitionKey. Aggregation works best with the consistent_hash or
+    explicit_hash_key partitioners, partitioning by siteId without shards gives one record per group. The shards are not
+    rediscovered, the aggregator should be rebuilt after the stream is resharded.
+
+    Attributes:
+        max_aggregated_record_size (int) : the largest aggregated record that will be built in bytes (default is the KPL default)
+        shards                     (list): the open shards of the stream, see kinesis_producer.describe_open_shards()
+    """
+    def __init__(self, max_aggregated_record_size=51200, shards=None):
+        if max_aggregated_record_size > MAX_KINESIS_RECORD_SIZE:
+            raise ValueError(f"max_aggregated_record_size can not be more than the kinesis record limit of {MAX_KINESIS_RECORD_SIZE} bytes")
+        self.max_aggregated_record_size = max_aggregated_record_size
+        self.shards = shards
+        self.__shard_starting_hash_keys = [shard["StartingHashKey"] for shard in shards] if shards else None
+
+    def get_group(self, kinesis_record):
+        """Returns the key of the group that a kinesis record can be aggregated with"""
+        explicit_hash_key = kinesis_record.get("ExplicitHashKey")
+        if self.__shard_starting_hash_keys is None:
+            return explicit_hash_key or kinesis_record["PartitionKey"]
+        hash_key = int(explicit_hash_key) if explicit_hash_key else utils.md5_hash_key(kinesis_record["PartitionKey"])
+        return bisect.bisect(self.__shard_starting_hash_keys, hash_key) - 1
+
+    def aggregate(self, kinesis_records):
+        """Returns the kinesis records packed into as few aggregated records as the size limit allows
+
+        Arguments:
+            kinesis_records {list} -- Dicts with PartitionKey, Data and an optional ExplicitHashKey
+        Returns:
+            {list} -- aggregated kinesis records, in the order the groups were first seen
+        """
+        return [aggregated_record for aggregated_record, _ in self.aggregate_with_user_records(kinesis_records)]
+
+    def aggregate_with_user_records(self, kinesis_records):
+        """Returns the same aggregated records as aggregate(), each paired with the list of kinesis records packed into it"""
+        aggregated_records = []
+        builders = {}
+        for kinesis_record in kinesis_records:
+            group = self.get_group(kinesis_record)
+            builder = builders.get(group)
+            if builder and builder.size_with(kinesis_record) > self.max_aggregated_record_size:
+                aggregated_records.append((builder.build(), builder.records))
+                builder = None
+            if builder is None:
+                builder = builders[group] = AggregatedRecordBuilder()
+            builder.add(kinesis_record)
+        aggregated_records.extend((builder.build(), builder.records) for builder in builders.values())
+        return aggregated_records
+
+
+def is_aggregated_record(data):
+    """Returns True if the data of a kinesis record is a KPL aggregated record"""
+    return len(data) > len(KPL_MAGIC) + DIGEST_SIZE and data[:len(KPL_MAGIC)] == KPL_MAGIC
+
+def deaggregate_record(kinesis_record):
+    """Returns the user records in a kinesis record, the same way that the KCL de-aggregates them
+
+    Arguments:
+        kinesis_record {dict} -- a kinesis record with PartitionKey, Data and an optional ExplicitHashKey
+    Returns:
+        {list} -- Dicts with the PartitionKey, ExplicitHashKey (or None) and Data of each user record
+    """
+    data = kinesis_record["Data"]
+    if not is_aggregated_record(data):
+        return [{"PartitionKey": kinesis_record["PartitionKey"], "ExplicitHashKey": kinesis_record.get("ExplicitHashKey"), "Data": data}]
+    message = data[len(KPL_MAGIC):-DIGEST_SIZE]
+    if hashlib.md5(message).digest() != data[-DIGEST_SIZE:]:
+        raise ValueError("The MD5 digest of the aggregated record does not match its contents")
+    partition_keys, explicit_hash_keys, records = [], [], []
+    for field_number, _, value in iter_fields(message):
+        if field_number == 1:
+            partition_keys.append(value.decode('utf-8'))
+        elif field_number == 2:
+            explicit_hash_keys.append(value.decode('utf-8'))
+        elif field_number == 3:
+            records.append(value)
+    user_records = []
+    for record in records:
+        fields = {field_number: value for field_number, _, value in iter_fields(record) if field_number in (1, 2, 3)}
+        user_records.append({
+            "PartitionKey": partition_keys[fields[1]],
+            "ExplicitHashKey": explicit_hash_keys[fields[2]] if 2 in fields else None,
+            "Data": fields[3]
+        })
+    return user_records
@@ -2,12 +2,197 @@ r"""
 kinesis_producer.py is responsible for pushing records to kinesis, handling rate limites and the kinesis connection.
 """
 import boto3
-import json
-import time
+import bisect
+import collections
+import threading
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 import utils
+import record_codecs
+import metrics
+from kinesis_retry import RetryPolicy
 import logging
 log = logging.getLogger(__name__)
 
+def describe_open_shards(kinesis_client, stream_name):
+    """Returns the open shards of a stream sorted by their starting hash key
+    
+    Arguments:
+        kinesis_client {boto3.client} -- boto3 kinesis client object used to interface with the kinesis service
+        stream_name {str} -- Name of the kinesis stream
+    Returns:
+        {list} -- Dicts with the ShardId, StartingHashKey and EndingHashKey (as ints) of each open shard
+    """
+    shards = []
+    kwargs = {"StreamName": stream_name}
+    while True:
+        description = kinesis_client.describe_stream(**kwargs)["StreamDescription"]
+        for shard in description["Shards"]:
+            if "EndingSequenceNumber" not in shard["SequenceNumberRange"]:
+                shards.append({
+                    "ShardId": shard["ShardId"],
+                    "StartingHashKey": int(shard["HashKeyRange"]["StartingHashKey"]),
+                    "EndingHashKey": int(shard["HashKeyRange"]["EndingHashKey"])
+                })
+        if not description.get("HasMoreShards") or not description["Shards"]:
+            break
+        kwargs["ExclusiveStartShardId"] = description["Shards"][-1]["ShardId"]
+    return sorted(shards, key=lambda shard: shard["StartingHashKey"])
+
+
+class RecordFieldPartitioner:
+    """Uses the value of a field in each record as the kinesis partition key.
+
+    Attributes:
+        field (str): the record field to partition by e.g. siteId or region
+    """
+    def __init__(self, field="siteId"):
+        self.field = field
+
+    def partition(self, record):
+        """Returns the PartitionKey for a record"""
+        return {"PartitionKey": str(record[self.field])}
+
+
+class ConsistentHashPartitioner:
+    """Maps the value of a record field onto a fixed set of partition keys with a consistent hash ring.
+
+    Each value always lands on the same partition key and changing num_partitions only moves about 1/num_partitions of the values,
+    so per site ordering is kept while the number of distinct partition keys stays bounded.
+
+    Attributes:
+        field          (str): the record field that is hashed e.g. siteId
+        num_partitions (int): number of distinct partition keys, this should be at least the number of shards in the stream
+        virtual_nodes  (int): number of points each partition key has on the ring, more points spread the values more evenly
+    """
+    def __init__(self, field="siteId", num_partitions=64, virtual_nodes=32):
+        self.field = field
+        self.num_partitions = num_partitions
+        self.virtual_nodes = virtual_nodes
+        ring = sorted((utils.md5_hash_key(f"partition-{p}-{v}"), f"partition-{p}") for p in range(num_partitions) for v in range(virtual_nodes))
+        self.__ring_hashes = [point for point, _ in ring]
+        self.__ring_keys = [key for _, key in ring]
+
+    def partition(self, record):
+        """Returns the PartitionKey for a record"""
+        index = bisect.bisect(self.__ring_hashes, utils.md5_hash_key(record[self.field])) % len(self.__ring_hashes)
+        return {"PartitionKey": self.__ring_keys[index]}
+
+
+class ExplicitHashKeyPartitioner:
+    """Spreads records evenly over the open shards of a stream by setting an ExplicitHashKey inside each shard's hash key range.
+
+    The shards are discovered with describe_stream, each value of the record field is assigned to one shard so the shards
+    receive an equal share of the values regardless of how their hash key ranges have been split.
+
+    Attributes:
+        kinesis_client (boto3.client): boto3 kinesis client object used to interface with the kinesis service
+        stream_name    (str)         : Name of the kinesis stream
+        field          (str)         : the record field used to choose the shard and as the partition key e.g. siteId
+        shards         (list)        : the open shards of the stream, see describe_open_shards()
+    """
+    def __init__(self, kinesis_client, stream_name, field="siteId"):
+        self.kinesis_client = kinesis_client
+        self.stream_name = stream_name
+        self.field = field
+        self.refresh_shards()
+
+    def refresh_shards(self):
+        """Rediscovers the open shards of the stream, this should be called after the stream has been resharded"""
+        shards = describe_open_shards(self.kinesis_client, self.stream_name)
+        if not shards:
+            raise Exception(f"The kinesis stream {self.stream_name} does not have any open shards.")
+        self.__explicit_hash_keys = [str((shard["StartingHashKey"] + shard["EndingHashKey"]) // 2) for shard in shards]
+        self.shards = shards
+
+    def partition(self, record):
+        """Returns the PartitionKey and ExplicitHashKey for a record"""
+        value = str(record[self.field])
+        explicit_hash_keys = self.__explicit_hash_keys
+        return {
+            "PartitionKey": value,
+            "ExplicitHashKey": explicit_hash_keys[utils.md5_hash_key(value) % len(explicit_hash_keys)]
+        }
+
+
+def create_partitioner(strategy, kinesis_client=None, stream_name=None):
+    """Returns a partitioner for the given strategy name
+    
+    Arguments:
+        strategy {str} -- one of siteId, region, consistent_hash or explicit_hash_key
+    
+    Keyword Arguments:
+        kinesis_client {boto3.client} -- required for the explicit_hash_key strategy (default: {None})
+        stream_name {str} -- required for the explicit_hash_key strategy (default: {None})
+    """
+    if strategy == "consistent_hash":
+        return ConsistentHashPartitioner()
+    elif strategy == "explicit_hash_key":
+        return ExplicitHashKeyPartitioner(kinesis_client, stream_name)
+    else:
+        return RecordFieldPartitioner(strategy)
+
+
+class AdaptiveBatcher:
+    """Splits kinesis records into put_records() batches that are as large as the kinesis limits allow.
+
+    Each batch is filled up to the record count and payload size limits of one put_records() call. When kinesis throttles
+    records the number of records per batch is halved, each call without throttling grows it again up to the limit.
+
+    Attributes:
+        max_records    (int)  : the most records in one put_records() call, kinesis allows 500
+        max_bytes      (int)  : the largest total size of data and partition keys in one put_records() call, kinesis allows 5 MB
+        min_records    (int)  : the batch size will not be reduced below this many records
+        growth_factor  (float): the batch size is multiplied by this after a call without throttling
+        target_records (int)  : the current number of records per batch
+    """
+    def __init__(self, max_records=500, max_bytes=5*1024*1024, min_records=10, growth_factor=2):
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.min_records = min(min_records, max_records)
+        self.growth_factor = growth_factor
+        self.target_records = max_records
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def record_size(kinesis_record):
+        """Returns the number of bytes a kinesis record counts towards the put_records() payload limit"""
+        return len(kinesis_record["Data"]) + len(kinesis_record["PartitionKey"].encode('utf-8'))
+
+    def batches(self, kinesis_records):
+        """Generator to yield lists of kinesis records that each fit in one put_records() call
+
+        Note:
+            The target size is read when each batch is started, so throttling reported while the batches are being sent
+            applies to the next batch.
+        """
+        batch = []
+        batch_bytes = 0
+        for kinesis_record in kinesis_records:
+            size = self.record_size(kinesis_record)
+            if batch and (len(batch) >= self.target_records or batch_bytes + size > self.max_bytes):
+                yield batch
+                batch = []
+                batch_bytes = 0
+            batch.append(kinesis_record)
+            batch_bytes += size
+        if batch:
+            yield batch
+
+    def record_result(self, attempted_records, throttled_records):
+        """Adapts the batch size to the result of a put_records() call
+
+        Arguments:
+            attempted_records {int} -- number of records in the call
+            throttled_records {int} -- number of records that failed with ProvisionedThroughputExceededException
+        """
+        with self.__lock:
+            if throttled_records > 0:
+                self.target_records = max(self.min_records, min(self.target_records, attempted_records) // 2)
+            elif attempted_records >= self.target_records:
+                self.target_records = min(self.max_records, int(self.target_records * self.growth_factor))
+
+
 class KinesisProducer:
     """The AWS kinesis client responsible for pushing records to kinesis, handling rate limites and the kinesis connection. 
 
@@ -15,45 +200,326 @@ class KinesisProducer:
         region         (str)         : AWS region for where the kinesis services is running
         stream_name    (str)         : Name of the kinesis stream
         kinesis_client (boto3.client): boto3 kinesis client object used to interface with the kinesis service
+        partitioner    (object)      : chooses the PartitionKey and ExplicitHashKey of each record e.g. RecordFieldPartitioner
+        aggregator     (kinesis_aggregation.RecordAggregator): packs records into KPL aggregated records, None to send one record per site
+        batcher        (AdaptiveBatcher): splits the records into put_records() calls
+        max_in_flight  (int)         : the most put_records() calls that are sent at the same time, 1 sends them one after another
+        retry_policy   (kinesis_retry.RetryPolicy): how many times and how soon failed records are retried
+        rate_limiter   (kinesis_retry.ShardRateLimiter): paces put_records() calls under the shard limits, None to send as fast as possible
+        spool          (kinesis_spool.KinesisSpool): records are written to this write-ahead log before they are sent, None to not spool them
+        replay_limit   (int)         : the most records left in the spool by earlier pushes that are sent again before each push, None for all of them
+        deduplicator   (record_deduplication.DuplicateRecordFilter): drops records for site intervals that were already sent, None to send every record
+        codec          (record_codecs.JSONCodec): encodes each record's Data, see record_codecs
+        compression    (str)         : "gzip" compresses the Data of each record that it makes smaller before it is aggregated, None to send it as encoded
+        dropped_records (int)        : total number of records that could not be added to kinesis
+        put_records_calls (int)      : total number of put_records() calls made, including retries
     """
 
-    def __init__(self,region,stream_name,kinesis_client):
+    def __init__(self,region,stream_name,kinesis_client,partitioner=None,aggregator=None,batcher=None,max_in_flight=1,
+                 retry_policy=None,rate_limiter=None,spool=None,deduplicator=None,codec=None,compression=None,replay_limit=500):
+        if compression not in (None, "gzip"):
+            raise ValueError(f"Unknown compression {compression}, expected gzip or None")
         self.region = region
         self.stream_name = stream_name
         self.kinesis_client = kinesis_client
+        self.partitioner = partitioner if partitioner else RecordFieldPartitioner("siteId")
+        self.aggregator = aggregator
+        self.batcher = batcher if batcher else AdaptiveBatcher()
+        self.max_in_flight = max_in_flight
+        self.retry_policy = retry_policy if retry_policy else RetryPolicy()
+        self.rate_limiter = rate_limiter
+        self.spool = spool
+        self.replay_limit = replay_limit
+        self.deduplicator = deduplicator
+        self.codec = codec if codec else record_codecs.JSONCodec()
+        self.compression = compression
+        self.put_records_calls = 0
+        self.dropped_records = 0
+        self.__counters_lock = threading.Lock()
     
-    def push_transis_detector_count_records(self, records, di_framework_client, batch_size=10, partition_key="region"):
+    def push_transis_detector_count_records(self, records, di_framework_client, batch_size=None, partition_key=None):
         """Batches and decorates a list of records to be pushed into kinesis
 
         Note:
-            A batch_size of 10 is about half way to hitting the 1000 records/ sec kineses rate limit for one shard. 
-            As the transis data comes in batches every 5 minutes this is more than enough to get through all the data.
+            Without a batch_size each put_records() call is filled up to the kinesis limits by the producer's batcher.
                     
         Arguments:
             records {list} -- list of all the detector count messages to be added to kinesis
             di_framework_client {DIFramework} -- Data Integration client to manage job status logging
         
         Keyword Arguments:
-            batch_size {int} -- the size of each batch sent to kinesis in one put_records() call (default: {10})
-            partition_key {str} --  (default: {"region"})
+            batch_size {int} -- a fixed number of records sent to kinesis in each put_records() call (default: {None})
+            partition_key {str} -- the record field to partition by, overriding the producer's partitioner (default: {None})
+        Returns:
+            {Dict} -- Details about how the records were sent, see push_kinesis_records()
+        """
+        site_intervals = {}
+        kinesis_records = self.encode_detector_count_records(records, partition_key, site_intervals)
+        summary = self.push_kinesis_records(kinesis_records, di_framework_client, batch_size, site_intervals)
+        return self.add_duplicate_count(summary, len(records) - len(kinesis_records))
+
+    def push_transis_detector_count_batch(self, batch, di_framework_client, batch_size=None, partition_key=None):
+        """Batches and pushes a DetectorCountBatch into kinesis, encoding each site straight from the batch's arrays
+
+        Arguments:
+            batch {transis_response_models.DetectorCountBatch} -- the detector counts of all the sites to be added to kinesis
+            di_framework_client {DIFramework} -- Data Integration client to manage job status logging
+
+        Keyword Arguments:
+            batch_size {int} -- a fixed number of records sent to kinesis in each put_records() call (default: {None})
+            partition_key {str} -- the record field to partition by, overriding the producer's partitioner (default: {None})
+        Returns:
+            {Dict} -- Details about how the records were sent, see push_kinesis_records()
+        """
+        site_intervals = {}
+        kinesis_records = self.encode_detector_count_batch(batch, partition_key, site_intervals)
+        summary = self.push_kinesis_records(kinesis_records, di_framework_client, batch_size, site_intervals)
+        return self.add_duplicate_count(summary, len(batch) - len(kinesis_records))
+
+    def add_duplicate_count(self, summary, duplicate_records):
+        """Adds the number of records the deduplicator dropped to a summary returned by push_kinesis_records()"""
+        if self.deduplicator:
+            summary["duplicate_records"] = duplicate_records
+        return summary
+
+    @staticmethod
+    def get_site_interval(record):
+        """Returns the (siteId, collectionendtimestamp_plus_3_mins) of a detector count record Dict, the epoc is None if it has none"""
+        epoc = record.get("collectionendtimestamp_plus_3_mins")
+        return str(record.get("siteId")), int(epoc) if epoc is not None else None
+
+    def observe_freshness(self, site_intervals):
+        """Observes the lag from collectionendtimestamp_plus_3_mins of the site intervals that kinesis has just acknowledged"""
+        epocs = collections.Counter(epoc for _, epoc in site_intervals)
+        epocs.pop(None, None)
+        metrics.observe_freshness(epocs)
+
+    def is_duplicate(self, record, encoded_keys):
+        """Returns True if the deduplicator drops the record, because its site interval has been sent or is in encoded_keys
+
+        Arguments:
+            record {Dict} -- a detector count record Dict or record header
+            encoded_keys {set} -- the site intervals encoded so far in this push, the record's site interval is added if it is not a duplicate
+        """
+        if not self.deduplicator:
+            return False
+        key = self.deduplicator.get_key(record)
+        if key in encoded_keys or self.deduplicator.is_duplicate(record):
+            return True
+        encoded_keys.add(key)
+        return False
+
+    def encode_detector_count_records(self, records, partition_key=None, site_intervals=None):
+        """Returns the kinesis records for a list of detector count record Dicts, partitioned by the producer's partitioner and without duplicates
+
+        Note:
+            The deduplicator only remembers a site interval once kinesis has acknowledged it, so repeats within the list are dropped here.
+
+        Keyword Arguments:
+            partition_key {str} -- the record field to partition by, overriding the producer's partitioner (default: {None})
+            site_intervals {dict} -- filled with the id() of each kinesis record to the site intervals in it, see get_site_interval(),
+                                     so they can be read back once kinesis has acknowledged the record (default: {None})
+        """
+        partitioner = RecordFieldPartitioner(partition_key) if partition_key else self.partitioner
+        kinesis_records = []
+        encoded_keys = set()
+        with metrics.KINESIS_ENCODE_SECONDS.time():
+            for record in records:
+                if self.is_duplicate(record, encoded_keys):
+                    continue
+                partition = partitioner.partition(record)
+                kinesis_record = self.generate_kinesis_record(partition["PartitionKey"], record, partition.get("ExplicitHashKey"))
+                if site_intervals is not None:
+                    site_intervals[id(kinesis_record)] = [self.get_site_interval(record)]
+                kinesis_records.append(kinesis_record)
+        return kinesis_records
+
+    def encode_detector_count_batch(self, batch, partition_key=None, site_intervals=None):
+        """Returns the kinesis records for a DetectorCountBatch without duplicates, encoding each site straight from the batch's arrays
+
+        Keyword Arguments:
+            partition_key {str} -- the record field to partition by, overriding the producer's partitioner (default: {None})
+            site_intervals {dict} -- filled with the site intervals of each kinesis record, see encode_detector_count_records() (default: {None})
+        """
+        partitioner = RecordFieldPartitioner(partition_key) if partition_key else self.partitioner
+        kinesis_records = []
+        encoded_keys = set()
+        with metrics.KINESIS_ENCODE_SECONDS.time():
+            for index in range(len(batch)):
+                record_header = batch.record_header(index)
+                if self.is_duplicate(record_header, encoded_keys):
+                    continue
+                kinesis_record = partitioner.partition(record_header)
+                kinesis_record["Data"] = self.codec.encode_batch_record(batch, index)
+                if site_intervals is not None:
+                    site_intervals[id(kinesis_record)] = [self.get_site_interval(record_header)]
+                kinesis_records.append(kinesis_record)
+        return kinesis_records
+
+    def prepare_kinesis_records(self, kinesis_records, site_intervals=None):
+        """Returns the encoded kinesis records compressed if the producer has a compression and then aggregated if it has an aggregator,
+        so the KPL aggregated records keep their magic number and can be de-aggregated by a KCL consumer
+
+        Keyword Arguments:
+            site_intervals {dict} -- the site intervals of the encoded records by id(), the site intervals of the records that are
+                                     returned are added to it (default: {None})
+        """
+        if self.compression == "gzip":
+            compressed_records = record_codecs.compress_kinesis_records(kinesis_records)
+            if site_intervals is not None:
+                for kinesis_record, compressed_record in zip(kinesis_records, compressed_records):
+                    if compressed_record is not kinesis_record:
+                        site_intervals[id(compressed_record)] = site_intervals.get(id(kinesis_record), [])
+            kinesis_records = compressed_records
+        if self.aggregator:
+            aggregated = self.aggregator.aggregate_with_user_records(kinesis_records)
+            kinesis_records = [aggregated_record for aggregated_record, _ in aggregated]
+            if site_intervals is not None:
+                for aggregated_record, user_records in aggregated:
+                    if len(user_records) > 1:
+                        site_intervals[id(aggregated_record)] = [site_interval for user_record in user_records
+                                                                 for site_interval in site_intervals.get(id(user_record), ())]
+        return kinesis_records
+
+    def push_kinesis_records(self, kinesis_records, di_framework_client, batch_size=None, site_intervals=None):
+        """Compresses and aggregates the encoded kinesis records, see prepare_kinesis_records(), and writes them to kinesis in batches
+
+        Note:
+            With max_in_flight above 1 the records are split into lanes by their partition key and the lanes are sent in parallel.
+            The batches of a lane are sent one after another, so records with the same partition key keep their order.
+            With a spool, up to replay_limit records left in it by earlier calls are sent first, then the records are spooled before
+            they are sent. Limiting the replay keeps a backlog built up while kinesis was unavailable from stalling each push.
+
+        Arguments:
+            kinesis_records {list} -- Dicts that are ready to be added into kinesis
+            di_framework_client {DIFramework} -- Data Integration client to manage job status logging
+
+        Keyword Arguments:
+            batch_size {int} -- a fixed number of records sent to kinesis in each put_records() call (default: {None})
+            site_intervals {dict} -- the site intervals of the records by id(), see encode_detector_count_records() (default: {None})
+        Returns:
+            {Dict} -- the number of kinesis records, put_records() calls it took to send them and records that were retried and dropped,
+                      including the records replayed from the spool
+        """
+        kinesis_records = self.prepare_kinesis_records(kinesis_records, site_intervals)
+        replay_summary = None
+        spool_sequences = None
+        if self.spool:
+            if self.spool.pending_records():
+                replay_summary = self.replay_spool(di_framework_client, batch_size=batch_size, limit=self.replay_limit)
+            spool_sequences = self.spool_records(kinesis_records)
+        if self.max_in_flight > 1 and len(kinesis_records) > 1:
+            lanes = [[] for _ in range(self.max_in_flight)]
+            for kinesis_record in kinesis_records:
+                lane_key = kinesis_record.get("ExplicitHashKey") or kinesis_record["PartitionKey"]
+                lanes[zlib.crc32(lane_key.encode('utf-8')) % self.max_in_flight].append(kinesis_record)
+            lanes = [lane for lane in lanes if lane]
+            with ThreadPoolExecutor(max_workers=len(lanes), thread_name_prefix="kinesis-put-records") as executor:
+                lane_summaries = list(executor.map(lambda lane: self.write_batches_to_kinesis(lane, di_framework_client, batch_size, spool_sequences, site_intervals), lanes))
+        else:
+            lane_summaries = [self.write_batches_to_kinesis(kinesis_records, di_framework_client, batch_size, spool_sequences, site_intervals)]
+        summary = {"kinesis_records": len(kinesis_records), "put_records_calls": 0, "retried_records": 0, "dropped_records": 0}
+        for lane_summary in lane_summaries:
+            for key in lane_summary:
+                summary[key] += lane_summary[key]
+        return self.add_replay_summary(summary, replay_summary)
+
+    @staticmethod
+    def add_replay_summary(summary, replay_summary):
+        """Adds the counts of a summary returned by replay_spool() to a summary of a push, None if nothing was replayed"""
+        if replay_summary:
+            summary["replayed_records"] = replay_summary["replayed_records"]
+            for key in ("put_records_calls", "retried_records", "dropped_records"):
+                summary[key] += replay_summary[key]
+        return summary
+
+    def close(self):
+        """Closes the spool and saves the deduplicator's keys, call this when the connector shuts down"""
+        if self.spool:
+            self.spool.close()
+        if self.deduplicator:
+            self.deduplicator.close()
+
+    def spool_records(self, kinesis_records):
+        """Writes kinesis records to the spool, returning a Dict of the id() of each spooled record to its spool sequence number"""
+        sequences = self.spool.append(kinesis_records)
+        return {id(kinesis_record): sequence for kinesis_record, sequence in zip(kinesis_records, sequences) if sequence is not None}
+
+    def ack_sent_records(self, result, spool_sequences, site_intervals=None):
+        """Acknowledges the spooled records that put_records_with_retries() added to kinesis and moves the records kinesis rejected to
+        the spool's dead-letter file, records that were dropped after running out of attempts stay in the spool to be replayed.
+        The site intervals of the records that were added, kept by id() when they were encoded, are observed for their freshness
+        lag and remembered by the deduplicator. Records replayed from the spool have no site intervals and are not observed."""
+        if self.spool and spool_sequences:
+            self.spool.ack([spool_sequences.get(id(kinesis_record)) for kinesis_record in result["sent_records"]])
+            self.spool.dead_letter([(spool_sequences[id(kinesis_record)], kinesis_record) for kinesis_record in result["rejected_records"]
+                                    if id(kinesis_record) in spool_sequences])
+        if site_intervals and result["sent_records"]:
+            sent_site_intervals = [site_interval for kinesis_record in result["sent_records"]
+                                   for site_interval in site_intervals.get(id(kinesis_record), ())]
+            self.observe_freshness(sent_site_intervals)
+            if self.deduplicator:
+                self.deduplicator.remember_keys(site_interval for site_interval in sent_site_intervals if site_interval[1] is not None)
+
+    def replay_spool(self, di_framework_client, batch_size=None, limit=None):
+        """Sends the records in the spool that have not been acknowledged, such as records that could not be sent before a restart
+
+        Keyword Arguments:
+            batch_size {int} -- a fixed number of records sent to kinesis in each put_records() call (default: {None})
+            limit {int} -- the most records that are sent (default: {None})
+        Returns:
+            {Dict} -- replayed_records and the put_records() calls it took to send them and the records that were retried and dropped
+        """
+        spooled = self.spool.replay(limit=limit)
+        kinesis_records = [kinesis_record for _, kinesis_record in spooled]
+        spool_sequences = {id(kinesis_record): sequence for sequence, kinesis_record in spooled}
+        log.info(f"Replaying {len(kinesis_records)} kinesis records from the spool")
+        summary = self.write_batches_to_kinesis(kinesis_records, di_framework_client, batch_size, spool_sequences)
+        summary["replayed_records"] = len(kinesis_records)
+        return summary
+
+    def write_batches_to_kinesis(self, kinesis_records, di_framework_client, batch_size=None, spool_sequences=None, site_intervals=None):
+        """Writes kinesis records in put_records() sized batches one after another
+
+        Arguments:
+            kinesis_records {list} -- Dicts that are ready to be added into kinesis
+            di_framework_client {DIFramework} -- Data Integration client to manage job status logging
+
+        Keyword Arguments:
+            batch_size {int} -- a fixed number of records sent to kinesis in each put_records() call (default: {None})
+            spool_sequences {dict} -- the spool sequence numbers of the records by id(), see spool_records() (default: {None})
+            site_intervals {dict} -- the site intervals of the records by id(), see encode_detector_count_records() (default: {None})
+        Returns:
+            {Dict} -- the put_records() calls made and the records that were retried and dropped, see put_records_with_retries()
         """
-        for batch in utils.chunks(records, batch_size):
-            records_batch = [self.generate_kinesis_record(partition_key, record) for record in batch]
-            self.write_records_to_kinesis(records_batch, di_framework_client)
+        summary = {"put_records_calls": 0, "retried_records": 0, "dropped_records": 0}
+        batches = utils.chunks(kinesis_records, batch_size) if batch_size else self.batcher.batches(kinesis_records)
+        for records_batch in batches:
+            result = self.put_records_with_retries(records_batch, di_framework_client)
+            self.ack_sent_records(result, spool_sequences, site_intervals)
+            for key in summary:
+                summary[key] += result[key]
+        return summary
 
-    def generate_kinesis_record(self,partition_key, data):
-        """Returns a Dict of with fields required by kinesis, encoding the data.
+    def generate_kinesis_record(self,partition_key, data, explicit_hash_key=None):
+        """Returns a Dict of with fields required by kinesis, encoding the data with the producer's codec.
         
         Arguments:
             partition_key {str} -- key used by kinesis to determine which shard the data is written in.
             data {dict} -- Data to be encoded
+
+        Keyword Arguments:
+            explicit_hash_key {str} -- overrides the hash of the partition key to choose the shard (default: {None})
         Returns:
             Dict
         """
-        return {
+        kinesis_record = {
             "PartitionKey": partition_key,
-            "Data": json.dumps(data).encode('utf-8')
+            "Data": self.codec.encode(data)
         }
+        if explicit_hash_key:
+            kinesis_record["ExplicitHashKey"] = explicit_hash_key
+        return kinesis_record
     
     def write_records_to_kinesis(self,records,di_framework_client,retry=True):
         """Writes a batch of records into kinesis
@@ -63,29 +529,102 @@ class KinesisProducer:
             di_framework_client {DIFramework} -- Data Integration client to manage job status logging
         
         Keyword Arguments:
-            retry {bool} -- if this flag is true there will be one attempt to retry the failed records. (default: {True})
+            retry {bool} -- if this flag is true failed records are retried as the producer's retry_policy allows. (default: {True})
+        Returns:
+            {dict} -- the response of the last put_records() call, None if it raised an exception
         """
-        try:
-            response = self.kinesis_client.put_records(Records=records, StreamName=self.stream_name)
-            if(int(response["FailedRecordCount"])>0):
-                error_message = f'{response["FailedRecordCount"]} out of {len(response["Records"])} records failed when being added to kinesis'
-                log.error(error_message)
-                failed_records = self.get_failed_records(records,response)
-                di_framework_client.log_job_status(error_message)
-                if(retry and len(failed_records) > 0):
-                    time.sleep(2)
-                    return self.write_records_to_kinesis(failed_records,di_framework_client,retry=False)
+        return self.put_records_with_retries(records, di_framework_client, retry)["response"]
+
+    def put_records_with_retries(self,records,di_framework_client,retry=True):
+        """Writes a batch of records into kinesis, retrying the records that failed with a retryable error
+        
+        Records that fail with a retryable ErrorCode, or whose call raised a retryable exception, are sent again after an exponential
+        backoff until retry_policy.max_attempts is reached. Records that fail with any other ErrorCode, or whose call raised an
+        exception that rejects the records themselves such as a ValidationException, are dropped straight away as rejected records.
+
+        Arguments:
+            records {list} -- list of Dicts that are ready to be added into kinesis
+            di_framework_client {DIFramework} -- Data Integration client to manage job status logging
+        
+        Keyword Arguments:
+            retry {bool} -- if this flag is false the records are only attempted once. (default: {True})
+        Returns:
+            {dict} -- put_records_calls, retried_records, dropped_records, dropped_error_codes (counts by ErrorCode), the last response,
+                      sent_records, the records that were added to kinesis, and rejected_records, the dropped records that kinesis
+                      will never accept
+        """
+        result = {"put_records_calls": 0, "retried_records": 0, "dropped_records": 0, "dropped_error_codes": {}, "response": None,
+                  "sent_records": [], "rejected_records": []}
+        max_attempts = self.retry_policy.max_attempts if retry else 1
+        pending_records = records
+        for attempt in range(max_attempts):
+            is_last_attempt = attempt == max_attempts - 1
+            if self.rate_limiter:
+                self.rate_limiter.acquire(pending_records)
+            try:
+                with metrics.KINESIS_PUT_RECORDS_SECONDS.time():
+                    response = self.kinesis_client.put_records(Records=pending_records, StreamName=self.stream_name)
+            except Exception as e:
+                metrics.KINESIS_RECORDS.labels("failed").inc(len(pending_records))
+                if self.retry_policy.is_retryable_exception(e) and not is_last_attempt:
+                    log.warning(f"Retrying {len(pending_records)} records after a retryable error when adding records to kinesis: {e}")
+                    result["retried_records"] += len(pending_records)
+                    self.retry_policy.wait(attempt)
+                    continue
+                log.error("An error occured when attempting to add records to kinesis.")
+                log.error(e)
+                di_framework_client.log_job_status(str(e))
+                self.__drop_records(result, pending_records, type(e).__name__, self.retry_policy.is_rejected_exception(e))
+                result["response"] = None
+                break
+            with self.__counters_lock:
+                self.put_records_calls += 1
+            result["put_records_calls"] += 1
+            result["response"] = response
+            throttled_records = self.get_throttled_record_count(response)
+            self.batcher.record_result(len(pending_records), throttled_records)
+            metrics.KINESIS_RECORDS.labels("sent").inc(len(pending_records) - int(response["FailedRecordCount"]))
+            metrics.KINESIS_RECORDS.labels("throttled").inc(throttled_records)
+            metrics.KINESIS_RECORDS.labels("failed").inc(int(response["FailedRecordCount"]) - throttled_records)
+            if int(response["FailedRecordCount"]) == 0:
+                result["sent_records"].extend(pending_records)
+                break
+            error_message = f'{response["FailedRecordCount"]} out of {len(response["Records"])} records failed when being added to kinesis'
+            log.error(error_message)
+            di_framework_client.log_job_status(error_message)
+            retryable_records = []
+            for record, record_result in zip(pending_records, response["Records"]):
+                error_code = record_result.get("ErrorCode")
+                if not error_code:
+                    result["sent_records"].append(record)
+                    continue
+                if not self.retry_policy.is_retryable_error_code(error_code):
+                    self.__drop_records(result, [record], error_code, rejected=True)
+                elif is_last_attempt:
+                    self.__drop_records(result, [record], error_code)
                 else:
-                    return response
-            else:
-                return response
-        except Exception as e:
-            log.error("An error occured when attempting to add records to kinesis.")
-            log.error(e)
-            di_framework_client.log_job_status(e)
+                    retryable_records.append(record)
+            if not retryable_records:
+                break
+            result["retried_records"] += len(retryable_records)
+            pending_records = retryable_records
+            self.retry_policy.wait(attempt)
+        if result["dropped_records"]:
+            log.error(f'{result["dropped_records"]} records were dropped and not added to kinesis: {result["dropped_error_codes"]}')
+        return result
+
+    def __drop_records(self, result, records, error_code, rejected=False):
+        count = len(records)
+        if rejected:
+            result["rejected_records"].extend(records)
+        metrics.KINESIS_RECORDS.labels("dropped").inc(count)
+        result["dropped_records"] += count
+        result["dropped_error_codes"][error_code] = result["dropped_error_codes"].get(error_code, 0) + count
+        with self.__counters_lock:
+            self.dropped_records += count
 
     def get_failed_records(self, all_attempted_records, response):
-        """Returns a list of all the records that failed because of the kinesis rate limit
+        """Returns a list of all the records that failed with an ErrorCode that the retry policy will retry
         
         Arguments:
             all_attempted_records {list} -- the list of records that were originially attempted to be put in kinesis
@@ -93,6 +632,12 @@ class KinesisProducer:
         """
         failed_records = []
         for index, record in enumerate(response["Records"]):
-            if "ErrorCode" in record and record["ErrorCode"] == "ProvisionedThroughputExceededException":
+            if "ErrorCode" in record and self.retry_policy.is_retryable_error_code(record["ErrorCode"]):
                 failed_records.append(all_attempted_records[index])
-        return failed_records
\ No newline at end of file
+        return failed_records
+
+    def get_throttled_record_count(self, response):
+        """Returns the number of records in a put_records() response that failed because of the kinesis rate limit"""
+        if int(response["FailedRecordCount"]) == 0:
+            return 0
+        return len([r for r in response["Records"] if r.get("ErrorCode") == "ProvisionedThroughputExceededException"])
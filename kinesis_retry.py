@@ -0,0 +1,168 @@
+r"""
+kinesis_retry.py decides which failed kinesis writes are retried, how long to wait before retrying and paces writes under the shard limits.
+"""
+import bisect
+import random
+import threading
+import time
+from botocore.exceptions import ClientError, ConnectionError as BotoConnectionError, HTTPClientError
+import utils
+
+# ErrorCodes of individual records in a put_records() response that can succeed if they are sent again
+RETRYABLE_RECORD_ERROR_CODES = {
+    "ProvisionedThroughputExceededException",
+    "InternalFailure",
+    "KMSThrottlingException"
+}
+
+# Error codes of a put_records() call that raised a ClientError and can succeed if the call is made again
+RETRYABLE_CLIENT_ERROR_CODES = {
+    "ProvisionedThroughputExceededException",
+    "LimitExceededException",
+    "ThrottlingException",
+    "InternalFailure",
+    "InternalFailureException",
+    "ServiceUnavailable",
+    "ServiceUnavailableException",
+    "KMSThrottlingException"
+}
+
+# Error codes of a put_records() call that raised a ClientError because of the records themselves, they fail the same way every time
+REJECTED_CLIENT_ERROR_CODES = {
+    "ValidationException",
+    "InvalidArgumentException"
+}
+
+SHARD_RECORDS_PER_SECOND = 1000
+SHARD_BYTES_PER_SECOND = 1024*1024
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter for kinesis writes.
+
+    The delay before attempt n+1 is a random time between 0 and min(max_delay, base_delay * 2**n) seconds, so producers that were
+    throttled together do not retry together.
+
+    Attributes:
+        max_attempts (int)  : the most times a record will be sent, including the first attempt
+        base_delay   (float): the upper bound of the delay in seconds after the first attempt
+        max_delay    (float): the largest delay in seconds between attempts
+    """
+    def __init__(self, max_attempts=5, base_delay=0.1, max_delay=10, sleep=time.sleep, random_fraction=random.random):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.__sleep = sleep
+        self.__random_fraction = random_fraction
+
+    def get_delay(self, attempt):
+        """Returns the seconds to wait after the given attempt failed, attempts are numbered from 0"""
+        return self.__random_fraction() * min(self.max_delay, self.base_delay * 2**attempt)
+
+    def wait(self, attempt):
+        """Sleeps for the backoff delay of the given attempt"""
+        self.__sleep(self.get_delay(attempt))
+
+    def is_retryable_error_code(self, error_code):
+        """Returns True if a record that failed with the given ErrorCode should be sent again"""
+        return error_code in RETRYABLE_RECORD_ERROR_CODES
+
+    def is_retryable_exception(self, exception):
+        """Returns True if a put_records() call that raised the exception should be made again"""
+        if isinstance(exception, ClientError):
+            return exception.response.get("Error", {}).get("Code") in RETRYABLE_CLIENT_ERROR_CODES
+        return isinstance(exception, (BotoConnectionError, HTTPClientError))
+
+    def is_rejected_exception(self, exception):
+        """Returns True if a put_records() call raised the exception because kinesis will never accept its records, e.g. an oversized record"""
+        return isinstance(exception, ClientError) and exception.response.get("Error", {}).get("Code") in REJECTED_CLIENT_ERROR_CODES
+
+
+class TokenBucket:
+    """A thread safe token bucket that refills at a constant rate.
+
+    Tokens are reserved rather than waited for, so a request larger than the capacity is allowed and the bucket goes into debt
+    that later requests wait out.
+
+    Attributes:
+        rate     (float): tokens added per second
+        capacity (float): the most tokens the bucket can hold, this is the largest burst that is sent without waiting
+    """
+    def __init__(self, rate, capacity=None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.__clock = clock
+        self.__sleep = sleep
+        self.__tokens = self.capacity
+        self.__updated = clock()
+        self.__lock = threading.Lock()
+
+    def reserve(self, amount):
+        """Takes amount tokens from the bucket and returns the seconds until they are available"""
+        with self.__lock:
+            now = self.__clock()
+            self.__tokens = min(self.capacity, self.__tokens + (now - self.__updated) * self.rate)
+            self.__updated = now
+            self.__tokens -= amount
+            return max(0.0, -self.__tokens / self.rate)
+
+    def acquire(self, amount):
+        """Blocks until amount tokens are available, returning the seconds spent waiting"""
+        wait = self.reserve(amount)
+        if wait > 0:
+            self.__sleep(wait)
+        return wait
+
+
+class ShardRateLimiter:
+    """Paces kinesis writes under the per shard limits of 1000 records and 1 MB per second.
+
+    Each shard has a record and a byte token bucket, records are assigned to shards by their ExplicitHashKey or the MD5 hash of their
+    PartitionKey. If the shards are not known all records share one pair of buckets sized for num_shards shards.
+
+    Attributes:
+        shards             (list) : the open shards of the stream, see kinesis_producer.describe_open_shards()
+        num_shards         (int)  : the number of shards the shared buckets are sized for when shards is None
+        records_per_second (float): the record limit of each shard
+        bytes_per_second   (float): the byte limit of each shard
+        waited_seconds     (float): total time spent waiting for tokens
+    """
+    def __init__(self, shards=None, num_shards=1, records_per_second=SHARD_RECORDS_PER_SECOND, bytes_per_second=SHARD_BYTES_PER_SECOND,
+                 clock=time.monotonic, sleep=time.sleep):
+        self.shards = shards
+        self.num_shards = len(shards) if shards else num_shards
+        self.records_per_second = records_per_second
+        self.bytes_per_second = bytes_per_second
+        self.waited_seconds = 0.0
+        self.__sleep = sleep
+        buckets = len(shards) if shards else 1
+        scale = 1 if shards else num_shards
+        self.__record_buckets = [TokenBucket(records_per_second * scale, clock=clock, sleep=sleep) for _ in range(buckets)]
+        self.__byte_buckets = [TokenBucket(bytes_per_second * scale, clock=clock, sleep=sleep) for _ in range(buckets)]
+        self.__shard_starting_hash_keys = [shard["StartingHashKey"] for shard in shards] if shards else None
+
+    def get_shard_index(self, kinesis_record):
+        """Returns the index of the shard that a kinesis record will be written to"""
+        if self.__shard_starting_hash_keys is None:
+            return 0
+        explicit_hash_key = kinesis_record.get("ExplicitHashKey")
+        hash_key = int(explicit_hash_key) if explicit_hash_key else utils.md5_hash_key(kinesis_record["PartitionKey"])
+        return max(0, bisect.bisect(self.__shard_starting_hash_keys, hash_key) - 1)
+
+    def acquire(self, kinesis_records):
+        """Blocks until every shard the records are written to has capacity for them, returning the seconds spent waiting"""
+        records_per_shard = {}
+        bytes_per_shard = {}
+        for kinesis_record in kinesis_records:
+            shard_index = self.get_shard_index(kinesis_record)
+            records_per_shard[shard_index] = records_per_shard.get(shard_index, 0) + 1
+            bytes_per_shard[shard_index] = bytes_per_shard.get(shard_index, 0) + len(kinesis_record["Data"]) + len(kinesis_record["PartitionKey"].encode('utf-8'))
+        wait = 0.0
+        for shard_index, record_count in records_per_shard.items():
+            wait = max(wait,
+                       self.__record_buckets[shard_index].reserve(record_count),
+                       self.__byte_buckets[shard_index].reserve(bytes_per_shard[shard_index]))
+        if wait > 0:
+            self.waited_seconds += wait
+            self.__sleep(wait)
+        return wait
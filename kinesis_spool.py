@@ -0,0 +1,271 @@
+r"""
+kinesis_spool.py is a write-ahead log on local disk for kinesis records that have not been added to kinesis yet.
+
+Records are appended to segment files before they are sent and acknowledged once put_records() has succeeded. Acknowledged sequence
+numbers are appended to an ack file next to each segment, a segment and its ack file are deleted once every record in it has been
+acknowledged. After a restart the records that were never acknowledged are read back from the segments with mmap. Records that
+kinesis rejected, and will reject every time they are sent, are moved to the dead-letter file with the same entry layout.
+
+    segment entry = header (sequence, crc32, partition key size, explicit hash key size, data size) + partition key + explicit hash key + data
+"""
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+log = logging.getLogger(__name__)
+
+ENTRY_HEADER = struct.Struct(">QIHHI")
+ACK = struct.Struct(">Q")
+SEGMENT_SUFFIX = ".seg"
+ACK_SUFFIX = ".ack"
+DEAD_LETTER_FILE = "dead-letter.log"
+FSYNC_POLICIES = ("always", "interval", "segment", "never")
+
+class KinesisSpool:
+    """A disk backed, append only spool of kinesis records split into segment files.
+
+    Attributes:
+        directory       (str)  : where the segment and ack files are kept
+        segment_size    (int)  : the size in bytes a segment grows to before a new one is started
+        max_spool_bytes (int)  : the most bytes the segments can take up, records are not spooled once it is reached
+        fsync_policy    (str)  : when the files are fsynced, "always" after every append and ack, "interval" at most every
+                                 fsync_interval seconds, "segment" when a segment is finished and "never" leaves it to the OS
+        fsync_interval  (float): seconds between fsyncs with the "interval" policy
+        rejected_records (int) : records that were not spooled because the spool was full
+        dead_letter_records (int): records moved to the dead-letter file by dead_letter()
+    """
+    def __init__(self, directory, segment_size=64*1024*1024, max_spool_bytes=1024*1024*1024, fsync_policy="interval", fsync_interval=1.0):
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync_policy {fsync_policy}, expected one of {', '.join(FSYNC_POLICIES)}")
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_spool_bytes = max_spool_bytes
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
+        self.rejected_records = 0
+        self.dead_letter_records = 0
+        self.__lock = threading.Lock()
+        self.__segments = {}
+        self.__unacked = {}
+        self.__active_segment = None
+        self.__active_file = None
+        self.__last_fsync = time.monotonic()
+        self.__next_sequence = 0
+        os.makedirs(directory, exist_ok=True)
+        self.__load_segments()
+
+    def __load_segments(self):
+        for file_name in sorted(os.listdir(self.directory)):
+            if not file_name.endswith(SEGMENT_SUFFIX):
+                continue
+            segment = file_name[:-len(SEGMENT_SUFFIX)]
+            acked = set()
+            ack_path = self.__path(segment, ACK_SUFFIX)
+            if os.path.exists(ack_path):
+                with open(ack_path, "rb") as file_handle:
+                    ack_bytes = file_handle.read()
+                acked = {sequence for (sequence,) in ACK.iter_unpack(ack_bytes[:len(ack_bytes) - len(ack_bytes) % ACK.size])}
+            unacked = set()
+            for sequence, offset, _ in self.__iter_entries(segment):
+                self.__next_sequence = max(self.__next_sequence, sequence + 1)
+                if sequence not in acked:
+                    unacked.add(sequence)
+                    self.__unacked[sequence] = (segment, offset)
+            self.__segments[segment] = {"size": os.path.getsize(self.__path(segment, SEGMENT_SUFFIX)), "unacked": unacked}
+            if not unacked:
+                self.__delete_segment(segment)
+        if self.__unacked:
+            log.info(f"Found {len(self.__unacked)} spooled kinesis records that were not acknowledged in {self.directory}")
+
+    def __path(self, segment, suffix):
+        return os.path.join(self.directory, segment + suffix)
+
+    def __iter_entries(self, segment):
+        """Generator to yield the sequence, offset and kinesis record of every complete entry in a segment, using a memory map"""
+        path = self.__path(segment, SEGMENT_SUFFIX)
+        if os.path.getsize(path) == 0:
+            return
+        with open(path, "rb") as file_handle, mmap.mmap(file_handle.fileno(), 0, access=mmap.ACCESS_READ) as segment_map:
+            offset = 0
+            while offset + ENTRY_HEADER.size <= len(segment_map):
+                entry = self.__read_entry(segment_map, offset)
+                if entry is None:
+                    log.warning(f"Ignoring a partly written entry at byte {offset} of spool segment {segment}")
+                    return
+                sequence, kinesis_record, entry_size = entry
+                yield sequence, offset, kinesis_record
+                offset += entry_size
+
+    @staticmethod
+    def __read_entry(segment_map, offset):
+        sequence, crc, partition_key_size, explicit_hash_key_size, data_size = ENTRY_HEADER.unpack_from(segment_map, offset)
+        body_start = offset + ENTRY_HEADER.size
+        body_end = body_start + partition_key_size + explicit_hash_key_size + data_size
+        if body_end > len(segment_map):
+            return None
+        body = segment_map[body_start:body_end]
+        if zlib.crc32(body) != crc:
+            return None
+        kinesis_record = {
+            "PartitionKey": body[:partition_key_size].decode('utf-8'),
+            "Data": body[partition_key_size + explicit_hash_key_size:]
+        }
+        if explicit_hash_key_size:
+            kinesis_record["ExplicitHashKey"] = body[partition_key_size:partition_key_size + explicit_hash_key_size].decode('utf-8')
+        return sequence, kinesis_record, body_end - offset
+
+    @staticmethod
+    def encode_entry(sequence, kinesis_record):
+        """Returns the bytes of a segment entry for a kinesis record"""
+        partition_key = kinesis_record["PartitionKey"].encode('utf-8')
+        explicit_hash_key = kinesis_record.get("ExplicitHashKey", "").encode('utf-8')
+        data = kinesis_record["Data"]
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        body = partition_key + explicit_hash_key + data
+        return ENTRY_HEADER.pack(sequence, zlib.crc32(body), len(partition_key), len(explicit_hash_key), len(data)) + body
+
+    def size_bytes(self):
+        """Returns the bytes taken up by the segments"""
+        return sum(segment["size"] for segment in self.__segments.values())
+
+    def pending_records(self):
+        """Returns the number of spooled records that have not been acknowledged"""
+        return len(self.__unacked)
+
+    def append(self, kinesis_records):
+        """Writes kinesis records to the spool
+
+        Returns:
+            {list} -- the sequence number of each record, None for records that were not spooled because max_spool_bytes was reached
+        """
+        sequences = []
+        with self.__lock:
+            for kinesis_record in kinesis_records:
+                entry = self.encode_entry(self.__next_sequence, kinesis_record)
+                if self.size_bytes() + len(entry) > self.max_spool_bytes:
+                    self.rejected_records += 1
+                    sequences.append(None)
+                    continue
+                if self.__active_segment is None or self.__segments[self.__active_segment]["size"] + len(entry) > self.segment_size:
+                    self.__start_segment()
+                offset = self.__segments[self.__active_segment]["size"]
+                self.__active_file.write(entry)
+                self.__segments[self.__active_segment]["size"] += len(entry)
+                self.__segments[self.__active_segment]["unacked"].add(self.__next_sequence)
+                self.__unacked[self.__next_sequence] = (self.__active_segment, offset)
+                sequences.append(self.__next_sequence)
+                self.__next_sequence += 1
+            if self.__active_file:
+                self.__active_file.flush()
+                self.__sync(self.__active_file)
+        if self.rejected_records and None in sequences:
+            log.error(f"The kinesis spool is full ({self.max_spool_bytes} bytes), {sequences.count(None)} records were not spooled")
+        return sequences
+
+    def __start_segment(self):
+        if self.__active_file:
+            self.__finish_active_segment()
+        self.__active_segment = f"{self.__next_sequence:020d}"
+        self.__active_file = open(self.__path(self.__active_segment, SEGMENT_SUFFIX), "ab")
+        self.__segments[self.__active_segment] = {"size": 0, "unacked": set()}
+
+    def __finish_active_segment(self):
+        self.__active_file.flush()
+        if self.fsync_policy != "never":
+            os.fsync(self.__active_file.fileno())
+        self.__active_file.close()
+        segment = self.__active_segment
+        self.__active_file = None
+        self.__active_segment = None
+        if not self.__segments[segment]["unacked"]:
+            self.__delete_segment(segment)
+
+    def __sync(self, file_handle, force=False):
+        now = time.monotonic()
+        if force or self.fsync_policy == "always" or (self.fsync_policy == "interval" and now - self.__last_fsync >= self.fsync_interval):
+            os.fsync(file_handle.fileno())
+            self.__last_fsync = now
+
+    def ack(self, sequences):
+        """Acknowledges that the records with the sequence numbers have been added to kinesis, None sequences are ignored"""
+        acked_per_segment = {}
+        with self.__lock:
+            for sequence in sequences:
+                location = self.__unacked.pop(sequence, None) if sequence is not None else None
+                if location:
+                    acked_per_segment.setdefault(location[0], []).append(sequence)
+            for segment, acked in acked_per_segment.items():
+                unacked = self.__segments[segment]["unacked"]
+                unacked.difference_update(acked)
+                if not unacked and segment != self.__active_segment:
+                    self.__delete_segment(segment)
+                    continue
+                with open(self.__path(segment, ACK_SUFFIX), "ab") as file_handle:
+                    file_handle.write(b"".join(ACK.pack(sequence) for sequence in acked))
+                    file_handle.flush()
+                    self.__sync(file_handle)
+
+    def dead_letter(self, entries):
+        """Moves spooled records that kinesis rejected to the dead-letter file, so they are kept but never replayed
+
+        Arguments:
+            entries {list} -- (sequence number, kinesis record) tuples of spooled records
+        """
+        if not entries:
+            return
+        with self.__lock:
+            with open(os.path.join(self.directory, DEAD_LETTER_FILE), "ab") as file_handle:
+                file_handle.write(b"".join(self.encode_entry(sequence, kinesis_record) for sequence, kinesis_record in entries))
+                file_handle.flush()
+                self.__sync(file_handle, force=self.fsync_policy != "never")
+            self.dead_letter_records += len(entries)
+        log.error(f"Moved {len(entries)} kinesis records that were rejected by kinesis to {os.path.join(self.directory, DEAD_LETTER_FILE)}")
+        self.ack([sequence for sequence, _ in entries])
+
+    def __delete_segment(self, segment):
+        for suffix in (SEGMENT_SUFFIX, ACK_SUFFIX):
+            try:
+                os.remove(self.__path(segment, suffix))
+            except FileNotFoundError:
+                pass
+        del self.__segments[segment]
+
+    def replay(self, before_sequence=None, limit=None):
+        """Returns the spooled records that have not been acknowledged, oldest first, read from the segments with mmap
+
+        Keyword Arguments:
+            before_sequence {int} -- only return records spooled before this sequence number (default: {None})
+            limit {int} -- the most records returned (default: {None})
+        Returns:
+            {list} -- (sequence number, kinesis record) tuples
+        """
+        with self.__lock:
+            if self.__active_file:
+                self.__active_file.flush()
+            wanted = sorted(sequence for sequence in self.__unacked if before_sequence is None or sequence < before_sequence)[:limit]
+            offsets_per_segment = {}
+            for sequence in wanted:
+                segment, offset = self.__unacked[sequence]
+                offsets_per_segment.setdefault(segment, []).append(offset)
+            replayed = []
+            for segment, offsets in offsets_per_segment.items():
+                with open(self.__path(segment, SEGMENT_SUFFIX), "rb") as file_handle, mmap.mmap(file_handle.fileno(), 0, access=mmap.ACCESS_READ) as segment_map:
+                    for offset in offsets:
+                        sequence, kinesis_record, _ = self.__read_entry(segment_map, offset)
+                        replayed.append((sequence, kinesis_record))
+        return sorted(replayed, key=lambda entry: entry[0])
+
+    def next_sequence(self):
+        """Returns the sequence number the next spooled record will be given"""
+        return self.__next_sequence
+
+    def close(self):
+        """Fsyncs and closes the active segment"""
+        with self.__lock:
+            if self.__active_file:
+                self.__finish_active_segment()
@@ -0,0 +1,406 @@
+r"""
+load_test.py runs the connector, wired up by main.py, against local stand-ins for transis and kinesis to measure its sustained
+throughput and lag.
+
+TransisStandInServer imitates /transis/pushservice?types=DetectorCount, sending the null byte delimited documents of a
+benchmarks.WorkloadGenerator at a fixed rate and optionally going silent for a while like transis does. It also serves the
+/transis/rest/* endpoints that TransisConsumer requests. ThrottlingKinesisClient takes the place of the boto3 kinesis client and
+enforces the per shard limits of 1000 records and 1MiB per second, failing records with ProvisionedThroughputExceededException.
+
+The connector is configured by the same environment variables as main.py e.g. CONNECTOR_RUN_MODE, KINESIS_MAX_IN_FLIGHT.
+
+Run with: python load_test.py --sites 5000 --documents 60 --documents-per-second 1 --shards 4 --output load_test.json
+"""
+import argparse
+import hashlib
+import json
+import logging
+import select
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import botocore.exceptions
+import utils
+import record_codecs
+from benchmarks import WorkloadGenerator, percentile, tail_percentile
+
+log = logging.getLogger(__name__)
+
+MAX_HASH_KEY = 2**128 - 1
+EMPTY_TRANSIS_RESPONSE = (b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                          b'<ns2:TransisResponse error="false" xmlns:ns2="http://model.transis.rta.nsw.gov.au/"></ns2:TransisResponse>')
+
+class LoadTestStats:
+    """Collects when each detector count document was sent and when its records were added to kinesis.
+
+    Attributes:
+        documents_sent   (int) : documents the transis stand-in has finished sending
+        accepted_records (int) : detector count records added to the kinesis stand-in
+    """
+    def __init__(self):
+        self.documents_sent = 0
+        self.accepted_records = 0
+        self.__sent_times = {}
+        self.__lags = []
+        self.__lock = threading.Lock()
+
+    def document_sent(self, collectionendtimestamp_plus_3_mins):
+        """Records that the document of a collection interval has been sent"""
+        with self.__lock:
+            self.documents_sent += 1
+            self.__sent_times[collectionendtimestamp_plus_3_mins] = time.monotonic()
+
+    def records_accepted(self, data):
+        """Records the lag from sending its document of every detector count record in the Data of the accepted kinesis records"""
+        now = time.monotonic()
+        epocs = [record["collectionendtimestamp_plus_3_mins"] for d in data for record in record_codecs.decode_kinesis_data(d)]
+        with self.__lock:
+            self.accepted_records += len(epocs)
+            self.__lags.extend(now - self.__sent_times[epoc] for epoc in epocs if epoc in self.__sent_times)
+
+    def take_lags(self):
+        """Returns the lags in seconds recorded since the last call"""
+        with self.__lock:
+            lags, self.__lags = self.__lags, []
+        return lags
+
+
+class ThrottlingKinesisClient:
+    """Imitates the put_records() and describe_stream() calls of a boto3 kinesis client with the kinesis per shard limits.
+
+    Each shard has a token bucket of records_per_second records and bytes_per_second bytes that refills continuously, records that a
+    shard has no capacity for fail with ProvisionedThroughputExceededException as they do in kinesis.
+
+    Attributes:
+        stream_name        (str)          : name of the imitated stream
+        num_shards         (int)          : the stream's shards split the hash key range evenly
+        records_per_second (int)          : the records each shard accepts per second
+        bytes_per_second   (int)          : the bytes of data and partition key each shard accepts per second
+        latency            (float)        : seconds each put_records() call takes
+        listener           (function)     : called with the Data of the records accepted by each call, None to not be told
+        put_records_calls  (int)          : total put_records() calls
+        accepted_records   (int)          : total kinesis records that were accepted
+        throttled_records  (int)          : total kinesis records that failed with ProvisionedThroughputExceededException
+    """
+    def __init__(self, stream_name="load-test", num_shards=1, records_per_second=1000, bytes_per_second=1024*1024, latency=0.0, listener=None):
+        self.stream_name = stream_name
+        self.num_shards = num_shards
+        self.records_per_second = records_per_second
+        self.bytes_per_second = bytes_per_second
+        self.latency = latency
+        self.listener = listener
+        self.put_records_calls = 0
+        self.accepted_records = 0
+        self.throttled_records = 0
+        self.__shard_size = (MAX_HASH_KEY + 1) // num_shards
+        self.__buckets = [[records_per_second, bytes_per_second, time.monotonic()] for _ in range(num_shards)]
+        self.__sequence_number = 0
+        self.__lock = threading.Lock()
+
+    def get_shard_id(self, shard):
+        return f"shardId-{shard:012d}"
+
+    def describe_stream(self, StreamName, ExclusiveStartShardId=None):
+        shards = []
+        for shard in range(self.num_shards):
+            ending_hash_key = MAX_HASH_KEY if shard == self.num_shards - 1 else (shard + 1) * self.__shard_size - 1
+            shards.append({
+                "ShardId": self.get_shard_id(shard),
+                "HashKeyRange": {"StartingHashKey": str(shard * self.__shard_size), "EndingHashKey": str(ending_hash_key)},
+                "SequenceNumberRange": {"StartingSequenceNumber": "0"}
+            })
+        return {"StreamDescription": {"StreamName": StreamName, "Shards": shards, "HasMoreShards": False}}
+
+    def __get_shard(self, record):
+        hash_key = int(record["ExplicitHashKey"]) if record.get("ExplicitHashKey") else int(hashlib.md5(record["PartitionKey"].encode('utf-8')).hexdigest(), 16)
+        return min(hash_key // self.__shard_size, self.num_shards - 1)
+
+    def __take_capacity(self, shard, size, now):
+        bucket = self.__buckets[shard]
+        elapsed = now - bucket[2]
+        bucket[0] = min(self.records_per_second, bucket[0] + elapsed * self.records_per_second)
+        bucket[1] = min(self.bytes_per_second, bucket[1] + elapsed * self.bytes_per_second)
+        bucket[2] = now
+        if bucket[0] < 1 or bucket[1] < size:
+            return False
+        bucket[0] -= 1
+        bucket[1] -= size
+        return True
+
+    def put_records(self, Records, StreamName):
+        """Accepts or throttles each record and returns a response shaped like the kinesis PutRecords response
+
+        Raises:
+            botocore.exceptions.ClientError -- with a ValidationException if the call is over the kinesis PutRecords limits
+        """
+        if len(Records) > 500 or sum(len(r["Data"]) + len(r["PartitionKey"]) for r in Records) > 5*1024*1024:
+            raise botocore.exceptions.ClientError({"Error": {"Code": "ValidationException", "Message": "PutRecords is over the 500 record or 5MiB limit"}},
+                                                  "PutRecords")
+        if self.latency:
+            time.sleep(self.latency)
+        results = []
+        accepted_data = []
+        with self.__lock:
+            self.put_records_calls += 1
+            now = time.monotonic()
+            for record in Records:
+                shard = self.__get_shard(record)
+                if self.__take_capacity(shard, len(record["Data"]) + len(record["PartitionKey"]), now):
+                    self.__sequence_number += 1
+                    results.append({"SequenceNumber": str(self.__sequence_number), "ShardId": self.get_shard_id(shard)})
+                    accepted_data.append(record["Data"])
+                else:
+                    results.append({
+                        "ErrorCode": "ProvisionedThroughputExceededException",
+                        "ErrorMessage": f"Rate exceeded for shard {self.get_shard_id(shard)} in stream {StreamName} under account 111111111111."
+                    })
+            failed_record_count = len(Records) - len(accepted_data)
+            self.accepted_records += len(accepted_data)
+            self.throttled_records += failed_record_count
+        if self.listener and accepted_data:
+            self.listener(accepted_data)
+        return {"FailedRecordCount": failed_record_count, "Records": results, "EncryptionType": "NONE"}
+
+
+class LoadTestDIFramework:
+    """Takes the place of the DI framework so the load test does not need a database, counting the jobs instead"""
+    def __init__(self):
+        self.started_jobs = 0
+        self.ended_jobs = 0
+        self.errored_jobs = 0
+
+    def start_job(self):
+        self.started_jobs += 1
+        return self.started_jobs
+
+    def log_job_status(self, status):
+        pass
+
+    def end_job(self):
+        self.ended_jobs += 1
+
+    def error_job(self, *args):
+        self.errored_jobs += 1
+
+    def close_db_connection(self):
+        pass
+
+
+class TransisStandInServer:
+    """A local HTTP server that imitates the transis push service and REST endpoints.
+
+    Attributes:
+        workload             (WorkloadGenerator): generates the documents that are sent
+        documents_per_second (float)            : how often a detector count document is sent on the push stream
+        stall_every          (int)              : the stream goes silent after this many documents, 0 never stalls
+        stall_seconds        (float)            : how long each stall lasts
+        stats                (LoadTestStats)    : told when each document has been sent
+        port                 (int)              : the port the server is listening on, chosen by the OS if 0
+    """
+    def __init__(self, workload, documents_per_second=1.0, stall_every=0, stall_seconds=0.0, stats=None, port=0):
+        self.workload = workload
+        self.documents_per_second = documents_per_second
+        self.stall_every = stall_every
+        self.stall_seconds = stall_seconds
+        self.stats = stats if stats else LoadTestStats()
+        self.stopped = threading.Event()
+        self.__next_document = 0
+        self.__document_lock = threading.Lock()
+        self.__stalled_documents = set()
+        self.__server = ThreadingHTTPServer(("127.0.0.1", port), self.__create_handler())
+        self.__server.daemon_threads = True
+        self.port = self.__server.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.__server.serve_forever, name="transis-stand-in", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.__server.shutdown()
+        self.__server.server_close()
+
+    def get_rest_response(self, path):
+        """Returns the body of a REST endpoint"""
+        endpoint = path.rsplit("/", 1)[-1]
+        if endpoint == "getCurrentTopology":
+            return self.workload.topology_document() + b"\x00"
+        if endpoint in ("getFromDate", "getWithinDates"):
+            return self.workload.detector_count_document(0) + b"\x00"
+        return EMPTY_TRANSIS_RESPONSE + b"\x00"
+
+    def stream_documents(self, write_chunk, is_connected):
+        """Sends the push stream documents at documents_per_second until they have all been sent, the server is stopped or the
+        connection is closed, the stream stalls once before every stall_every-th document
+
+        A document is only counted as sent once it has been written to a connection that is still open, so a client that gives up
+        on a stalled stream and reconnects carries on from the document it missed.
+        """
+        interval = 1 / self.documents_per_second
+        next_send = time.monotonic()
+        while not self.stopped.is_set():
+            with self.__document_lock:
+                index = self.__next_document
+            if index >= self.workload.documents_per_stream:
+                return
+            if self.stall_every and index and index % self.stall_every == 0 and index not in self.__stalled_documents:
+                self.__stalled_documents.add(index)
+                log.info(f"The transis stand-in is stalling for {self.stall_seconds} seconds")
+                if self.stopped.wait(self.stall_seconds):
+                    return
+                next_send = time.monotonic()
+            self.stopped.wait(max(0, next_send - time.monotonic()))
+            document = self.workload.detector_count_document(index)
+            with self.__document_lock:
+                if self.__next_document != index or not is_connected():
+                    return
+                write_chunk(document + b"\x00")
+                self.__next_document += 1
+            self.stats.document_sent(utils.get_epoc_from_timestamp_string(self.workload.interval_date(index)))
+            next_send += interval
+
+    def __create_handler(self):
+        stand_in = self
+
+        class TransisStandInHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/xml;charset=utf-8")
+                if self.path.startswith("/transis/pushservice"):
+                    self.send_header("Transfer-Encoding", "chunked")
+                    self.send_header("Connection", "close")
+                    self.end_headers()
+                    try:
+                        stand_in.stream_documents(self.write_chunk, self.is_connected)
+                        self.wfile.write(b"0\r\n\r\n")
+                    except (BrokenPipeError, ConnectionResetError):
+                        pass
+                    self.close_connection = True
+                else:
+                    body = stand_in.get_rest_response(self.path.split("?", 1)[0])
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+            def is_connected(self):
+                """Returns False if the client has closed the connection"""
+                try:
+                    readable, _, _ = select.select([self.connection], [], [], 0)
+                    return not readable or self.connection.recv(1, socket.MSG_PEEK) != b""
+                except OSError:
+                    return False
+
+            def write_chunk(self, chunk):
+                self.wfile.write(f"{len(chunk):x}\r\n".encode("ascii") + chunk + b"\r\n")
+                self.wfile.flush()
+
+            def log_message(self, format, *args):
+                log.debug(format % args)
+
+        return TransisStandInHandler
+
+
+def summarise(stats, kinesis_client, di_framework_client, workload, elapsed_seconds, lags):
+    """Returns the throughput, lag percentiles and counts of a load test run"""
+    summary = {
+        "workload": workload.get_parameters(),
+        "elapsed_seconds": elapsed_seconds,
+        "documents_sent": stats.documents_sent,
+        "records_sent": stats.documents_sent * workload.sites,
+        "records_accepted": stats.accepted_records,
+        "records_per_second": stats.accepted_records / elapsed_seconds if elapsed_seconds else None,
+        "put_records_calls": kinesis_client.put_records_calls,
+        "throttled_kinesis_records": kinesis_client.throttled_records,
+        "di_jobs_ended": di_framework_client.ended_jobs
+    }
+    if lags:
+        summary.update({"lag_p50_seconds": percentile(lags, 50), "lag_p90_seconds": tail_percentile(lags, 90),
+                        "lag_p99_seconds": tail_percentile(lags, 99), "lag_max_seconds": max(lags)})
+    return summary
+
+def run_load_test(workload, documents_per_second=1.0, stall_every=0, stall_seconds=0.0, num_shards=1, kinesis_latency=0.0,
+                  stream_timeout=60, report_interval=10, timeout=None, stop_timeout=10):
+    """Runs the connector from main.py against the stand-ins until every document has been added to kinesis or the timeout is reached
+
+    The transis stream is then stopped and the connector thread is joined, waiting up to stop_timeout seconds, so it does not
+    keep reconnecting once the stand-in has gone. The kinesis producer, with its spool and deduplicator, is closed when it ends.
+
+    Returns:
+        {dict} -- see summarise()
+    """
+    import main
+    from transis_consumer import TransisConsumer
+    stats = LoadTestStats()
+    server = TransisStandInServer(workload, documents_per_second, stall_every, stall_seconds, stats).start()
+    kinesis_client = ThrottlingKinesisClient(num_shards=num_shards, latency=kinesis_latency, listener=stats.records_accepted)
+    config = {
+        "transis_config_prod": {"hostname": "127.0.0.1", "port": server.port, "username": "load-test", "password": "load-test"},
+        "kinesis_config": {"region_name": "ap-southeast-2", "stream_name": kinesis_client.stream_name}
+    }
+    transis_consumer = TransisConsumer(config["transis_config_prod"], stream_timeout=stream_timeout)
+    di_framework_client = LoadTestDIFramework()
+    kinesis_producer = main.build_kinesis_producer(config, kinesis_client)
+    def run_connector():
+        try:
+            main.run_connector(transis_consumer, kinesis_producer, di_framework_client)
+        except Exception as e:
+            log.error(f"The connector failed: {e}")
+        finally:
+            kinesis_producer.close()
+    connector = threading.Thread(target=run_connector, name="load-test-connector", daemon=True)
+    expected_records = workload.documents_per_stream * workload.sites
+    start = time.monotonic()
+    connector.start()
+    all_lags = []
+    next_report = start + report_interval
+    try:
+        while stats.accepted_records < expected_records and (timeout is None or time.monotonic() - start < timeout):
+            if not connector.is_alive():
+                log.error("The connector stopped before every record was added to kinesis")
+                break
+            time.sleep(0.1)
+            if time.monotonic() >= next_report:
+                lags = stats.take_lags()
+                all_lags.extend(lags)
+                log.info(f"{stats.documents_sent} documents sent, {stats.accepted_records} of {expected_records} records in kinesis, "
+                         f"{kinesis_client.throttled_records} throttled, lag p50 {percentile(lags, 50) if lags else 0:.2f}s")
+                next_report += report_interval
+    finally:
+        server.stop()
+        transis_consumer.stop()
+        connector.join(stop_timeout)
+    if connector.is_alive():
+        log.error(f"The connector did not stop within {stop_timeout} seconds")
+    all_lags.extend(stats.take_lags())
+    summary = summarise(stats, kinesis_client, di_framework_client, workload, time.monotonic() - start, all_lags)
+    summary["connector_stopped"] = not connector.is_alive()
+    return summary
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the transis kinesis connector against local transis and kinesis stand-ins")
+    parser.add_argument("--sites", type=int, default=5000, help="number of sites in each document")
+    parser.add_argument("--detectors", type=int, default=24, help="the most detectors a site has")
+    parser.add_argument("--documents", type=int, default=60, help="number of documents the push stream sends")
+    parser.add_argument("--documents-per-second", type=float, default=1.0, help="how often a document is sent")
+    parser.add_argument("--stall-every", type=int, default=0, help="the stream goes silent after this many documents, 0 never stalls")
+    parser.add_argument("--stall-seconds", type=float, default=0.0, help="how long each stall lasts")
+    parser.add_argument("--stream-timeout", type=float, default=60, help="seconds without data before the connector reconnects")
+    parser.add_argument("--shards", type=int, default=1, help="number of shards of the kinesis stand-in")
+    parser.add_argument("--kinesis-latency", type=float, default=0.0, help="seconds each put_records() call takes")
+    parser.add_argument("--report-interval", type=float, default=10, help="seconds between progress logs")
+    parser.add_argument("--timeout", type=float, default=None, help="the longest the load test runs in seconds")
+    parser.add_argument("--output", default=None, help="file the summary is saved to as json")
+    args = parser.parse_args()
+    workload = WorkloadGenerator(args.sites, args.detectors, args.documents)
+    summary = run_load_test(workload, args.documents_per_second, args.stall_every, args.stall_seconds, args.shards, args.kinesis_latency,
+                            args.stream_timeout, args.report_interval, args.timeout)
+    print(json.dumps(summary, indent=2))
+    if args.output:
+        with open(args.output, "w") as file_handle:
+            json.dump(summary, file_handle, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -3,11 +3,22 @@ main.py is the entry point for the transis kinesis detector volume connector.
 """
 
 from transis_consumer import TransisConsumer
-from kinesis_producer import KinesisProducer
+from kinesis_producer import KinesisProducer, create_partitioner, describe_open_shards
+from kinesis_retry import RetryPolicy, ShardRateLimiter
+from kinesis_aggregation import RecordAggregator
+from kinesis_spool import KinesisSpool
+from record_deduplication import DuplicateRecordFilter
+from record_codecs import create_codec
+from topology_index import TopologyIndex
+from topology_enrichment import TopologyEnricher
 from transis_kinesis_connector import TransisKinesisConnector
+from async_transis_kinesis_connector import AsyncTransisKinesisConnector
 import di_framework
+import metrics
 import transis_response_models
 import requests
+import asyncio
+import functools
 import os
 import logging
 import utils
@@ -18,22 +29,116 @@ logging.basicConfig(
          level=logging.INFO,
          datefmt='%Y-%m-%d %H:%M:%S')
          
+def build_kinesis_producer(config, kinesis_client=None):
+    """Returns the KinesisProducer configured by the KINESIS_*, DEDUP_* environment variables, with a boto3 client unless one is given"""
+    kinesis_client = kinesis_client if kinesis_client else boto3.client('kinesis',config["kinesis_config"]["region_name"])
+    partitioner = create_partitioner(os.environ.get("KINESIS_PARTITIONER", "siteId"), kinesis_client, config["kinesis_config"]["stream_name"])
+    aggregator = RecordAggregator(int(os.environ["KINESIS_AGGREGATION_MAX_SIZE"]),
+                                  describe_open_shards(kinesis_client, config["kinesis_config"]["stream_name"])) if os.environ.get("KINESIS_AGGREGATION_MAX_SIZE") else None
+    retry_policy = RetryPolicy(max_attempts=int(os.environ.get("KINESIS_MAX_ATTEMPTS", "5")))
+    rate_limiter = ShardRateLimiter(describe_open_shards(kinesis_client, config["kinesis_config"]["stream_name"])) if os.environ.get("KINESIS_RATE_LIMIT") == "true" else None
+    spool = KinesisSpool(os.environ["KINESIS_SPOOL_DIR"],
+                         max_spool_bytes=int(os.environ.get("KINESIS_SPOOL_MAX_BYTES", str(1024*1024*1024))),
+                         fsync_policy=os.environ.get("KINESIS_SPOOL_FSYNC", "interval")) if os.environ.get("KINESIS_SPOOL_DIR") else None
+    deduplicator = DuplicateRecordFilter(max_entries=int(os.environ.get("DEDUP_MAX_ENTRIES", "200000")),
+                                         bloom_capacity=int(os.environ.get("DEDUP_BLOOM_CAPACITY", "0")),
+                                         persistence_path=os.environ.get("DEDUP_STATE_PATH")) if os.environ.get("DEDUP_ENABLED") == "true" else None
+    codec = create_codec(os.environ.get("KINESIS_CODEC", "json"))
+    return KinesisProducer(config["kinesis_config"]["region_name"],config["kinesis_config"]["stream_name"],kinesis_client,partitioner,aggregator,
+                           max_in_flight=int(os.environ.get("KINESIS_MAX_IN_FLIGHT", "1")),
+                           retry_policy=retry_policy,rate_limiter=rate_limiter,spool=spool,deduplicator=deduplicator,
+                           codec=codec,compression=os.environ.get("KINESIS_COMPRESSION") or None,
+                           replay_limit=int(os.environ.get("KINESIS_SPOOL_REPLAY_LIMIT", "500")))
+
+def build_di_framework_client(config):
+    """Returns the DI framework client, wrapped in a DIJobWriter unless DI_ASYNC_WRITER is false"""
+    di_framework_client = di_framework.DIFramework(config["di_framework_config"])
+    if os.environ.get("DI_ASYNC_WRITER", "true") == "true":
+        di_framework_client = di_framework.DIJobWriter(di_framework_client)
+    return di_framework_client
+
+def build_topology_enricher(transis_consumer):
+    """Returns a TopologyEnricher kept up to date from the topology index at TOPOLOGY_INDEX_PATH, None if it is not set
+
+    Note:
+        If the topology can not be loaded the enricher starts with an empty lookup and the background refresh keeps trying.
+    """
+    if not os.environ.get("TOPOLOGY_INDEX_PATH"):
+        return None
+    topology_index = TopologyIndex(os.environ["TOPOLOGY_INDEX_PATH"], float(os.environ.get("TOPOLOGY_FULL_REFRESH_SECONDS", str(24*60*60))))
+    enricher = TopologyEnricher()
+    try:
+        enricher.refresh(topology_index, transis_consumer)
+    except Exception as e:
+        logging.error(f"Could not load the topology, records will not be enriched until the next refresh succeeds: {e}")
+    enricher.start_refreshing(topology_index, transis_consumer, float(os.environ.get("TOPOLOGY_REFRESH_SECONDS", "3600")))
+    return enricher
+
+def run_connector(transis_consumer, kinesis_producer, di_framework_client):
+    """Replays the spool and runs the connector in the CONNECTOR_RUN_MODE until the transis stream ends, sending the records
+    straight from a DetectorCountBatch if COMPACT_RECORDS is true"""
+    if kinesis_producer.spool and kinesis_producer.spool.pending_records():
+        kinesis_producer.replay_spool(di_framework_client)
+    enricher = build_topology_enricher(transis_consumer)
+    try:
+        compact_records = os.environ.get("COMPACT_RECORDS") == "true"
+        transis_kinesis_connector = TransisKinesisConnector(transis_consumer, kinesis_producer, di_framework_client,
+                                                            compact_records=compact_records, enricher=enricher)
+        run_mode = os.environ.get("CONNECTOR_RUN_MODE", "blocking")
+        if run_mode == "streaming":
+            transis_kinesis_connector.run_streaming()
+        elif run_mode == "pipelined":
+            transis_kinesis_connector.run_pipelined(overflow_policy=os.environ.get("PIPELINE_OVERFLOW_POLICY", "block"))
+        elif run_mode == "async":
+            async_connector = AsyncTransisKinesisConnector(transis_consumer, kinesis_producer, di_framework_client, compact_records=compact_records,
+                                                           max_concurrent_puts=int(os.environ.get("KINESIS_MAX_IN_FLIGHT", "4")),
+                                                           enricher=enricher)
+            add_transis_pollers(async_connector)
+            asyncio.run(async_connector.run_forever())
+        else:
+            transis_kinesis_connector.run()
+    finally:
+        if enricher:
+            enricher.stop_refreshing()
+
+def add_transis_pollers(async_connector):
+    """Adds a poller to the async connector for each endpoint:seconds in TRANSIS_POLLERS e.g. getAllVMS:300,getAllOpenTIRF:60"""
+    for poller in filter(None, os.environ.get("TRANSIS_POLLERS", "").split(",")):
+        endpoint, interval = poller.strip().split(":")
+        async_connector.add_poller(endpoint, float(interval), functools.partial(log_transis_poll, endpoint))
+
+def log_transis_poll(endpoint, transis_responses):
+    """Logs the result of a poll of a transis REST endpoint"""
+    errors = len([transis_response for transis_response in transis_responses if transis_response.is_error()])
+    logging.info(f"Polled {endpoint}: {len(transis_responses)} responses, {errors} errors")
+
+def start_metrics():
+    """Serves the metrics on METRICS_PORT if it is set and logs a summary of them every METRICS_LOG_INTERVAL seconds unless it is 0"""
+    if os.environ.get("METRICS_PORT"):
+        metrics.start_http_server(int(os.environ["METRICS_PORT"]))
+    log_interval = float(os.environ.get("METRICS_LOG_INTERVAL", "60"))
+    if log_interval > 0:
+        metrics.start_log_summaries(log_interval)
+
 def main():
     try:
+        start_metrics()
         config = utils.get_config() # create a ./local_config.json file if you want to run this locally or this will fail
         transis_consumer = TransisConsumer(config["transis_config_prod"])
-        
-        kinesis_client = boto3.client('kinesis',config["kinesis_config"]["region_name"])
-        kinesis_producer = KinesisProducer(config["kinesis_config"]["region_name"],config["kinesis_config"]["stream_name"],kinesis_client)
-        di_framework_client = di_framework.DIFramework(config["di_framework_config"])
-        transis_kinesis_connector = TransisKinesisConnector(transis_consumer, kinesis_producer, di_framework_client)
-        transis_kinesis_connector.run()
+        kinesis_producer = build_kinesis_producer(config)
+        di_framework_client = build_di_framework_client(config)
+        run_connector(transis_consumer, kinesis_producer, di_framework_client)
     except Exception as e:
         logging.critical(f"shutting down the service as a fatal error has occured: {e}")
+        exit()
+    finally:
+        try:
+            kinesis_producer.close()
+        except UnboundLocalError:
+            pass
         try:
             di_framework_client.close_db_connection()
         except UnboundLocalError:
             pass
-        exit()
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,259 @@
+r"""
+metrics.py holds the counters and histograms that instrument each stage of the connector, from the bytes received from transis to
+the records acknowledged by kinesis.
+
+The metrics are served in the Prometheus text format by start_http_server() and written to the log as a json summary every
+interval by start_log_summaries(). Recording a value is a lock and an addition, or a bisect of the bucket bounds for a histogram,
+so the metrics are cheap enough to always be on.
+"""
+import bisect
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+log = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+LAG_BUCKETS = (1, 5, 10, 30, 60, 120, 180, 240, 300, 450, 600, 900, 1800, 3600)
+
+def format_labels(labelnames, labelvalues, extra=""):
+    labels = [f'{name}="{value}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+class Metric:
+    """A metric with a child metric for every combination of label values.
+
+    Attributes:
+        name       (str)  : the Prometheus name of the metric
+        help       (str)  : what the metric measures
+        labelnames (tuple): names of the labels, empty for a metric without labels
+    """
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._children = {}
+
+    def create_child(self):
+        raise NotImplementedError
+
+    def labels(self, *labelvalues):
+        """Returns the child metric for the label values, creating it the first time"""
+        child = self._children.get(labelvalues)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(labelvalues, self.create_child())
+        return child
+
+    def children(self):
+        """Returns (label values, metric) of the metric, or of each child if it has labels"""
+        if self.labelnames:
+            return sorted(self._children.items())
+        return [((), self)]
+
+
+class Counter(Metric):
+    """A total that only goes up"""
+    kind = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self.value = 0
+
+    def create_child(self):
+        return Counter(self.name, self.help)
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def expose(self):
+        return [f"{self.name}{format_labels(self.labelnames, labelvalues)} {counter.value}" for labelvalues, counter in self.children()]
+
+    def summarise(self):
+        if self.labelnames:
+            return {",".join(labelvalues): counter.value for labelvalues, counter in self.children()}
+        return self.value
+
+
+class Histogram(Metric):
+    """Counts observations in cumulative buckets and keeps their sum.
+
+    Attributes:
+        buckets (tuple): the upper bound of each bucket, an infinite bucket is added after the last one
+    """
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+        self.__bounds = self.buckets + (float("inf"),)
+        self.__counts = [0] * len(self.__bounds)
+        self.__sum = 0.0
+
+    def create_child(self):
+        return Histogram(self.name, self.help, buckets=self.buckets)
+
+    def observe(self, value, count=1):
+        """Records count observations of a value"""
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.__counts[index] += count
+            self.__sum += value * count
+
+    def time(self):
+        """Returns a context manager that observes the seconds taken by its block"""
+        return Timer(self)
+
+    def snapshot(self):
+        """Returns the count of each bucket (not cumulative) and the sum of the observations"""
+        with self._lock:
+            return list(self.__counts), self.__sum
+
+    def quantile(self, quantile):
+        """Returns the upper bound of the bucket the quantile falls in, None without observations"""
+        counts, _ = self.snapshot()
+        rank = quantile * sum(counts)
+        cumulative = 0
+        for bound, count in zip(self.__bounds, counts):
+            cumulative += count
+            if count and cumulative >= rank:
+                return bound
+        return None
+
+    def expose(self):
+        lines = []
+        for labelvalues, histogram in self.children():
+            counts, total = histogram.snapshot()
+            cumulative = 0
+            for bound, count in zip(self.__bounds, counts):
+                cumulative += count
+                bucket_label = 'le="+Inf"' if bound == float("inf") else f'le="{float(bound)}"'
+                lines.append(f"{self.name}_bucket{format_labels(self.labelnames, labelvalues, bucket_label)} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, labelvalues)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, labelvalues)} {cumulative}")
+        return lines
+
+    def summarise(self):
+        summaries = {}
+        for labelvalues, histogram in self.children():
+            counts, total = histogram.snapshot()
+            count = sum(counts)
+            summaries[",".join(labelvalues)] = {"count": count, "mean": total / count if count else None,
+                                                "p50": histogram.quantile(0.5), "p99": histogram.quantile(0.99)}
+        return summaries if self.labelnames else summaries[""]
+
+
+class Timer:
+    """Observes the seconds taken by a with block in a Histogram"""
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Registry:
+    """The set of metrics that are exposed and summarised together"""
+    def __init__(self):
+        self.metrics = []
+        self.__lock = threading.Lock()
+
+    def register(self, metric):
+        with self.__lock:
+            self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def expose(self):
+        """Returns every metric in the Prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.expose())
+        return "\n".join(lines) + "\n"
+
+    def summarise(self):
+        """Returns a Dict of every metric's totals, with the count, mean and approximate percentiles of each histogram"""
+        return {metric.name: metric.summarise() for metric in self.metrics}
+
+
+REGISTRY = Registry()
+
+TRANSIS_BYTES_RECEIVED = REGISTRY.counter("transis_bytes_received_total", "Bytes received from transis")
+TRANSIS_DOCUMENTS_FRAMED = REGISTRY.counter("transis_documents_framed_total", "Complete xml documents split from the transis byte stream")
+TRANSIS_PARSE_SECONDS = REGISTRY.histogram("transis_parse_seconds", "Seconds to parse a detector count document")
+TRANSFORM_SECONDS = REGISTRY.histogram("transform_seconds", "Seconds to build the records of a detector count document")
+KINESIS_ENCODE_SECONDS = REGISTRY.histogram("kinesis_encode_seconds", "Seconds to encode the kinesis records of a document")
+KINESIS_PUT_RECORDS_SECONDS = REGISTRY.histogram("kinesis_put_records_seconds", "Seconds each put_records() call takes")
+KINESIS_RECORDS = REGISTRY.counter("kinesis_records_total", "Kinesis records by the result of their put_records() attempt", ("result",))
+DI_CALL_SECONDS = REGISTRY.histogram("di_call_seconds", "Seconds each DI framework stored proc call takes", ("statement",))
+FRESHNESS_LAG_SECONDS = REGISTRY.histogram("freshness_lag_seconds", "Seconds from collectionendtimestamp_plus_3_mins to the records being in kinesis",
+                                           buckets=LAG_BUCKETS)
+
+def observe_freshness(epocs):
+    """Observes the freshness lag of records that have just been added to kinesis
+
+    Arguments:
+        epocs {dict} -- the number of records for each collectionendtimestamp_plus_3_mins
+    """
+    now = time.time()
+    for epoc, count in epocs.items():
+        if count:
+            FRESHNESS_LAG_SECONDS.observe(now - epoc, count)
+
+def start_http_server(port, address="", registry=REGISTRY):
+    """Serves the metrics in the Prometheus text format at /metrics from a daemon thread
+
+    Returns:
+        {ThreadingHTTPServer} -- the server, call shutdown() on it to stop serving
+    """
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.expose().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            log.debug(format % args)
+
+    server = ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    log.info(f"Serving metrics at http://{address or '0.0.0.0'}:{server.server_address[1]}/metrics")
+    return server
+
+def start_log_summaries(interval=60, registry=REGISTRY):
+    """Logs a json summary of the metrics every interval seconds from a daemon thread
+
+    Returns:
+        {threading.Event} -- set it to stop logging
+    """
+    stopped = threading.Event()
+    def log_summaries():
+        while not stopped.wait(interval):
+            log.info(json.dumps({"metrics": registry.summarise()}))
+    threading.Thread(target=log_summaries, name="metrics-log", daemon=True).start()
+    return stopped
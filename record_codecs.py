@@ -0,0 +1,218 @@
+r"""
+record_codecs.py encodes detector count records into the Data of kinesis records.
+
+The JSON codec is the original format and has no marker, its Data starts with "{". Every other codec starts its Data with the
+marker byte 0xdc and a codec id so a consumer can pick the decoder from the first two bytes. Records whose Data has been
+compressed start with the gzip magic number, and KPL aggregated records with the KPL magic number, see decode_kinesis_data().
+Records are compressed before they are aggregated, so a KCL consumer can still de-aggregate them and then decompress each one.
+
+    codec          id  Data
+    json           -   {"collectionIntervalSecs": 300, "region": "ROZ", "siteId": "1", ..., "detectorCounts": {"1": "5"}}
+    compact-json   1   0xdc 0x01 {"v":1,"i":300,"r":"ROZ","s":"1","t":1570081380,"c":{"1":5}}
+    struct         2   0xdc 0x02 header (interval, timestamp, region size, site id size, detectors, layout) + region + site id + (detector id, count)...
+    msgpack        3   0xdc 0x03 the compact-json map packed with msgpack
+
+The compact codecs send the counts as ints. Fields other than the detector count fields, such as the detector topology added by
+topology_enrichment.TopologyEnricher, are kept by the json, compact-json and msgpack codecs and left out by the struct codec.
+"""
+import gzip
+import json
+import struct
+import kinesis_aggregation
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+CODEC_MARKER = 0xdc
+GZIP_MAGIC = b"\x1f\x8b"
+COMPACT_SCHEMA_VERSION = 1
+COMPACT_FIELDS = {
+    "collectionIntervalSecs": "i",
+    "region": "r",
+    "siteId": "s",
+    "collectionendtimestamp_plus_3_mins": "t",
+    "detectorCounts": "c"
+}
+STRUCT_HEADER = struct.Struct(">HQBBHB")
+# The layout byte of the struct header picks how each (detector id, count) is packed, narrow is used when every pair fits in it
+STRUCT_DETECTOR_COUNT_LAYOUTS = (struct.Struct(">HI"), struct.Struct(">qq"))
+STRUCT_NARROW_LIMITS = (0xffff, 0xffffffff)
+
+class JSONCodec:
+    """Encodes records as the json of DetectorCountMessage.to_dict(), the format the stream has always used"""
+    name = "json"
+    codec_id = None
+    content_type = "application/json"
+
+    def encode(self, record):
+        """Returns the Data of a kinesis record for a detector count record Dict"""
+        return json.dumps(record).encode('utf-8')
+
+    def encode_batch_record(self, batch, index):
+        """Returns the Data of a kinesis record for the site at index of a DetectorCountBatch"""
+        return batch.encode_json_record(index)
+
+    def decode(self, data):
+        """Returns the record Dict encoded in the Data of a kinesis record"""
+        return json.loads(data)
+
+
+class CompactJSONCodec(JSONCodec):
+    """Encodes records as json with single letter keys, a schema version and int counts"""
+    name = "compact-json"
+    codec_id = 1
+    content_type = "application/vnd.transis.detector-count.compact+json"
+
+    def __init__(self):
+        self.marker = bytes([CODEC_MARKER, self.codec_id])
+
+    @staticmethod
+    def to_compact_dict(record):
+        """Returns the record with the detector count fields renamed to their short keys and the counts as ints"""
+        compact_record = {"v": COMPACT_SCHEMA_VERSION}
+        for field, value in record.items():
+            if field == "detectorCounts":
+                value = {detector_id: int(count) for detector_id, count in value.items()}
+            compact_record[COMPACT_FIELDS.get(field, field)] = value
+        return compact_record
+
+    @staticmethod
+    def from_compact_dict(compact_record):
+        """Returns the record Dict with the full field names of a Dict returned by to_compact_dict()"""
+        if compact_record.pop("v", None) != COMPACT_SCHEMA_VERSION:
+            raise ValueError("Unsupported compact detector count schema version")
+        field_names = {short_key: field for field, short_key in COMPACT_FIELDS.items()}
+        return {field_names.get(key, key): value for key, value in compact_record.items()}
+
+    def encode(self, record):
+        return self.marker + json.dumps(self.to_compact_dict(record), separators=(",", ":")).encode('utf-8')
+
+    def encode_batch_record(self, batch, index):
+        record = batch.record_header(index)
+        record["detectorCounts"] = {str(detector_id): count for detector_id, count in batch.detector_counts(index)}
+        return self.encode(record)
+
+    def decode(self, data):
+        return self.from_compact_dict(json.loads(data[len(self.marker):]))
+
+
+class StructCodec(CompactJSONCodec):
+    """Packs the detector count fields of a record into a fixed binary layout, detector ids and counts take 16 and 32 bits when
+    they all fit and are packed as signed 64 bit ints otherwise"""
+    name = "struct"
+    codec_id = 2
+    content_type = "application/vnd.transis.detector-count.struct"
+
+    def __pack(self, interval, epoc, region, site_id, detector_counts):
+        region, site_id = region.encode('utf-8'), site_id.encode('utf-8')
+        detector_counts = list(detector_counts)
+        max_detector_id, max_count = STRUCT_NARROW_LIMITS
+        layout = 0 if all(0 <= detector_id <= max_detector_id and 0 <= count <= max_count for detector_id, count in detector_counts) else 1
+        detector_count_struct = STRUCT_DETECTOR_COUNT_LAYOUTS[layout]
+        packed = [self.marker, STRUCT_HEADER.pack(interval, epoc, len(region), len(site_id), len(detector_counts), layout), region, site_id]
+        packed.extend(detector_count_struct.pack(detector_id, count) for detector_id, count in detector_counts)
+        return b"".join(packed)
+
+    def encode(self, record):
+        return self.__pack(record["collectionIntervalSecs"], record["collectionendtimestamp_plus_3_mins"], record["region"], record["siteId"],
+                           ((int(detector_id), int(count)) for detector_id, count in record["detectorCounts"].items()))
+
+    def encode_batch_record(self, batch, index):
+        return self.__pack(300, batch.epoc(index), batch.region(index), batch.site_ids[index], batch.detector_counts(index))
+
+    def decode(self, data):
+        offset = len(self.marker)
+        interval, epoc, region_size, site_id_size, num_detectors, layout = STRUCT_HEADER.unpack_from(data, offset)
+        detector_count_struct = STRUCT_DETECTOR_COUNT_LAYOUTS[layout]
+        offset += STRUCT_HEADER.size
+        region = bytes(data[offset:offset + region_size]).decode('utf-8')
+        site_id = bytes(data[offset + region_size:offset + region_size + site_id_size]).decode('utf-8')
+        offset += region_size + site_id_size
+        detector_counts = {}
+        for _ in range(num_detectors):
+            detector_id, count = detector_count_struct.unpack_from(data, offset)
+            detector_counts[str(detector_id)] = count
+            offset += detector_count_struct.size
+        return {"collectionIntervalSecs": interval, "region": region, "siteId": site_id,
+                "collectionendtimestamp_plus_3_mins": epoc, "detectorCounts": detector_counts}
+
+
+class MsgPackCodec(CompactJSONCodec):
+    """Packs the compact-json map with MessagePack, needs the msgpack package
+
+    Raises:
+        Exception -- if msgpack is not installed
+    """
+    name = "msgpack"
+    codec_id = 3
+    content_type = "application/vnd.transis.detector-count+msgpack"
+
+    def __init__(self):
+        if msgpack is None:
+            raise Exception("The msgpack codec needs the msgpack package, install it with pip install msgpack")
+        super().__init__()
+
+    def encode(self, record):
+        return self.marker + msgpack.packb(self.to_compact_dict(record), use_bin_type=True)
+
+    def decode(self, data):
+        return self.from_compact_dict(msgpack.unpackb(data[len(self.marker):], raw=False))
+
+
+CODECS = {codec.name: codec for codec in (JSONCodec, CompactJSONCodec, StructCodec, MsgPackCodec)}
+
+def create_codec(name):
+    """Returns a codec by its name, one of json, compact-json, struct or msgpack"""
+    if name not in CODECS:
+        raise ValueError(f"Unknown record codec {name}, expected one of {', '.join(CODECS)}")
+    return CODECS[name]()
+
+def compress_kinesis_records(kinesis_records, compresslevel=6):
+    """Returns the kinesis records with their Data gzip compressed, the records are compressed before they are aggregated
+
+    Note:
+        A record whose Data does not get smaller, such as a small record where the gzip framing outweighs the savings, keeps its
+        Data as it was.
+    """
+    compressed_records = []
+    for kinesis_record in kinesis_records:
+        compressed_data = gzip.compress(kinesis_record["Data"], compresslevel=compresslevel, mtime=0)
+        if len(compressed_data) < len(kinesis_record["Data"]):
+            kinesis_record = dict(kinesis_record)
+            kinesis_record["Data"] = compressed_data
+        compressed_records.append(kinesis_record)
+    return compressed_records
+
+def decode_record(data):
+    """Returns the record Dict encoded in the Data of a user record, choosing the codec from its first bytes
+
+    Raises:
+        ValueError -- if the Data was not encoded by one of the codecs
+    """
+    if data[:1] == b"{":
+        return JSONCodec().decode(data)
+    if len(data) >= 2 and data[0] == CODEC_MARKER:
+        for codec in CODECS.values():
+            if codec.codec_id == data[1]:
+                return codec().decode(data)
+    raise ValueError("The kinesis record Data was not encoded by a known record codec")
+
+def decode_kinesis_data(data):
+    """Returns every record Dict in the Data of a kinesis record, de-aggregating it and decompressing each user record when needed
+
+    Note:
+        Aggregated records that were compressed as a whole, as they were before records were compressed before aggregating, are
+        still decompressed first.
+    """
+    if data[:len(GZIP_MAGIC)] == GZIP_MAGIC:
+        data = gzip.decompress(data)
+    user_records = kinesis_aggregation.deaggregate_record({"PartitionKey": "", "Data": data})
+    return [decode_record(decompress_data(user_record["Data"])) for user_record in user_records]
+
+def decompress_data(data):
+    """Returns the Data of a record decompressed if it was gzip compressed"""
+    if data[:len(GZIP_MAGIC)] == GZIP_MAGIC:
+        return gzip.decompress(data)
+    return data
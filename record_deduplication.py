@@ -0,0 +1,188 @@
+r"""
+record_deduplication.py drops detector count records for a site and interval that have already been sent to kinesis.
+
+Records are identified by their (siteId, collectionendtimestamp_plus_3_mins). The most recent keys are held exactly in an LRU,
+keys that are evicted from the LRU can be kept in a Bloom filter so much older intervals are still recognised in a fixed amount
+of memory, at the cost of a small chance of dropping a record that was not a duplicate.
+"""
+import base64
+import hashlib
+import json
+import logging
+import math
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+class BloomFilter:
+    """A fixed size Bloom filter of byte string keys.
+
+    Attributes:
+        capacity            (int)  : the number of keys the filter is sized for
+        false_positive_rate (float): the chance that a key that was never added is reported as added once capacity keys are in the filter
+        num_bits            (int)  : size of the bit array
+        num_hashes          (int)  : bits set for each key
+    """
+    def __init__(self, capacity, false_positive_rate=0.001, bits=None):
+        self.capacity = capacity
+        self.false_positive_rate = false_positive_rate
+        self.num_bits = max(8, int(math.ceil(-capacity * math.log(false_positive_rate) / math.log(2) ** 2)))
+        self.num_hashes = max(1, int(round(self.num_bits / capacity * math.log(2))))
+        self.bits = bytearray(bits) if bits is not None else bytearray((self.num_bits + 7) // 8)
+
+    def __positions(self, key):
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        first_hash, second_hash = int.from_bytes(digest[:8], "big"), int.from_bytes(digest[8:], "big") | 1
+        return [(first_hash + i * second_hash) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, key):
+        """Adds a key to the filter"""
+        for position in self.__positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.__positions(key))
+
+
+class DuplicateRecordFilter:
+    """Remembers the site intervals that have been seen and reports repeats.
+
+    Note:
+        is_duplicate() only checks a key, the key is remembered by remember() once its record has been added to kinesis. A record
+        that the producer dropped is therefore still sent when transis delivers its interval again, the producer drops repeats within
+        one push itself. With a persistence_path the keys are saved every persist_interval seconds from a background thread and by close().
+
+    Attributes:
+        max_entries      (int)        : the most keys held in the LRU
+        bloom_filter     (BloomFilter): holds the keys evicted from the LRU, None to forget them
+        persistence_path (str)        : file the keys are saved to and loaded from, None to keep them in memory only
+        persist_interval (float)      : seconds between the saves made by the background thread
+        hits             (int)        : records that were duplicates
+        misses           (int)        : records that were not duplicates
+    """
+    def __init__(self, max_entries=200000, bloom_capacity=0, bloom_false_positive_rate=0.001, persistence_path=None, persist_interval=60):
+        self.max_entries = max_entries
+        self.bloom_filter = BloomFilter(bloom_capacity, bloom_false_positive_rate) if bloom_capacity else None
+        self.persistence_path = persistence_path
+        self.persist_interval = persist_interval
+        self.hits = 0
+        self.misses = 0
+        self.__keys = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__save_lock = threading.Lock()
+        self.__stop_saving = threading.Event()
+        self.__save_thread = None
+        if persistence_path and os.path.exists(persistence_path):
+            self.load()
+        if persistence_path:
+            self.__save_thread = threading.Thread(target=self.__save_periodically, name="dedup-save", daemon=True)
+            self.__save_thread.start()
+
+    @staticmethod
+    def get_key(record):
+        """Returns the (siteId, collectionendtimestamp_plus_3_mins) of a detector count record Dict"""
+        return str(record["siteId"]), int(record["collectionendtimestamp_plus_3_mins"])
+
+    @staticmethod
+    def __bloom_key(key):
+        return f"{key[0]}\x00{key[1]}".encode('utf-8')
+
+    def is_duplicate(self, record):
+        """Returns True if the site interval of the record has been remembered, the key is not remembered by this call"""
+        key = self.get_key(record)
+        with self.__lock:
+            if key in self.__keys:
+                self.__keys.move_to_end(key)
+                duplicate = True
+            else:
+                duplicate = self.bloom_filter is not None and self.__bloom_key(key) in self.bloom_filter
+            if duplicate:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return duplicate
+
+    def remember(self, records):
+        """Remembers the site intervals of records that have been added to kinesis"""
+        self.remember_keys(self.get_key(record) for record in records)
+
+    def remember_keys(self, keys):
+        """Remembers (siteId, collectionendtimestamp_plus_3_mins) keys of records that have been added to kinesis, see get_key()"""
+        with self.__lock:
+            for key in keys:
+                if key in self.__keys:
+                    self.__keys.move_to_end(key)
+                    continue
+                self.__keys[key] = None
+                if len(self.__keys) > self.max_entries:
+                    evicted_key, _ = self.__keys.popitem(last=False)
+                    if self.bloom_filter is not None:
+                        self.bloom_filter.add(self.__bloom_key(evicted_key))
+
+    def filter_records(self, records):
+        """Returns the records that are not duplicates, of each other or of remembered records, and remembers them"""
+        unique_records = []
+        for record in records:
+            if not self.is_duplicate(record):
+                self.remember([record])
+                unique_records.append(record)
+        return unique_records
+
+    def get_counters(self):
+        """Returns the hit and miss counts and the number of keys held in the LRU"""
+        return {"duplicate_hits": self.hits, "duplicate_misses": self.misses, "duplicate_keys": len(self.__keys)}
+
+    def __save_periodically(self):
+        while not self.__stop_saving.wait(self.persist_interval):
+            try:
+                self.save()
+            except Exception as e:
+                log.error(f"Could not save the duplicate record state to {self.persistence_path}: {e}")
+
+    def save(self):
+        """Writes the keys and Bloom filter to persistence_path, replacing the previous file in one step"""
+        with self.__save_lock:
+            with self.__lock:
+                state = {"keys": list(self.__keys)}
+                if self.bloom_filter is not None:
+                    state["bloom_filter"] = {
+                        "capacity": self.bloom_filter.capacity,
+                        "false_positive_rate": self.bloom_filter.false_positive_rate,
+                        "bits": base64.b64encode(bytes(self.bloom_filter.bits)).decode('ascii')
+                    }
+            file_descriptor, temporary_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.persistence_path)), suffix=".tmp")
+            try:
+                with os.fdopen(file_descriptor, "w") as file_handle:
+                    json.dump(state, file_handle)
+                os.replace(temporary_path, self.persistence_path)
+            except BaseException:
+                os.remove(temporary_path)
+                raise
+
+    def load(self):
+        """Reads the keys and Bloom filter saved in persistence_path"""
+        try:
+            with open(self.persistence_path, "r") as file_handle:
+                state = json.load(file_handle)
+        except ValueError as e:
+            log.error(f"Ignoring the unreadable duplicate record state in {self.persistence_path}: {e}")
+            return
+        with self.__lock:
+            self.__keys = OrderedDict(((str(site_id), int(epoc)), None) for site_id, epoc in state["keys"][-self.max_entries:])
+            if self.bloom_filter is not None and "bloom_filter" in state:
+                saved = state["bloom_filter"]
+                if (saved["capacity"], saved["false_positive_rate"]) == (self.bloom_filter.capacity, self.bloom_filter.false_positive_rate):
+                    self.bloom_filter = BloomFilter(saved["capacity"], saved["false_positive_rate"], base64.b64decode(saved["bits"]))
+        log.info(f"Loaded {len(self.__keys)} site intervals that have already been sent from {self.persistence_path}")
+
+    def close(self):
+        """Stops the background saves and saves the keys if there is a persistence_path"""
+        if self.__save_thread:
+            self.__stop_saving.set()
+            self.__save_thread.join()
+            self.__save_thread = None
+        if self.persistence_path:
+            self.save()
@@ -2,13 +2,37 @@ r"""these are all the tests of the transis to kinesis connector"""
 
 import unittest
 from unittest.mock import Mock, patch
-from transis_consumer import TransisConsumer
+from transis_consumer import TransisConsumer, TransisStreamFramer
 from kinesis_producer import KinesisProducer
 from transis_kinesis_connector import TransisKinesisConnector
+from async_transis_kinesis_connector import AsyncTransisKinesisConnector, AsyncTransisHTTPClient
 import di_framework
 import transis_response_models
+import kinesis_producer
+import kinesis_aggregation
+import kinesis_retry
+import kinesis_spool
+import record_deduplication
+import record_codecs
+import backfill
+import benchmarks
+import load_test
+import main
+import metrics
+import urllib.request
+import topology_index
+import topology_enrichment
+import botocore.exceptions
+import utils
 import requests
+import asyncio
+import base64
+import io
 import json
+import os
+import tempfile
+import threading
+import time
 import logging
 
 logger = logging.getLogger()
@@ -54,6 +78,102 @@ class TransisConsumerTests(unittest.TestCase):
             list(transis_consumer.get_detector_counts())
     
 
+class TransisConsumerRestTests(unittest.TestCase):
+    def setUp(self):
+        with open("local_config.json","r") as file_handle:
+            self.transis_consumer = TransisConsumer(json.loads(file_handle.read())["transis_config_prod"], stream_chunk_size=64)
+        self.documents = [generate_detector_count_document([str(i)]) for i in range(3)]
+        self.response = Mock()
+        body = b"\x00".join(self.documents)
+        self.chunks_read = []
+        def iter_content(chunk_size):
+            for i in range(0, len(body), chunk_size):
+                self.chunks_read.append(i)
+                yield body[i:i + chunk_size]
+        self.response.iter_content = iter_content
+
+    def test_iter_data_from_yields_each_document_including_the_last_without_a_null_byte(self):
+        with patch.object(TransisConsumer, '_TransisConsumer__get_http_response', return_value=self.response) as get_http_response:
+            responses = list(self.transis_consumer.iter_data_from("DetectorCount", "2019-10-03T15:43:00.000+10:00"))
+        self.assertEqual([r.byte_string for r in responses], self.documents)
+        get_http_response.assert_called_once_with("getFromDate", stream=True, startDate="2019-10-03T15:43:00.000+10:00", types="DetectorCount")
+        self.response.close.assert_called_once()
+
+    def test_get_data_from_stops_reading_after_the_first_document(self):
+        with patch.object(TransisConsumer, '_TransisConsumer__get_http_response', return_value=self.response):
+            transis_response = self.transis_consumer.get_data_from("DetectorCount", "2019-10-03T15:43:00.000+10:00")
+        self.assertEqual(transis_response.byte_string, self.documents[0])
+        self.assertLess(len(self.chunks_read) * 64, sum(len(d) for d in self.documents))
+        self.response.close.assert_called_once()
+
+    def test_get_raw_data_within_dates_streams_the_body_and_limits_its_size(self):
+        with patch.object(TransisConsumer, '_TransisConsumer__get_http_response', return_value=self.response) as get_http_response:
+            byte_string = self.transis_consumer.get_raw_data_within_dates("DetectorCount", "2019-10-03T15:43:00.000+10:00", "2019-10-03T16:43:00.000+10:00")
+            self.assertEqual(byte_string, b"\x00".join(self.documents))
+            get_http_response.assert_called_once_with("getWithinDates", stream=True, startDate="2019-10-03T15:43:00.000+10:00",
+                                                      endDate="2019-10-03T16:43:00.000+10:00", types="DetectorCount")
+            self.transis_consumer.max_document_size = 100
+            with self.assertRaises(Exception):
+                self.transis_consumer.get_raw_data_within_dates("DetectorCount", "2019-10-03T15:43:00.000+10:00", "2019-10-03T16:43:00.000+10:00")
+        self.assertEqual(self.response.close.call_count, 2)
+
+
+class TransisStreamFramerTests(unittest.TestCase):
+    def setUp(self):
+        self.documents = [b'<a>1</a>', b'<b>22</b>', b'<c>333</c>']
+        self.stream = b'\x00'.join(self.documents) + b'\x00'
+
+    def test_frame_splits_documents_regardless_of_chunk_size(self):
+        for chunk_size in [1, 2, 7, len(self.stream)]:
+            framer = TransisStreamFramer()
+            chunks = [self.stream[i:i+chunk_size] for i in range(0, len(self.stream), chunk_size)]
+            self.assertEqual(list(framer.frame(chunks)), self.documents)
+            self.assertEqual(framer.buffered_bytes(), 0)
+
+    def test_frame_skips_empty_documents_and_keeps_incomplete_document_buffered(self):
+        framer = TransisStreamFramer()
+        self.assertEqual(framer.feed(b'\x00\x00<a>1</a>\x00<b>'), [b'<a>1</a>'])
+        self.assertEqual(framer.buffered_bytes(), 3)
+        self.assertEqual(framer.feed(b'2</b>\x00'), [b'<b>2</b>'])
+
+    def test_frame_raises_exception_when_document_is_too_large(self):
+        framer = TransisStreamFramer(max_document_size=8)
+        with self.assertRaises(Exception):
+            framer.feed(b'<a>123456789</a>')
+        self.assertEqual(framer.buffered_bytes(), 0)
+
+    def test_get_detector_counts_reads_stream_in_large_chunks(self):
+        with open("local_config.json","r") as file_handle: 
+            transis_consumer = TransisConsumer(json.loads(file_handle.read())["transis_config_prod"], stream_chunk_size=4096)
+        document = generate_detector_count_document(["2087", "2088"])
+        stream = Mock()
+        stream.iter_content.return_value = iter([document + b'\x00' + document[:100], document[100:] + b'\x00'])
+        with patch.object(TransisConsumer, '_TransisConsumer__get_http_response', return_value=stream):
+            responses = list(transis_consumer.get_detector_counts())
+        stream.iter_content.assert_called_once_with(chunk_size=4096)
+        self.assertEqual(len(responses), 2)
+        self.assertEqual(responses[1].detector_count_messages.get_num_sites(), 2)
+
+    def test_stopped_stream_is_closed_and_not_reconnected(self):
+        with open("local_config.json","r") as file_handle: 
+            transis_consumer = TransisConsumer(json.loads(file_handle.read())["transis_config_prod"])
+        document = generate_detector_count_document(["2087"])
+        def iter_content(chunk_size):
+            yield document + b'\x00'
+            raise requests.exceptions.ConnectionError("connection closed")
+        stream = Mock()
+        stream.iter_content = iter_content
+        with patch.object(TransisConsumer, '_TransisConsumer__get_http_response', return_value=stream) as get_http_response:
+            documents = []
+            for document in transis_consumer.get_detector_count_documents():
+                documents.append(document)
+                transis_consumer.stop()
+            self.assertEqual(list(transis_consumer.stream_detector_count_messages()), [])
+        self.assertEqual(len(documents), 1)
+        get_http_response.assert_called_once()
+        stream.close.assert_called_once()
+
+
 class TransisResponseModelsTests(unittest.TestCase):
     def setUp(self):
         self.simple_transis_response_byte_string = b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?><ns2:TransisResponse error="false" xmlns:ns2="http://model.transis.rta.nsw.gov.au/"><DetectorCountMessages><ns2:DetectorCountMessage Sid="2087" date="2019-10-03T15:43:00+10:00" reg="ROZ"><Detectors><Detector Did="21" count="5"/><Detector Did="20" count="6"/><Detector Did="18" count="12"/><Detector Did="19" count="0"/><Detector Did="1" count="0"/><Detector Did="7" count="0"/><Detector Did="12" count="0"/><Detector Did="6" count="1"/><Detector Did="13" count="0"/><Detector Did="8" count="0"/><Detector Did="11" count="0"/><Detector Did="9" count="0"/><Detector Did="10" count="0"/><Detector Did="14" count="0"/><Detector Did="15" count="0"/><Detector Did="17" count="0"/><Detector Did="16" count="0"/><Detector Did="24" count="0"/><Detector Did="2" count="0"/><Detector Did="3" count="0"/><Detector Did="23" count="0"/><Detector Did="5" count="0"/><Detector Did="22" count="0"/><Detector Did="4" count="0"/></Detectors></ns2:DetectorCountMessage></DetectorCountMessages></ns2:TransisResponse>'
@@ -80,6 +200,22 @@ class TransisResponseModelsTests(unittest.TestCase):
         get_num_sites = transis_response.detector_count_messages.get_num_sites()
         self.assertEqual(get_num_sites,2)
     
+    def test_detector_count_messages_and_site_layouts_are_built_lazily_once(self):
+        transis_response = transis_response_models.TransisResponse(self.multi_site_transis_response_byte_string)
+        with patch.object(transis_response_models, 'DetectorCountMessages', wraps=transis_response_models.DetectorCountMessages) as mocked_messages:
+            self.assertEqual(mocked_messages.call_count, 0)
+            first = transis_response.detector_count_messages
+            second = transis_response.detector_count_messages
+        self.assertIs(first, second)
+        self.assertEqual(mocked_messages.call_count, 1)
+        self.assertIsNone(transis_response.site_layouts)
+
+    def test_byte_string_can_be_dropped_after_parsing(self):
+        transis_response = transis_response_models.TransisResponse(self.simple_transis_response_byte_string, keep_byte_string=False)
+        self.assertIsNone(transis_response.byte_string)
+        self.assertEqual(transis_response.detector_count_messages.get_num_sites(), 1)
+        self.assertIn('Sid="2087"', transis_response.to_string())
+
     def test_detector_count_message_to_dict(self):
         transis_response = transis_response_models.TransisResponse(self.simple_transis_response_byte_string)
         detector_message_dict = transis_response.detector_count_messages.detector_count_message_list[0].to_dict()
@@ -118,6 +254,448 @@ class TransisResponseModelsTests(unittest.TestCase):
         self.assertEqual(detector_message_dict,expected_dict)
 
 
+class SiteLayoutsTests(unittest.TestCase):
+    def setUp(self):
+        self.site_layouts = transis_response_models.TransisResponse(
+            b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?><ns2:TransisResponse error="false" xmlns:ns2="http://model.transis.rta.nsw.gov.au/">'
+            b'<SiteLayouts>'
+            b'<SiteLayout sId="1" name="Main St &quot;North&quot;"><Arms><Arm aId="1" dir="N"/><Arm aId="2" dir="S"/></Arms>'
+            b'<Phases><Phase name="A"><SGNos><SGNo>1</SGNo><SGNo>2</SGNo></SGNos></Phase></Phases></SiteLayout>'
+            b'<SiteLayout sId="2" name="King, St"><Detectors><Detector dId="1" lane="1"/></Detectors></SiteLayout>'
+            b'</SiteLayouts></ns2:TransisResponse>').site_layouts
+
+    def test_write_csv_writes_every_subcomponent_in_one_pass_with_quoting(self):
+        file_handles = {subcomponent: io.StringIO() for subcomponent in ("sites", "arms", "detectors", "streets", "sgs", "phases")}
+        row_counts = self.site_layouts.write_csv(file_handles)
+        self.assertEqual(row_counts, {"sites": 2, "arms": 2, "detectors": 1, "streets": 0, "sgs": 0, "phases": 2})
+        self.assertEqual(file_handles["sites"].getvalue(), 'sId,name\n"1","Main St ""North"""\n"2","King, St"\n')
+        self.assertEqual(file_handles["arms"].getvalue(), 'sId,aId,dir\n"1","1","N"\n"1","2","S"\n')
+        self.assertEqual(file_handles["streets"].getvalue(), '')
+
+    def test_phases_are_exported_for_sites_without_signal_groups(self):
+        self.assertEqual(self.site_layouts.get_csv_string("phases"), 'sId,name,sgno\n"1","A","1"\n"1","A","2"\n')
+
+    def test_unknown_subcomponents_are_rejected(self):
+        with self.assertRaises(ValueError):
+            self.site_layouts.get_csv_string(None)
+        with self.assertRaises(ValueError):
+            self.site_layouts.write_csv({"lanes": io.StringIO()})
+
+
+class TopologyIndexTests(unittest.TestCase):
+    def test_index_is_refreshed_incrementally_and_persisted(self):
+        mocked_transis_consumer = Mock()
+        mocked_transis_consumer.get_current_topology.return_value = generate_topology_response(
+            '<SiteLayout sId="1" name="A"><Detectors><Detector dId="1" lane="1"/><Detector dId="2" lane="2"/></Detectors></SiteLayout>'
+            '<SiteLayout sId="2" name="B"><Arms><Arm aId="1" dir="N"/></Arms></SiteLayout>')
+        mocked_transis_consumer.iter_topology_changes_from.side_effect = [
+            iter([generate_topology_response('<SiteLayout sId="2" name="B"><Arms><Arm aId="1" dir="N"/></Arms></SiteLayout>')]),
+            iter([generate_topology_response('<SiteLayout sId="2" name="B"><Arms><Arm aId="1" dir="N"/></Arms></SiteLayout>'),
+                  generate_topology_response('<SiteLayout sId="2" name="B"><Arms><Arm aId="1" dir="S"/></Arms></SiteLayout>')])
+        ]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "topology.sqlite")
+            index = topology_index.TopologyIndex(path)
+            self.assertEqual(index.refresh(mocked_transis_consumer), 2)
+            self.assertEqual(index.version, 1)
+            self.assertEqual(index.refresh(mocked_transis_consumer), 0)
+            self.assertEqual(index.version, 1)
+            index.close()
+            reopened_index = topology_index.TopologyIndex(path)
+            self.assertEqual(reopened_index.refresh(mocked_transis_consumer), 1)
+            mocked_transis_consumer.get_current_topology.assert_called_once()
+            self.assertEqual(reopened_index.version, 2)
+            self.assertEqual(reopened_index.get_site_ids(), ["1", "2"])
+            self.assertEqual(reopened_index.get_arm("2", "1"), {"aId": "1", "dir": "S"})
+            self.assertEqual(reopened_index.get_detector("1", "2"), {"dId": "2", "lane": "2"})
+            self.assertEqual(reopened_index.get_site_layout("1").root.get("name"), "A")
+            reopened_index.close()
+
+    def test_removed_sites_are_deleted_by_the_periodic_full_load(self):
+        mocked_transis_consumer = Mock()
+        mocked_transis_consumer.get_current_topology.side_effect = [
+            generate_topology_response('<SiteLayout sId="1" name="A"/><SiteLayout sId="2" name="B"/>'),
+            generate_topology_response('<SiteLayout sId="1" name="A"/>')
+        ]
+        mocked_transis_consumer.iter_topology_changes_from.side_effect = lambda last_sync: iter([generate_topology_response('')])
+        index = topology_index.TopologyIndex(":memory:", full_refresh_interval=3600)
+        index.refresh(mocked_transis_consumer)
+        self.assertEqual(index.refresh(mocked_transis_consumer), 0)
+        self.assertEqual(index.get_site_ids(), ["1", "2"])
+        index.full_refresh_interval = 0
+        self.assertEqual(index.refresh(mocked_transis_consumer), 1)
+        self.assertEqual((index.get_site_ids(), index.version), (["1"], 2))
+        self.assertEqual(mocked_transis_consumer.get_current_topology.call_count, 2)
+        index.close()
+
+
+    def test_changes_in_every_document_are_applied_and_a_failed_download_is_not_synced(self):
+        mocked_transis_consumer = Mock()
+        mocked_transis_consumer.get_current_topology.return_value = generate_topology_response('<SiteLayout sId="1" name="A"/>')
+        def failed_download(last_sync):
+            yield generate_topology_response('<SiteLayout sId="2" name="B"/>')
+            raise requests.exceptions.ConnectionError("mock connection error")
+        mocked_transis_consumer.iter_topology_changes_from.side_effect = [
+            failed_download(None),
+            iter([generate_topology_response('<SiteLayout sId="2" name="B"/>'), generate_topology_response('<SiteLayout sId="3" name="C"/>')])
+        ]
+        index = topology_index.TopologyIndex(":memory:")
+        index.refresh(mocked_transis_consumer)
+        last_sync = index.last_sync
+        with self.assertRaises(requests.exceptions.ConnectionError):
+            index.refresh(mocked_transis_consumer)
+        self.assertEqual((index.get_site_ids(), index.last_sync), (["1"], last_sync))
+        self.assertEqual(index.refresh(mocked_transis_consumer), 2)
+        self.assertEqual(mocked_transis_consumer.iter_topology_changes_from.call_args_list[1][0][0], last_sync)
+        self.assertEqual(index.get_site_ids(), ["1", "2", "3"])
+        index.close()
+
+
+class TopologyEnrichmentTests(unittest.TestCase):
+    def setUp(self):
+        self.site_layouts = generate_topology_response(
+            '<SiteLayout sId="2087"><Arms><Arm aId="1" dir="N"/></Arms>'
+            '<Detectors><Detector dId="1" aId="1" lane="1"/><Detector dId="2" lane="2"/></Detectors></SiteLayout>').site_layouts
+
+    def test_records_are_enriched_with_the_detector_and_arm_topology(self):
+        enricher = topology_enrichment.TopologyEnricher(topology_enrichment.DetectorLookup.from_site_layouts(self.site_layouts))
+        transis_response = transis_response_models.TransisResponse(generate_detector_count_document(["2087", "2088"], num_detectors=3))
+        records = enricher.enrich_records([m.to_dict() for m in transis_response.detector_count_messages.detector_count_message_list])
+        self.assertEqual(records[0]["detectorTopology"], {
+            "1": {"dId": "1", "aId": "1", "lane": "1", "arm": {"aId": "1", "dir": "N"}},
+            "2": {"dId": "2", "lane": "2"}
+        })
+        self.assertNotIn("detectorTopology", records[1])
+        self.assertEqual((enricher.enriched_records, enricher.unknown_sites), (1, 1))
+
+    def test_detectors_are_only_joined_on_the_arm_id_attribute(self):
+        lookup = topology_enrichment.DetectorLookup({"1": [{"dId": "1", "sId": "1", "aId": "2"}, {"dId": "2", "sId": "1"}]},
+                                                    {"1": [{"sId": "1", "aId": "1"}, {"sId": "1", "aId": "2"}]})
+        self.assertEqual(lookup.get_site("1")["1"]["arm"], {"sId": "1", "aId": "2"})
+        self.assertNotIn("arm", lookup.get_site("1")["2"])
+
+    def test_detectors_are_keyed_on_their_dId_attribute(self):
+        site_layouts = generate_topology_response(
+            '<SiteLayout sId="1"><Detectors><Detector loopNo="7" dId="2" lane="1"/><Detector loopNo="8" lane="2"/></Detectors></SiteLayout>').site_layouts
+        lookup = topology_enrichment.DetectorLookup.from_site_layouts(site_layouts)
+        self.assertEqual(lookup.get_site("1"), {"2": {"loopNo": "7", "dId": "2", "lane": "1"}})
+
+    def test_main_starts_with_an_empty_lookup_when_the_topology_can_not_be_loaded(self):
+        mocked_transis_consumer = Mock()
+        mocked_transis_consumer.get_current_topology.side_effect = requests.exceptions.ConnectionError("mock connection error")
+        with patch.dict(os.environ, {"TOPOLOGY_INDEX_PATH": ":memory:", "TOPOLOGY_REFRESH_SECONDS": "3600"}):
+            enricher = main.build_topology_enricher(mocked_transis_consumer)
+        enricher.stop_refreshing()
+        self.assertEqual(len(enricher.lookup), 0)
+        self.assertEqual(enricher.enrich({"siteId": "1", "detectorCounts": {"1": "5"}}), {"siteId": "1", "detectorCounts": {"1": "5"}})
+
+    def test_lookup_is_swapped_when_the_topology_index_changes(self):
+        mocked_transis_consumer = Mock()
+        mocked_transis_consumer.get_current_topology.return_value = generate_topology_response('<SiteLayout sId="1"/>')
+        mocked_transis_consumer.iter_topology_changes_from.side_effect = [
+            iter([generate_topology_response('')]),
+            iter([generate_topology_response('<SiteLayout sId="1"><Detectors><Detector dId="5" lane="3"/></Detectors></SiteLayout>')])
+        ]
+        index = topology_index.TopologyIndex(":memory:")
+        enricher = topology_enrichment.TopologyEnricher()
+        self.assertTrue(enricher.refresh(index, mocked_transis_consumer))
+        first_lookup = enricher.lookup
+        self.assertFalse(enricher.refresh(index, mocked_transis_consumer))
+        self.assertIs(enricher.lookup, first_lookup)
+        self.assertTrue(enricher.refresh(index, mocked_transis_consumer))
+        self.assertEqual(enricher.lookup.version, 2)
+        record = enricher.enrich({"siteId": "1", "detectorCounts": {"5": "10"}})
+        self.assertEqual(record["detectorTopology"], {"5": {"dId": "5", "lane": "3"}})
+        index.close()
+
+
+class DetectorCountBatchTests(unittest.TestCase):
+    def setUp(self):
+        self.transis_response = transis_response_models.TransisResponse(generate_detector_count_document(["2087", "2088", "2089"]))
+
+    def test_batch_records_match_detector_count_message_to_dict(self):
+        batch = self.transis_response.detector_count_batch
+        expected = [m.to_dict() for m in self.transis_response.detector_count_messages.detector_count_message_list]
+        self.assertEqual(len(batch), 3)
+        self.assertEqual(list(batch.iter_records()), expected)
+        self.assertEqual([batch.encode_json_record(i) for i in range(len(batch))], [json.dumps(r).encode('utf-8') for r in expected])
+
+    def test_batch_stores_repeated_values_once(self):
+        batch = self.transis_response.detector_count_batch
+        self.assertEqual(batch.regions, ["ROZ"])
+        self.assertEqual(batch.dates, ["2019-10-03T15:43:00+10:00"])
+        self.assertEqual(list(batch.offsets), [0, 24, 48, 72])
+        self.assertEqual(batch.detector_ids.typecode, 'i')
+        self.assertEqual(batch.counts.typecode, 'i')
+
+    def test_ids_and_counts_outside_the_narrow_ranges_are_stored_and_encoded(self):
+        document = generate_detector_count_document(["2087"], num_detectors=2).replace(b'Did="1"', b'Did="70000"').replace(b'count="2"', b'count="-1"')
+        transis_response = transis_response_models.TransisResponse(document)
+        expected = transis_response.detector_count_messages.detector_count_message_list[0].to_dict()
+        batch = transis_response.detector_count_batch
+        self.assertEqual(batch.to_dict(0), expected)
+        data = record_codecs.StructCodec().encode_batch_record(batch, 0)
+        self.assertEqual(record_codecs.decode_record(data)["detectorCounts"], {"70000": 1, "2": -1})
+        self.assertEqual(record_codecs.StructCodec().encode(expected), data)
+        too_large = transis_response_models.TransisResponse(document.replace(b'Did="70000"', b'Did="5000000000"'))
+        self.assertIsNone(too_large.detector_count_batch)
+
+    def test_documents_whose_json_would_differ_from_the_dict_path_are_not_batched(self):
+        document = generate_detector_count_document(["2087"], num_detectors=3)
+        canonical = transis_response_models.TransisResponse(document)
+        expected = json.dumps(canonical.detector_count_messages.detector_count_message_list[0].to_dict()).encode('utf-8')
+        self.assertEqual(canonical.detector_count_batch.encode_json_record(0), expected)
+        for old, new in ((b'count="2"', b'count="007"'), (b'count="2"', b'count=" 5"'), (b'Did="2"', b'Did="1"'), (b'Did="2"', b'Did="1_0"')):
+            transis_response = transis_response_models.TransisResponse(document.replace(old, new))
+            self.assertIsNone(transis_response.detector_count_batch)
+            self.assertIsNotNone(transis_response.detector_count_messages)
+
+    def test_main_sends_batches_when_compact_records_is_set(self):
+        with patch.object(main, "TransisKinesisConnector") as connector, patch.object(main, "build_topology_enricher", return_value=None), \
+                patch.dict(os.environ, {"COMPACT_RECORDS": "true", "CONNECTOR_RUN_MODE": "blocking"}):
+            main.run_connector(Mock(), Mock(spool=None), Mock())
+        self.assertTrue(connector.call_args[1]["compact_records"])
+        connector.return_value.run.assert_called_once()
+
+
+class DetectorCountStreamParserTests(unittest.TestCase):
+    def test_messages_are_returned_as_each_site_element_closes(self):
+        document = generate_detector_count_document(["1", "2", "3"])
+        parser = transis_response_models.DetectorCountStreamParser()
+        first_site_end = document.index(b'</ns2:DetectorCountMessage>') + len(b'</ns2:DetectorCountMessage>')
+        items = parser.feed(document[:first_site_end])
+        self.assertEqual([m.to_dict()["siteId"] for m in items], ["1"])
+        items = parser.feed(document[first_site_end:] + b'\x00')
+        self.assertEqual([type(i) for i in items], [transis_response_models.DetectorCountMessage]*2 + [transis_response_models.DetectorCountDocumentEnd])
+        self.assertEqual(items[-1].num_sites, 3)
+
+    def test_multiple_documents_fed_one_byte_at_a_time(self):
+        stream = (generate_detector_count_document(["1", "2"]) + b'\x00') * 2
+        parser = transis_response_models.DetectorCountStreamParser()
+        items = []
+        for i in range(len(stream)):
+            items.extend(parser.feed(stream[i:i+1]))
+        document_ends = [i for i in items if isinstance(i, transis_response_models.DetectorCountDocumentEnd)]
+        self.assertEqual(len(items), 6)
+        self.assertEqual(len(document_ends), 2)
+
+    def test_error_document_raises_exception(self):
+        parser = transis_response_models.DetectorCountStreamParser()
+        with self.assertRaises(Exception) as context:
+            parser.feed(generate_detector_count_document(["1"], error=True) + b'\x00')
+        self.assertEqual(str(context.exception), "mock error message")
+
+
+class TransisKinesisConnectorTests(unittest.TestCase):
+    def test_run_streaming_pushes_in_flushes_and_ends_job_per_document(self):
+        stream = Mock()
+        stream.iter_content.return_value = iter([generate_detector_count_document([str(i) for i in range(5)]) + b'\x00'])
+        with open("local_config.json","r") as file_handle: 
+            transis_consumer = TransisConsumer(json.loads(file_handle.read())["transis_config_prod"])
+        mocked_kinesis_producer = Mock()
+        mocked_kinesis_producer.push_transis_detector_count_records.return_value = {"kinesis_records": 2, "put_records_calls": 1}
+        mocked_di_framework_client = Mock()
+        connector = TransisKinesisConnector(transis_consumer, mocked_kinesis_producer, mocked_di_framework_client)
+        with patch.object(TransisConsumer, '_TransisConsumer__get_http_response', return_value=stream):
+            connector.run_streaming(flush_size=2)
+        pushed = [call[0][0] for call in mocked_kinesis_producer.push_transis_detector_count_records.call_args_list]
+        self.assertEqual([len(p) for p in pushed], [2, 2, 1])
+        mocked_di_framework_client.start_job.assert_called_once()
+        mocked_di_framework_client.end_job.assert_called_once()
+
+    def test_run_streaming_errors_the_job_and_drops_records_when_the_stream_resets(self):
+        def message(site_id):
+            return Mock(to_dict=Mock(return_value={"siteId": site_id}))
+        mocked_transis_consumer = Mock()
+        mocked_transis_consumer.stream_detector_count_messages.return_value = iter([
+            message("1"),
+            transis_response_models.DetectorCountStreamReset("connection reset"),
+            message("2"),
+            transis_response_models.DetectorCountDocumentEnd(1, "2020-01-01 00:03:00")
+        ])
+        mocked_kinesis_producer = Mock()
+        mocked_kinesis_producer.push_transis_detector_count_records.return_value = {"kinesis_records": 1, "put_records_calls": 1}
+        mocked_di_framework_client = Mock()
+        connector = TransisKinesisConnector(mocked_transis_consumer, mocked_kinesis_producer, mocked_di_framework_client)
+        connector.run_streaming(flush_size=10)
+        pushed = [call[0][0] for call in mocked_kinesis_producer.push_transis_detector_count_records.call_args_list]
+        self.assertEqual(pushed, [[{"siteId": "2"}]])
+        self.assertEqual(mocked_di_framework_client.start_job.call_count, 2)
+        mocked_di_framework_client.error_job.assert_called_once()
+        mocked_di_framework_client.end_job.assert_called_once()
+
+    def test_run_streaming_errors_the_job_when_the_stream_fails(self):
+        def stream_detector_count_messages():
+            yield Mock(to_dict=Mock(return_value={"siteId": "1"}))
+            raise Exception("stream failed")
+        mocked_transis_consumer = Mock()
+        mocked_transis_consumer.stream_detector_count_messages = stream_detector_count_messages
+        mocked_di_framework_client = Mock()
+        connector = TransisKinesisConnector(mocked_transis_consumer, Mock(), mocked_di_framework_client)
+        with self.assertRaises(Exception):
+            connector.run_streaming(flush_size=10)
+        mocked_di_framework_client.error_job.assert_called_once()
+        mocked_di_framework_client.end_job.assert_not_called()
+
+    def test_run_pipelined_keeps_reading_the_stream_while_publishing_is_slow(self):
+        documents = [generate_detector_count_document([str(i), str(i + 100)]) for i in range(5)]
+        received = []
+        def get_detector_count_documents():
+            for document in documents:
+                received.append(document)
+                yield document
+        mocked_transis_consumer = Mock()
+        mocked_transis_consumer.get_detector_count_documents = get_detector_count_documents
+        mocked_transis_consumer.parse_detector_count_document = lambda document: transis_response_models.TransisResponse(document)
+        published = []
+        def slow_push(records, di_framework_client):
+            time.sleep(0.05)
+            published.append((len(received), [r["siteId"] for r in records]))
+            return {"kinesis_records": len(records), "put_records_calls": 1, "retried_records": 0, "dropped_records": 0}
+        mocked_kinesis_producer = Mock()
+        mocked_kinesis_producer.push_transis_detector_count_records = slow_push
+        mocked_di_framework_client = Mock()
+        connector = TransisKinesisConnector(mocked_transis_consumer, mocked_kinesis_producer, mocked_di_framework_client)
+        connector.run_pipelined(documents_queue_size=10, records_queue_size=1)
+        self.assertEqual([p[1] for p in published], [[str(i), str(i + 100)] for i in range(5)])
+        self.assertEqual(published[0][0], 5)
+        self.assertEqual(mocked_di_framework_client.end_job.call_count, 5)
+        logged = json.loads(mocked_di_framework_client.log_job_status.call_args[0][0])
+        self.assertIn("documents_queue_depth", logged)
+
+    def test_run_pipelined_drops_the_oldest_documents_when_asked_to_and_publishing_falls_behind(self):
+        documents = [generate_detector_count_document([str(i)]) for i in range(10)]
+        mocked_transis_consumer = Mock()
+        mocked_transis_consumer.get_detector_count_documents.return_value = iter(documents)
+        mocked_transis_consumer.parse_detector_count_document = lambda document: transis_response_models.TransisResponse(document)
+        published = []
+        def slow_push(records, di_framework_client):
+            time.sleep(0.05)
+            published.append(records[0]["siteId"])
+            return {"kinesis_records": len(records), "put_records_calls": 1, "retried_records": 0, "dropped_records": 0}
+        mocked_kinesis_producer = Mock()
+        mocked_kinesis_producer.push_transis_detector_count_records = slow_push
+        connector = TransisKinesisConnector(mocked_transis_consumer, mocked_kinesis_producer, Mock())
+        connector.run_pipelined(documents_queue_size=1, records_queue_size=1, overflow_policy="drop_oldest")
+        self.assertGreater(connector.dropped_documents, 0)
+        self.assertEqual(len(published) + connector.dropped_documents, 10)
+        self.assertEqual(published[-1], "9")
+
+    def test_run_pipelined_blocks_by_default_and_joins_its_threads(self):
+        documents = [generate_detector_count_document([str(i)]) for i in range(10)]
+        mocked_transis_consumer = Mock()
+        mocked_transis_consumer.get_detector_count_documents.return_value = iter(documents)
+        mocked_transis_consumer.parse_detector_count_document = lambda document: transis_response_models.TransisResponse(document)
+        published = []
+        def slow_push(records, di_framework_client):
+            time.sleep(0.01)
+            published.append(records[0]["siteId"])
+            return {"kinesis_records": len(records), "put_records_calls": 1, "retried_records": 0, "dropped_records": 0}
+        mocked_kinesis_producer = Mock()
+        mocked_kinesis_producer.push_transis_detector_count_records = slow_push
+        connector = TransisKinesisConnector(mocked_transis_consumer, mocked_kinesis_producer, Mock())
+        connector.run_pipelined(documents_queue_size=1, records_queue_size=1)
+        self.assertEqual((connector.dropped_documents, published), (0, [str(i) for i in range(10)]))
+        mocked_transis_consumer.stop.assert_called_once()
+        self.assertFalse([t for t in threading.enumerate() if t.name in ("transis-receiver", "transis-transform")])
+
+    def test_run_pipelined_raises_errors_from_the_stream(self):
+        mocked_transis_consumer = Mock()
+        mocked_transis_consumer.get_detector_count_documents.side_effect = Exception("stream failed")
+        connector = TransisKinesisConnector(mocked_transis_consumer, Mock(), Mock())
+        with self.assertRaises(Exception) as context:
+            connector.run_pipelined()
+        self.assertEqual(str(context.exception), "stream failed")
+
+
+class AsyncTransisKinesisConnectorTests(unittest.TestCase):
+    def test_run_publishes_each_document_from_a_chunked_stream(self):
+        stream = b"".join(generate_detector_count_document([str(i), str(i + 100)]) + b"\x00" for i in range(3))
+        responses = {"/transis/pushservice": chunked_http_response([stream[i:i + 500] for i in range(0, len(stream), 500)])}
+        kinesis_client = Mock()
+        kinesis_client.put_records.side_effect = lambda Records, StreamName: {"FailedRecordCount": 0, "Records": [{"SequenceNumber": "1", "ShardId": "shardId-0"} for _ in Records]}
+        mocked_di_framework_client = Mock()
+
+        async def run_connector():
+            server, transis_consumer = await start_transis_stand_in(responses)
+            async with server:
+                connector = AsyncTransisKinesisConnector(transis_consumer, KinesisProducer("ap-southeast-2", "stream", kinesis_client), mocked_di_framework_client)
+                await connector.run()
+
+        asyncio.run(run_connector())
+        sent = [json.loads(r["Data"])["siteId"] for call in kinesis_client.put_records.call_args_list for r in call[1]["Records"]]
+        self.assertEqual(sent, ["0", "100", "1", "101", "2", "102"])
+        self.assertEqual(mocked_di_framework_client.end_job.call_count, 3)
+        logged = json.loads(mocked_di_framework_client.log_job_status.call_args[0][0])
+        self.assertEqual(logged["kinesis_records"], 2)
+
+    def test_http_client_raises_http_error_when_not_authorised(self):
+        async def get():
+            server, transis_consumer = await start_transis_stand_in({})
+            async with server:
+                client = AsyncTransisHTTPClient(dict(transis_consumer.connection_details, password="wrong"), timeout=5)
+                await client.get(transis_consumer.endpoints["getAllVMS"])
+
+        with self.assertRaises(requests.exceptions.HTTPError):
+            asyncio.run(get())
+
+    def test_poller_runs_alongside_the_stream(self):
+        vms = b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?><ns2:TransisResponse error="false" xmlns:ns2="http://model.transis.rta.nsw.gov.au/"/>\x00'
+        polled = []
+
+        async def slow_stream(writer):
+            while len(polled) < 2:
+                await asyncio.sleep(0.01)
+            writer.write(b"HTTP/1.1 200 OK\r\nConnection: close\r\n\r\n" + generate_detector_count_document(["1"]) + b"\x00")
+
+        responses = {
+            "/transis/pushservice": slow_stream,
+            "/transis/rest/getAllVMS": b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n" % len(vms) + vms
+        }
+        kinesis_client = Mock()
+        kinesis_client.put_records.return_value = {"FailedRecordCount": 0, "Records": [{"SequenceNumber": "1", "ShardId": "shardId-0"}]}
+        mocked_di_framework_client = Mock()
+
+        async def run_connector():
+            server, transis_consumer = await start_transis_stand_in(responses)
+            async with server:
+                connector = AsyncTransisKinesisConnector(transis_consumer, KinesisProducer("ap-southeast-2", "stream", kinesis_client), mocked_di_framework_client)
+                connector.add_poller("getAllVMS", 0.01, polled.append)
+                await connector.run_forever()
+
+        asyncio.run(run_connector())
+        self.assertGreaterEqual(len(polled), 2)
+        self.assertIsInstance(polled[0][0], transis_response_models.TransisResponse)
+        kinesis_client.put_records.assert_called_once()
+        mocked_di_framework_client.end_job.assert_called_once()
+
+    def test_batches_are_taken_from_the_batcher_as_the_put_semaphore_allows(self):
+        stream = generate_detector_count_document([str(i) for i in range(5)]) + b"\x00"
+        responses = {"/transis/pushservice": chunked_http_response([stream])}
+        def put_records(Records, StreamName):
+            if kinesis_client.put_records.call_count == 1:
+                return {"FailedRecordCount": len(Records), "Records": [{"ErrorCode": "ProvisionedThroughputExceededException"} for _ in Records]}
+            return {"FailedRecordCount": 0, "Records": [{"SequenceNumber": "1", "ShardId": "shardId-0"} for _ in Records]}
+        kinesis_client = Mock()
+        kinesis_client.put_records.side_effect = put_records
+        producer = KinesisProducer("ap-southeast-2", "stream", kinesis_client, batcher=kinesis_producer.AdaptiveBatcher(max_records=2, min_records=1),
+                                   retry_policy=kinesis_retry.RetryPolicy(max_attempts=1))
+
+        async def run_connector():
+            server, transis_consumer = await start_transis_stand_in(responses)
+            async with server:
+                await AsyncTransisKinesisConnector(transis_consumer, producer, Mock(), max_concurrent_puts=1).run()
+
+        asyncio.run(run_connector())
+        self.assertEqual([len(call[1]["Records"]) for call in kinesis_client.put_records.call_args_list], [2, 1, 2])
+
+    def test_main_adds_the_configured_pollers(self):
+        async_connector = Mock()
+        with patch.dict(os.environ, {"TRANSIS_POLLERS": "getAllVMS:300, getAllOpenTIRF:60"}):
+            main.add_transis_pollers(async_connector)
+        self.assertEqual([call[0][:2] for call in async_connector.add_poller.call_args_list], [("getAllVMS", 300.0), ("getAllOpenTIRF", 60.0)])
+
+
 class KinesisProducerTests(unittest.TestCase):
     def setUp(self):
         pass
@@ -146,6 +724,760 @@ class KinesisProducerTests(unittest.TestCase):
         }
         self.assertEqual(res,expected_res)
 
+    def test_push_transis_detector_count_batch_encodes_every_site(self):
+        mocked_kinesis_client = Mock()
+        mocked_kinesis_client.put_records.return_value = {"FailedRecordCount": 0, "Records": []}
+        batch = transis_response_models.TransisResponse(generate_detector_count_document([str(i) for i in range(25)])).detector_count_batch
+        kinesis_producer = KinesisProducer("region_name","stream_name",mocked_kinesis_client)
+        kinesis_producer.push_transis_detector_count_batch(batch, Mock(), batch_size=10)
+        sent = [r for call in mocked_kinesis_client.put_records.call_args_list for r in call[1]["Records"]]
+        self.assertEqual(mocked_kinesis_client.put_records.call_count, 3)
+        self.assertEqual([json.loads(r["Data"])["siteId"] for r in sent], [str(i) for i in range(25)])
+
+
+    def test_push_transis_detector_count_records_partitions_by_site_id_by_default(self):
+        mocked_kinesis_client = Mock()
+        mocked_kinesis_client.put_records.return_value = {"FailedRecordCount": 0, "Records": []}
+        records = [{"siteId": str(i), "region": "ROZ"} for i in range(5)]
+        KinesisProducer("region_name","stream_name",mocked_kinesis_client).push_transis_detector_count_records(records, Mock())
+        sent = mocked_kinesis_client.put_records.call_args[1]["Records"]
+        self.assertEqual([r["PartitionKey"] for r in sent], [str(i) for i in range(5)])
+
+    def test_push_fills_put_records_calls_up_to_kinesis_limits(self):
+        mocked_kinesis_client = Mock()
+        mocked_kinesis_client.put_records.return_value = {"FailedRecordCount": 0, "Records": []}
+        records = [{"siteId": str(i)} for i in range(5000)]
+        summary = KinesisProducer("region_name","stream_name",mocked_kinesis_client).push_transis_detector_count_records(records, Mock())
+        self.assertEqual(summary, {"kinesis_records": 5000, "put_records_calls": 10, "retried_records": 0, "dropped_records": 0})
+        self.assertTrue(all(len(call[1]["Records"]) == 500 for call in mocked_kinesis_client.put_records.call_args_list))
+
+    def test_concurrent_dispatch_bounds_in_flight_calls_and_keeps_partition_key_order(self):
+        in_flight = []
+        max_in_flight = []
+        sent = []
+        lock = threading.Lock()
+        def slow_put_records(Records, StreamName):
+            with lock:
+                in_flight.append(1)
+                max_in_flight.append(len(in_flight))
+            time.sleep(0.01)
+            with lock:
+                in_flight.pop()
+                sent.extend(Records)
+            return {"FailedRecordCount": 0, "Records": []}
+        mocked_kinesis_client = Mock()
+        mocked_kinesis_client.put_records = slow_put_records
+        producer = KinesisProducer("region_name","stream_name",mocked_kinesis_client,kinesis_producer.RecordFieldPartitioner("siteId"),max_in_flight=4)
+        records = [{"siteId": str(i % 20), "sequence": i} for i in range(400)]
+        summary = producer.push_transis_detector_count_records(records, Mock(), batch_size=10)
+        self.assertEqual(summary["put_records_calls"], producer.put_records_calls)
+        self.assertEqual(summary["dropped_records"], 0)
+        self.assertEqual(len(sent), 400)
+        self.assertLessEqual(max(max_in_flight), 4)
+        self.assertGreater(max(max_in_flight), 1)
+        for site_id in range(20):
+            sequences = [json.loads(r["Data"])["sequence"] for r in sent if r["PartitionKey"] == str(site_id)]
+            self.assertEqual(sequences, sorted(sequences))
+
+
+class RecordCodecsTests(unittest.TestCase):
+    def setUp(self):
+        self.batch = transis_response_models.TransisResponse(generate_detector_count_document(["2087", "2088"], num_detectors=3)).detector_count_batch
+
+    def test_codecs_round_trip_records_with_int_counts(self):
+        record = self.batch.to_dict(0)
+        int_counts_record = dict(record, detectorCounts={d: int(c) for d, c in record["detectorCounts"].items()})
+        self.assertEqual(record_codecs.decode_record(record_codecs.JSONCodec().encode(record)), record)
+        self.assertEqual(record_codecs.JSONCodec().encode_batch_record(self.batch, 0), record_codecs.JSONCodec().encode(record))
+        codec_names = ["compact-json", "struct"] + (["msgpack"] if record_codecs.msgpack else [])
+        for name in codec_names:
+            codec = record_codecs.create_codec(name)
+            data = codec.encode(record)
+            self.assertEqual(data[:2], bytes([record_codecs.CODEC_MARKER, codec.codec_id]))
+            self.assertEqual(codec.encode_batch_record(self.batch, 0), data)
+            self.assertEqual(record_codecs.decode_record(data), int_counts_record)
+            self.assertLess(len(data), len(record_codecs.JSONCodec().encode(record)))
+
+    def test_producer_sends_aggregated_and_gzipped_records_that_decode(self):
+        mocked_kinesis_client = Mock()
+        mocked_kinesis_client.put_records.return_value = {"FailedRecordCount": 0, "Records": []}
+        aggregator = kinesis_aggregation.RecordAggregator(shards=[{"ShardId": "shardId-0", "StartingHashKey": 0, "EndingHashKey": 2**128 - 1}])
+        producer = KinesisProducer("region_name","stream_name",mocked_kinesis_client,aggregator=aggregator,
+                                   codec=record_codecs.StructCodec(),compression="gzip")
+        site_ids = [str(2087 + i) for i in range(20)]
+        batch = transis_response_models.TransisResponse(generate_detector_count_document(site_ids, num_detectors=24)).detector_count_batch
+        producer.push_transis_detector_count_batch(batch, Mock())
+        sent = mocked_kinesis_client.put_records.call_args[1]["Records"]
+        self.assertTrue(kinesis_aggregation.is_aggregated_record(sent[0]["Data"]))
+        user_records = kinesis_aggregation.deaggregate_record(sent[0])
+        self.assertTrue(all(user_record["Data"][:2] == record_codecs.GZIP_MAGIC for user_record in user_records))
+        decoded = [record for r in sent for record in record_codecs.decode_kinesis_data(r["Data"])]
+        self.assertEqual([r["siteId"] for r in decoded], site_ids)
+        self.assertEqual(decoded[1]["detectorCounts"], {d: int(c) for d, c in batch.to_dict(1)["detectorCounts"].items()})
+
+    def test_records_that_gzip_does_not_shrink_are_sent_uncompressed(self):
+        small = {"PartitionKey": "1", "Data": record_codecs.StructCodec().encode_batch_record(self.batch, 0)}
+        large = {"PartitionKey": "2", "Data": b'{"siteId": "1"}' * 100}
+        compressed = record_codecs.compress_kinesis_records([small, large])
+        self.assertEqual(compressed[0], small)
+        self.assertEqual(compressed[1]["Data"][:2], record_codecs.GZIP_MAGIC)
+        self.assertLess(len(compressed[1]["Data"]), len(large["Data"]))
+        self.assertEqual(record_codecs.decode_kinesis_data(compressed[0]["Data"]), [record_codecs.decode_record(small["Data"])])
+
+    def test_unknown_codecs_and_data_are_rejected(self):
+        with self.assertRaises(ValueError):
+            record_codecs.create_codec("xml")
+        with self.assertRaises(ValueError):
+            record_codecs.decode_record(b"\xdc\x09")
+
+
+class AdaptiveBatcherTests(unittest.TestCase):
+    def test_batches_respect_record_and_byte_limits(self):
+        batcher = kinesis_producer.AdaptiveBatcher(max_records=4, max_bytes=100)
+        kinesis_records = [{"PartitionKey": "k", "Data": b"x" * 39} for _ in range(10)]
+        self.assertEqual([len(b) for b in batcher.batches(kinesis_records)], [2, 2, 2, 2, 2])
+        kinesis_records = [{"PartitionKey": "k", "Data": b"x"} for _ in range(10)]
+        self.assertEqual([len(b) for b in batcher.batches(kinesis_records)], [4, 4, 2])
+
+    def test_batch_size_shrinks_when_throttled_and_grows_on_success(self):
+        batcher = kinesis_producer.AdaptiveBatcher(max_records=500, min_records=10)
+        batcher.record_result(500, 20)
+        self.assertEqual(batcher.target_records, 250)
+        for _ in range(10):
+            batcher.record_result(batcher.target_records, 1)
+        self.assertEqual(batcher.target_records, 10)
+        for _ in range(10):
+            batcher.record_result(batcher.target_records, 0)
+        self.assertEqual(batcher.target_records, 500)
+
+
+class KinesisRetryTests(unittest.TestCase):
+    def setUp(self):
+        self.sleeps = []
+        self.retry_policy = kinesis_retry.RetryPolicy(max_attempts=4, base_delay=1, max_delay=3, sleep=self.sleeps.append, random_fraction=lambda: 1.0)
+
+    def test_retryable_records_are_retried_with_exponential_backoff_and_fatal_records_are_dropped(self):
+        responses = iter([
+            {"FailedRecordCount": 3, "Records": [{"ErrorCode": "ProvisionedThroughputExceededException"}, {"ErrorCode": "KMSAccessDeniedException"}, {"SequenceNumber": "1"}, {"ErrorCode": "InternalFailure"}]},
+            {"FailedRecordCount": 1, "Records": [{"SequenceNumber": "2"}, {"ErrorCode": "ProvisionedThroughputExceededException"}]},
+            {"FailedRecordCount": 1, "Records": [{"ErrorCode": "ProvisionedThroughputExceededException"}]},
+            {"FailedRecordCount": 1, "Records": [{"ErrorCode": "ProvisionedThroughputExceededException"}]}])
+        mocked_kinesis_client = Mock()
+        mocked_kinesis_client.put_records.side_effect = lambda Records, StreamName: next(responses)
+        producer = KinesisProducer("region_name","stream_name",mocked_kinesis_client,retry_policy=self.retry_policy)
+        records = [{"PartitionKey": str(i), "Data": b"x"} for i in range(4)]
+        result = producer.put_records_with_retries(records, Mock())
+        self.assertEqual(self.sleeps, [1, 2, 3])
+        self.assertEqual([len(call[1]["Records"]) for call in mocked_kinesis_client.put_records.call_args_list], [4, 2, 1, 1])
+        self.assertEqual(mocked_kinesis_client.put_records.call_args_list[1][1]["Records"], [records[0], records[3]])
+        self.assertEqual(result["dropped_records"], 2)
+        self.assertEqual(result["dropped_error_codes"], {"KMSAccessDeniedException": 1, "ProvisionedThroughputExceededException": 1})
+        self.assertEqual(result["retried_records"], 4)
+        self.assertEqual(producer.dropped_records, 2)
+
+    def test_retryable_exceptions_are_retried_and_other_exceptions_drop_the_batch(self):
+        throttled = botocore.exceptions.ClientError({"Error": {"Code": "ProvisionedThroughputExceededException"}}, "PutRecords")
+        mocked_kinesis_client = Mock()
+        mocked_kinesis_client.put_records.side_effect = [throttled, {"FailedRecordCount": 0, "Records": [{"SequenceNumber": "1"}]}]
+        mocked_di_framework_client = Mock()
+        producer = KinesisProducer("region_name","stream_name",mocked_kinesis_client,retry_policy=self.retry_policy)
+        result = producer.put_records_with_retries([{"PartitionKey": "1", "Data": b"x"}], mocked_di_framework_client)
+        self.assertEqual((result["put_records_calls"], result["dropped_records"]), (1, 0))
+        mocked_kinesis_client.put_records.side_effect = [ValueError("not retryable")]
+        result = producer.put_records_with_retries([{"PartitionKey": "1", "Data": b"x"}], mocked_di_framework_client)
+        self.assertEqual(result["dropped_error_codes"], {"ValueError": 1})
+        mocked_di_framework_client.log_job_status.assert_called_once_with("not retryable")
+
+    def test_shard_rate_limiter_paces_each_shard_under_its_limits(self):
+        clock = [0.0]
+        sleeps = []
+        shards = [{"ShardId": "shardId-0", "StartingHashKey": 0, "EndingHashKey": 2**127 - 1},
+                  {"ShardId": "shardId-1", "StartingHashKey": 2**127, "EndingHashKey": 2**128 - 1}]
+        rate_limiter = kinesis_retry.ShardRateLimiter(shards, records_per_second=100, bytes_per_second=10000, clock=lambda: clock[0], sleep=sleeps.append)
+        first_shard = [{"PartitionKey": "a", "ExplicitHashKey": "1", "Data": b"x"}] * 100
+        second_shard = [{"PartitionKey": "a", "ExplicitHashKey": str(2**127), "Data": b"x"}] * 100
+        self.assertEqual(rate_limiter.acquire(first_shard), 0)
+        self.assertEqual(rate_limiter.acquire(second_shard), 0)
+        self.assertAlmostEqual(rate_limiter.acquire(first_shard[:50]), 0.5)
+        clock[0] += 1.5
+        self.assertEqual(rate_limiter.acquire(first_shard[:50]), 0)
+        big_records = [{"PartitionKey": "a", "ExplicitHashKey": "1", "Data": b"x" * 4999}] * 3
+        self.assertAlmostEqual(rate_limiter.acquire(big_records), 0.51)
+        self.assertEqual(len(sleeps), 2)
+
+
+class PartitionerTests(unittest.TestCase):
+    def test_consistent_hash_partitioner_is_stable_and_bounded(self):
+        partitioner = kinesis_producer.ConsistentHashPartitioner(num_partitions=8)
+        keys = [partitioner.partition({"siteId": str(i)})["PartitionKey"] for i in range(2000)]
+        self.assertEqual(keys, [partitioner.partition({"siteId": str(i)})["PartitionKey"] for i in range(2000)])
+        self.assertEqual(len(set(keys)), 8)
+        moved = [k for i, k in enumerate(keys) if kinesis_producer.ConsistentHashPartitioner(num_partitions=9).partition({"siteId": str(i)})["PartitionKey"] != k]
+        self.assertLess(len(moved), 2000 * 0.25)
+
+    def test_explicit_hash_key_partitioner_spreads_sites_evenly_over_open_shards(self):
+        mocked_kinesis_client = Mock()
+        mocked_kinesis_client.describe_stream.side_effect = [
+            {"StreamDescription": {"HasMoreShards": True, "Shards": [
+                mock_shard("shardId-0", 0, 2**126 - 1),
+                mock_shard("shardId-1", 0, 2**128 - 1, closed=True)]}},
+            {"StreamDescription": {"HasMoreShards": False, "Shards": [
+                mock_shard("shardId-2", 2**126, 2**128 - 1)]}}]
+        partitioner = kinesis_producer.ExplicitHashKeyPartitioner(mocked_kinesis_client, "stream_name")
+        self.assertEqual([shard["ShardId"] for shard in partitioner.shards], ["shardId-0", "shardId-2"])
+        self.assertEqual(mocked_kinesis_client.describe_stream.call_args[1]["ExclusiveStartShardId"], "shardId-1")
+        hash_keys = [int(partitioner.partition({"siteId": str(i)})["ExplicitHashKey"]) for i in range(1000)]
+        in_first_shard = len([h for h in hash_keys if h < 2**126])
+        self.assertTrue(400 < in_first_shard < 600)
+
+
+class RecordAggregatorTests(unittest.TestCase):
+    def setUp(self):
+        self.kinesis_records = [{"PartitionKey": f"partition-{i % 3}", "Data": json.dumps({"siteId": str(i)}).encode('utf-8')} for i in range(300)]
+
+    def test_aggregated_records_round_trip_through_deaggregation(self):
+        aggregated_records = kinesis_aggregation.RecordAggregator().aggregate(self.kinesis_records)
+        self.assertEqual(len(aggregated_records), 3)
+        self.assertTrue(all(kinesis_aggregation.is_aggregated_record(r["Data"]) for r in aggregated_records))
+        user_records = [u for r in aggregated_records for u in kinesis_aggregation.deaggregate_record(r)]
+        self.assertEqual(sorted((u["PartitionKey"], u["Data"]) for u in user_records), sorted((r["PartitionKey"], r["Data"]) for r in self.kinesis_records))
+        for aggregated_record in aggregated_records:
+            self.assertEqual({u["PartitionKey"] for u in kinesis_aggregation.deaggregate_record(aggregated_record)}, {aggregated_record["PartitionKey"]})
+
+    def test_aggregated_records_do_not_exceed_max_size(self):
+        aggregator = kinesis_aggregation.RecordAggregator(max_aggregated_record_size=1000)
+        aggregated_records = aggregator.aggregate(self.kinesis_records)
+        self.assertTrue(all(len(r["Data"]) <= 1000 for r in aggregated_records))
+        self.assertEqual(sum(len(kinesis_aggregation.deaggregate_record(r)) for r in aggregated_records), 300)
+        self.assertTrue(any(len(r["Data"]) > 950 for r in aggregated_records))
+
+    def test_records_are_only_aggregated_within_a_shard(self):
+        shards = [{"ShardId": "shardId-0", "StartingHashKey": 0, "EndingHashKey": 2**127 - 1},
+                  {"ShardId": "shardId-1", "StartingHashKey": 2**127, "EndingHashKey": 2**128 - 1}]
+        kinesis_records = [{"PartitionKey": str(i), "Data": b"x"} for i in range(100)]
+        aggregated_records = kinesis_aggregation.RecordAggregator(shards=shards).aggregate(kinesis_records)
+        self.assertEqual(len(aggregated_records), 2)
+        for aggregated_record in aggregated_records:
+            shard_of_record = utils.md5_hash_key(aggregated_record["PartitionKey"]) >= 2**127
+            for user_record in kinesis_aggregation.deaggregate_record(aggregated_record):
+                self.assertEqual(utils.md5_hash_key(user_record["PartitionKey"]) >= 2**127, shard_of_record)
+
+    def test_explicit_hash_keys_and_corruption(self):
+        kinesis_records = [{"PartitionKey": str(i), "ExplicitHashKey": "12345", "Data": b"data"} for i in range(3)]
+        aggregated_record = kinesis_aggregation.RecordAggregator().aggregate(kinesis_records)[0]
+        self.assertEqual([u["ExplicitHashKey"] for u in kinesis_aggregation.deaggregate_record(aggregated_record)], ["12345"]*3)
+        aggregated_record["Data"] = aggregated_record["Data"][:-1] + b"\x00"
+        with self.assertRaises(ValueError):
+            kinesis_aggregation.deaggregate_record(aggregated_record)
+
+    def test_aggregated_record_matches_a_kpl_encoded_sample(self):
+        # partition_key_table ["a", "b"], explicit_hash_key_table ["123"], records [(0, None, "hi"), (1, 0, "yo")], encoded by hand
+        # from the KPL AggregatedRecord .proto and followed by the MD5 of the message, as the KCL reads it
+        kpl_sample = bytes.fromhex("f3899ac2" "0a0161" "0a0162" "1203313233" "1a0608001a026869" "1a08080110001a02796f"
+                                   "9d41d962a8f0b57740ab62e785ca3b0b")
+        self.assertEqual(kinesis_aggregation.deaggregate_record({"PartitionKey": "a", "Data": kpl_sample}), [
+            {"PartitionKey": "a", "ExplicitHashKey": None, "Data": b"hi"},
+            {"PartitionKey": "b", "ExplicitHashKey": "123", "Data": b"yo"}
+        ])
+        aggregator = kinesis_aggregation.RecordAggregator(shards=[{"ShardId": "shardId-0", "StartingHashKey": 0, "EndingHashKey": 2**128 - 1}])
+        aggregated_records = aggregator.aggregate([{"PartitionKey": "a", "Data": b"hi"}, {"PartitionKey": "b", "ExplicitHashKey": "123", "Data": b"yo"}])
+        self.assertEqual(aggregated_records, [{"PartitionKey": "a", "Data": kpl_sample}])
+
+    def test_main_aggregates_site_partitioned_records_by_shard(self):
+        kinesis_client = load_test.ThrottlingKinesisClient(num_shards=2)
+        config = {"kinesis_config": {"region_name": "ap-southeast-2", "stream_name": "load-test"}}
+        with patch.dict(os.environ, {"KINESIS_AGGREGATION_MAX_SIZE": "51200"}):
+            producer = main.build_kinesis_producer(config, kinesis_client)
+        kinesis_records = producer.encode_detector_count_records([{"siteId": str(i)} for i in range(50)])
+        self.assertEqual(len(producer.prepare_kinesis_records(kinesis_records)), 2)
+
+    def test_producer_aggregates_records_before_batching(self):
+        mocked_kinesis_client = Mock()
+        mocked_kinesis_client.put_records.return_value = {"FailedRecordCount": 0, "Records": []}
+        producer = KinesisProducer("region_name","stream_name",mocked_kinesis_client,kinesis_producer.ConsistentHashPartitioner(num_partitions=4),kinesis_aggregation.RecordAggregator())
+        producer.push_transis_detector_count_records([{"siteId": str(i)} for i in range(200)], Mock())
+        sent = mocked_kinesis_client.put_records.call_args[1]["Records"]
+        self.assertEqual(mocked_kinesis_client.put_records.call_count, 1)
+        self.assertEqual(len(sent), 4)
+        self.assertEqual(sum(len(kinesis_aggregation.deaggregate_record(r)) for r in sent), 200)
+
+
+class DIFrameworkTests(unittest.TestCase):
+    def setUp(self):
+        self.connections = []
+        def new_connection():
+            connection = Mock(closed=0, autocommit=True)
+            connection.cursor.return_value.fetchone.return_value = ('[{"key": "job_id", "value": 7}]',)
+            self.connections.append(connection)
+            return connection
+        pool = Mock(closed=False)
+        idle = []
+        pool.getconn.side_effect = lambda: idle.pop() if idle else new_connection()
+        pool.putconn.side_effect = lambda connection, close=False: None if close else idle.append(connection)
+        patcher = patch('di_framework.psycopg2.pool.ThreadedConnectionPool', return_value=pool)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.di_framework_client = di_framework.DIFramework({"connection_details": {"host": "h", "database": "d", "user": "u", "password": "p"},
+                                                             "schema_name": "di", "job_name": "transis"})
+
+    def test_jobs_reuse_one_connection_and_prepare_each_statement_once(self):
+        for _ in range(3):
+            self.di_framework_client.start_job()
+            self.di_framework_client.log_job_status("it's done")
+            self.di_framework_client.end_job()
+        self.assertEqual(len(self.connections), 1)
+        executed = [call[0] for call in self.connections[0].cursor.return_value.execute.call_args_list]
+        self.assertEqual(len([e for e in executed if e[0].startswith("PREPARE")]), 3)
+        self.assertIn(("EXECUTE di_log_job_stus (%s, %s, %s)", ("transis", 7, "it's done")), executed)
+
+    def test_call_is_made_again_on_a_new_connection_when_the_connection_breaks(self):
+        self.di_framework_client.start_job()
+        broken_cursor = self.connections[0].cursor.return_value
+        broken_cursor.execute.side_effect = di_framework.psycopg2.OperationalError("server closed the connection unexpectedly")
+        self.assertEqual(self.di_framework_client.end_job(), [{"key": "job_id", "value": 7}])
+        self.assertEqual(len(self.connections), 2)
+        self.assertIn(("EXECUTE di_end_job (%s, %s)", ("transis", 7)), [call[0] for call in self.connections[1].cursor.return_value.execute.call_args_list])
+
+    def test_statements_are_prepared_with_parameter_types(self):
+        self.di_framework_client.error_job("failed", job_id=7)
+        executed = [call[0][0] for call in self.connections[0].cursor.return_value.execute.call_args_list]
+        self.assertIn("PREPARE di_error_job (text, text, integer, integer) AS SELECT di.end_job($1, $2, $3, $4)", executed)
+
+    def test_start_job_is_not_made_again_once_it_has_been_sent(self):
+        self.di_framework_client.start_job()
+        self.connections[0].cursor.return_value.execute.side_effect = di_framework.psycopg2.OperationalError("server closed the connection unexpectedly")
+        with self.assertRaises(di_framework.psycopg2.OperationalError):
+            self.di_framework_client.start_job()
+        self.assertEqual(len(self.connections), 1)
+        executed = [call[0][0] for call in self.connections[0].cursor.return_value.execute.call_args_list]
+        self.assertEqual(executed.count("EXECUTE di_strt_job (%s)"), 2)
+
+    def test_callers_wait_for_a_connection_when_they_are_all_in_use(self):
+        self.di_framework_client = di_framework.DIFramework({"connection_details": {"host": "h", "database": "d", "user": "u", "password": "p"},
+                                                             "schema_name": "di", "job_name": "transis"}, max_connections=1, connection_wait_timeout=0.05)
+        connection = self.di_framework_client.start_db_connection()
+        with self.assertRaises(Exception):
+            self.di_framework_client.start_db_connection()
+        self.di_framework_client.connection_wait_timeout = 5
+        threading.Timer(0.05, self.di_framework_client.release_db_connection, [connection]).start()
+        self.assertEqual(self.di_framework_client.start_job(), [{"key": "job_id", "value": 7}])
+        self.assertEqual(len(self.connections), 1)
+
+
+class DIJobWriterTests(unittest.TestCase):
+    def test_events_are_written_in_order_with_status_logs_coalesced(self):
+        mocked_di_framework_client = Mock()
+        mocked_di_framework_client.start_job.side_effect = [[{"key": "job_id", "value": 10}], [{"key": "job_id", "value": 11}]]
+        mocked_di_framework_client.get_value_from_response = di_framework.DIFramework.get_value_from_response.__get__(mocked_di_framework_client)
+        writer = di_framework.DIJobWriter(mocked_di_framework_client, flush_interval=0.05)
+        writer.start_job()
+        writer.log_job_status("retrying 2 records")
+        writer.log_job_status('{"kinesis_records": 2}')
+        writer.end_job()
+        second_job = writer.start_job()
+        writer.error_job("failed", job_id=second_job)
+        self.assertTrue(writer.close())
+        self.assertEqual(mocked_di_framework_client.method_calls, [
+            unittest.mock.call.start_job(),
+            unittest.mock.call.log_job_status('retrying 2 records\n{"kinesis_records": 2}', job_id=10),
+            unittest.mock.call.end_job(job_id=10),
+            unittest.mock.call.start_job(),
+            unittest.mock.call.error_job("failed", job_id=11, job_status_cd="-1")
+        ])
+
+    def test_close_gives_up_after_the_shutdown_timeout(self):
+        mocked_di_framework_client = Mock()
+        mocked_di_framework_client.start_job.side_effect = lambda: time.sleep(0.5)
+        writer = di_framework.DIJobWriter(mocked_di_framework_client, flush_interval=0, shutdown_timeout=0.05)
+        writer.start_job()
+        started = time.monotonic()
+        self.assertFalse(writer.close())
+        self.assertLess(time.monotonic() - started, 0.4)
+
+    def test_close_does_not_block_on_a_full_queue(self):
+        mocked_di_framework_client = Mock()
+        mocked_di_framework_client.start_job.side_effect = lambda: time.sleep(0.5)
+        writer = di_framework.DIJobWriter(mocked_di_framework_client, max_batch_size=1, flush_interval=0, max_queue_size=2, shutdown_timeout=0.05)
+        for _ in range(3):
+            writer.start_job()
+        time.sleep(0.01)
+        writer.start_job()
+        started = time.monotonic()
+        self.assertFalse(writer.close())
+        self.assertLess(time.monotonic() - started, 0.4)
+        self.assertEqual(writer.unwritten_events, 2)
+
+    def test_main_writes_the_queued_events_when_the_connector_returns(self):
+        mocked_di_framework_client = Mock()
+        mocked_di_framework_client.start_job.return_value = [{"key": "job_id", "value": 10}]
+        mocked_di_framework_client.get_value_from_response = di_framework.DIFramework.get_value_from_response.__get__(mocked_di_framework_client)
+        writer = di_framework.DIJobWriter(mocked_di_framework_client, flush_interval=60)
+        def run_connector(transis_consumer, kinesis_producer, di_framework_client):
+            di_framework_client.start_job()
+            di_framework_client.end_job()
+        kinesis_producer = Mock()
+        with patch.object(main, "start_metrics"), patch.object(main.utils, "get_config", return_value={"transis_config_prod": {}}), \
+                patch.object(main, "TransisConsumer"), patch.object(main, "build_kinesis_producer", return_value=kinesis_producer), \
+                patch.object(main, "build_di_framework_client", return_value=writer), \
+                patch.object(main, "run_connector", side_effect=run_connector):
+            main.main()
+        mocked_di_framework_client.end_job.assert_called_once_with(job_id=10)
+        mocked_di_framework_client.close_db_connection.assert_called_once()
+        kinesis_producer.close.assert_called_once()
+
+
+class KinesisSpoolTests(unittest.TestCase):
+    def setUp(self):
+        temporary_directory = tempfile.TemporaryDirectory()
+        self.addCleanup(temporary_directory.cleanup)
+        self.directory = temporary_directory.name
+
+    def test_unacknowledged_records_are_replayed_after_a_restart(self):
+        records = [{"PartitionKey": str(i), "Data": b'{"siteId": "%d"}' % i} for i in range(10)]
+        records[3]["ExplicitHashKey"] = "12345"
+        spool = kinesis_spool.KinesisSpool(self.directory, segment_size=100, fsync_policy="always")
+        sequences = spool.append(records)
+        spool.ack(sequences[:3] + sequences[5:])
+        spool.close()
+        restarted_spool = kinesis_spool.KinesisSpool(self.directory)
+        self.assertEqual(restarted_spool.replay(), [(sequences[3], records[3]), (sequences[4], records[4])])
+        self.assertGreater(restarted_spool.append(records[:1])[0], sequences[4])
+
+    def test_acknowledged_segments_are_deleted_and_size_is_capped(self):
+        spool = kinesis_spool.KinesisSpool(self.directory, segment_size=60, max_spool_bytes=200)
+        sequences = spool.append([{"PartitionKey": "1", "Data": b"x" * 20} for _ in range(6)])
+        self.assertEqual(sequences[-1], None)
+        self.assertEqual(spool.rejected_records, sequences.count(None))
+        spool.ack(sequences)
+        self.assertEqual(spool.pending_records(), 0)
+        self.assertEqual(len([f for f in os.listdir(self.directory) if f.endswith(".seg")]), 1)
+
+    def test_producer_keeps_dropped_records_in_the_spool_and_sends_them_with_the_next_push(self):
+        kinesis_client = Mock()
+        kinesis_client.put_records.side_effect = [
+            {"FailedRecordCount": 1, "Records": [{"SequenceNumber": "1"}, {"ErrorCode": "ProvisionedThroughputExceededException", "ErrorMessage": "mock"}]},
+            {"FailedRecordCount": 1, "Records": [{"ErrorCode": "ProvisionedThroughputExceededException", "ErrorMessage": "mock"}]},
+            {"FailedRecordCount": 0, "Records": [{"SequenceNumber": "2"}]},
+            {"FailedRecordCount": 0, "Records": [{"SequenceNumber": "3"}]},
+            {"FailedRecordCount": 0, "Records": [{"SequenceNumber": "4"}]}
+        ]
+        spool = kinesis_spool.KinesisSpool(self.directory)
+        producer = KinesisProducer("ap-southeast-2", "stream", kinesis_client, spool=spool, retry_policy=kinesis_retry.RetryPolicy(max_attempts=1))
+        producer.push_transis_detector_count_records([{"siteId": "1"}, {"siteId": "2"}], Mock())
+        self.assertEqual(spool.pending_records(), 1)
+        summary = producer.push_transis_detector_count_records([{"siteId": "3"}], Mock())
+        self.assertEqual((summary["replayed_records"], summary["dropped_records"]), (1, 1))
+        self.assertEqual(spool.pending_records(), 1)
+        summary = producer.push_transis_detector_count_records([{"siteId": "4"}], Mock())
+        self.assertEqual(summary["replayed_records"], 1)
+        self.assertEqual([call[1]["Records"][0]["PartitionKey"] for call in kinesis_client.put_records.call_args_list[1:]], ["2", "3", "2", "4"])
+        self.assertEqual(spool.pending_records(), 0)
+
+    def test_rejected_records_are_dead_lettered_and_replay_is_limited_per_push(self):
+        kinesis_client = Mock()
+        kinesis_client.put_records.side_effect = [
+            {"FailedRecordCount": 1, "Records": [{"SequenceNumber": "1"}, {"ErrorCode": "ValidationException", "ErrorMessage": "mock"}]},
+            botocore.exceptions.ClientError({"Error": {"Code": "ServiceUnavailable", "Message": "mock"}}, "PutRecords"),
+            {"FailedRecordCount": 0, "Records": [{"SequenceNumber": "3"}]},
+            {"FailedRecordCount": 0, "Records": [{"SequenceNumber": "4"}]},
+        ]
+        spool = kinesis_spool.KinesisSpool(self.directory)
+        producer = KinesisProducer("ap-southeast-2", "stream", kinesis_client, spool=spool, retry_policy=kinesis_retry.RetryPolicy(max_attempts=1),
+                                   replay_limit=1)
+        producer.push_transis_detector_count_records([{"siteId": "1"}, {"siteId": "2"}], Mock())
+        self.assertEqual((spool.pending_records(), spool.dead_letter_records), (0, 1))
+        self.assertTrue(os.path.getsize(os.path.join(self.directory, kinesis_spool.DEAD_LETTER_FILE)) > 0)
+        producer.push_transis_detector_count_records([{"siteId": "3"}, {"siteId": "4"}], Mock())
+        self.assertEqual(spool.pending_records(), 2)
+        summary = producer.push_transis_detector_count_records([], Mock())
+        self.assertEqual((summary["replayed_records"], spool.pending_records()), (1, 1))
+        producer.close()
+
+
+class DuplicateRecordFilterTests(unittest.TestCase):
+    def test_repeated_site_intervals_are_counted_and_dropped(self):
+        deduplicator = record_deduplication.DuplicateRecordFilter(max_entries=2)
+        records = [{"siteId": "1", "collectionendtimestamp_plus_3_mins": 300}, {"siteId": "1", "collectionendtimestamp_plus_3_mins": 600},
+                   {"siteId": "1", "collectionendtimestamp_plus_3_mins": 300}]
+        self.assertEqual(deduplicator.filter_records(records), records[:2])
+        self.assertEqual(deduplicator.get_counters(), {"duplicate_hits": 1, "duplicate_misses": 2, "duplicate_keys": 2})
+
+    def test_evicted_keys_are_recognised_by_the_bloom_filter_after_a_restart(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "sent.json")
+            deduplicator = record_deduplication.DuplicateRecordFilter(max_entries=1, bloom_capacity=100, persistence_path=path)
+            records = [{"siteId": str(i), "collectionendtimestamp_plus_3_mins": 300} for i in range(3)]
+            deduplicator.filter_records(records)
+            deduplicator.close()
+            restarted = record_deduplication.DuplicateRecordFilter(max_entries=1, bloom_capacity=100, persistence_path=path)
+            self.assertEqual(restarted.filter_records(records + [{"siteId": "3", "collectionendtimestamp_plus_3_mins": 300}]), [{"siteId": "3", "collectionendtimestamp_plus_3_mins": 300}])
+
+    def test_producer_drops_duplicates_before_encoding(self):
+        kinesis_client = Mock()
+        kinesis_client.put_records.return_value = {"FailedRecordCount": 0, "Records": [{"SequenceNumber": "1"}]}
+        producer = KinesisProducer("ap-southeast-2", "stream", kinesis_client, deduplicator=record_deduplication.DuplicateRecordFilter())
+        batch = transis_response_models.TransisResponse(generate_detector_count_document(["1"])).detector_count_batch
+        producer.push_transis_detector_count_batch(batch, Mock())
+        summary = producer.push_transis_detector_count_batch(batch, Mock())
+        self.assertEqual(summary["duplicate_records"], 1)
+        self.assertEqual(summary["kinesis_records"], 0)
+        kinesis_client.put_records.assert_called_once()
+
+    def test_producer_drops_duplicates_within_one_push(self):
+        kinesis_client = Mock()
+        kinesis_client.put_records.return_value = {"FailedRecordCount": 0, "Records": [{"SequenceNumber": "1"}, {"SequenceNumber": "2"}]}
+        deduplicator = record_deduplication.DuplicateRecordFilter()
+        producer = KinesisProducer("ap-southeast-2", "stream", kinesis_client, deduplicator=deduplicator)
+        records = [{"siteId": site_id, "collectionendtimestamp_plus_3_mins": 300, "detectorCounts": {}} for site_id in ["1", "2", "1"]]
+        summary = producer.push_transis_detector_count_records(records, Mock())
+        self.assertEqual((summary["duplicate_records"], summary["kinesis_records"]), (1, 2))
+        self.assertEqual([r["PartitionKey"] for r in kinesis_client.put_records.call_args[1]["Records"]], ["1", "2"])
+        self.assertEqual(deduplicator.get_counters()["duplicate_keys"], 2)
+
+    def test_dropped_records_are_not_remembered_so_a_redelivery_is_sent(self):
+        kinesis_client = Mock()
+        kinesis_client.put_records.side_effect = [
+            {"FailedRecordCount": 1, "Records": [{"SequenceNumber": "1"}, {"ErrorCode": "InternalFailure", "ErrorMessage": "mock"}]},
+            {"FailedRecordCount": 0, "Records": [{"SequenceNumber": "2"}]}
+        ]
+        deduplicator = record_deduplication.DuplicateRecordFilter()
+        producer = KinesisProducer("ap-southeast-2", "stream", kinesis_client, deduplicator=deduplicator, retry_policy=kinesis_retry.RetryPolicy(max_attempts=1))
+        records = [{"siteId": str(i), "collectionendtimestamp_plus_3_mins": 300, "detectorCounts": {}} for i in range(2)]
+        producer.push_transis_detector_count_records(records, Mock())
+        summary = producer.push_transis_detector_count_records([dict(record) for record in records], Mock())
+        self.assertEqual((summary["duplicate_records"], summary["kinesis_records"]), (1, 1))
+        self.assertEqual(kinesis_client.put_records.call_args[1]["Records"][0]["PartitionKey"], "1")
+
+    def test_saves_from_many_threads_do_not_share_a_temporary_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            deduplicator = record_deduplication.DuplicateRecordFilter(persistence_path=os.path.join(directory, "sent.json"), persist_interval=0.001)
+            threads = [threading.Thread(target=deduplicator.filter_records, args=([{"siteId": str(i), "collectionendtimestamp_plus_3_mins": 300}],))
+                       for i in range(20)]
+            threads += [threading.Thread(target=deduplicator.save) for _ in range(20)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            deduplicator.close()
+            self.assertEqual(os.listdir(directory), ["sent.json"])
+            restarted = record_deduplication.DuplicateRecordFilter(persistence_path=os.path.join(directory, "sent.json"))
+            restarted.close()
+            self.assertEqual(restarted.get_counters()["duplicate_keys"], 20)
+
+
+class BackfillTests(unittest.TestCase):
+    def test_split_date_range_gives_windows_in_transis_date_format(self):
+        self.assertEqual(backfill.split_date_range("2019-10-03T00:00:00+10:00", "2019-10-03T02:30:00+10:00", 60), [
+            ("2019-10-03T00:00:00.000+10:00", "2019-10-03T01:00:00.000+10:00"),
+            ("2019-10-03T01:00:00.000+10:00", "2019-10-03T02:00:00.000+10:00"),
+            ("2019-10-03T02:00:00.000+10:00", "2019-10-03T02:30:00.000+10:00")
+        ])
+
+    def test_interrupted_backfill_resumes_from_the_checkpoint(self):
+        fetched = []
+        def get_raw_data_within_dates(types, start_date, end_date):
+            fetched.append(start_date)
+            if start_date.startswith("2019-10-03T01") and len(fetched) <= 3:
+                raise requests.exceptions.ConnectionError("mock connection error")
+            return generate_detector_count_document(["1", "2"], date=start_date[:19] + "+10:00") + b"\x00"
+        mocked_transis_consumer = Mock()
+        mocked_transis_consumer.get_raw_data_within_dates = get_raw_data_within_dates
+        mocked_transis_consumer.start_transis_http_session.side_effect = lambda: fetched.append("session")
+        mocked_kinesis_producer = Mock()
+        mocked_kinesis_producer.push_transis_detector_count_records.return_value = {"kinesis_records": 2}
+        with tempfile.TemporaryDirectory() as directory:
+            runner = backfill.Backfill(mocked_transis_consumer, mocked_kinesis_producer, Mock(), window_minutes=60, fetch_workers=2,
+                                       parse_workers=1, checkpoint_path=os.path.join(directory, "checkpoint.json"))
+            first_summary = runner.run("2019-10-03T00:00:00+10:00", "2019-10-03T03:00:00+10:00")
+            second_summary = runner.run("2019-10-03T00:00:00+10:00", "2019-10-03T03:00:00+10:00")
+        self.assertEqual((first_summary["completed_windows"], first_summary["failed_windows"]), (2, 1))
+        self.assertEqual((second_summary["completed_windows"], second_summary["skipped_windows"]), (1, 2))
+        self.assertEqual(fetched[0], "session")
+        self.assertEqual(fetched[4:], ["session", "2019-10-03T01:00:00.000+10:00"])
+        pushed = [call[0][0] for call in mocked_kinesis_producer.push_transis_detector_count_records.call_args_list]
+        self.assertEqual([r["siteId"] for r in pushed[0]], ["1", "2"])
+        self.assertEqual(len(pushed), 3)
+
+
+class BenchmarksTests(unittest.TestCase):
+    def test_workload_generator_documents_parse_and_are_repeatable(self):
+        workload = benchmarks.WorkloadGenerator(sites=20, detectors_per_site=8, documents_per_stream=3, seed=7)
+        documents = list(TransisStreamFramer().frame(iter([workload.detector_count_stream()])))
+        self.assertEqual(len(documents), 3)
+        self.assertEqual(documents[0], benchmarks.WorkloadGenerator(sites=20, detectors_per_site=8, seed=7).detector_count_document(0))
+        records = [m.to_dict() for m in transis_response_models.TransisResponse(documents[1]).detector_count_messages.detector_count_message_list]
+        self.assertEqual(len(records), 20)
+        self.assertTrue(all(4 <= len(r["detectorCounts"]) <= 8 for r in records))
+        self.assertEqual(records[0]["collectionendtimestamp_plus_3_mins"] - 300,
+                         utils.get_epoc_from_timestamp_string("2019-10-03T15:43:00+10:00"))
+        site_layouts = transis_response_models.TransisResponse(workload.topology_document()).site_layouts
+        self.assertEqual(site_layouts.get_num_sites(), 20)
+        self.assertEqual(site_layouts.get_csv_string("detectors").count("\n"), 1 + sum(workload.site_detectors))
+
+    def test_percentiles_interpolate_between_samples(self):
+        self.assertEqual(benchmarks.percentile([4, 1, 3, 2], 50), 2.5)
+        self.assertEqual(benchmarks.percentile([1, 2, 3, 4, 5], 90), 4.6)
+        self.assertEqual(benchmarks.percentile([3], 99), 3)
+        self.assertIsNone(benchmarks.tail_percentile([1, 2, 3, 4, 5], 99))
+        self.assertIsNone(benchmarks.tail_percentile(list(range(99)), 99))
+        self.assertEqual(benchmarks.tail_percentile(list(range(100)), 99), 98.01)
+        self.assertEqual(benchmarks.tail_percentile(list(range(10)), 90), 8.1)
+
+    def test_workload_counts_peak_at_midday(self):
+        workload = benchmarks.WorkloadGenerator(sites=50, detectors_per_site=8, start_date="2019-10-03T00:00:00+10:00")
+        def mean_count(index):
+            records = [m.to_dict() for m in transis_response_models.TransisResponse(workload.detector_count_document(index)).detector_count_messages.detector_count_message_list]
+            counts = [int(c) for r in records for c in r["detectorCounts"].values()]
+            return sum(counts) / len(counts)
+        self.assertGreater(mean_count(12 * 12), 2 * mean_count(0))
+
+
+class LoadTestTests(unittest.TestCase):
+    def test_throttling_kinesis_client_enforces_the_shard_record_limit(self):
+        kinesis_client = load_test.ThrottlingKinesisClient(num_shards=2, records_per_second=10)
+        response = kinesis_client.put_records(Records=[{"PartitionKey": str(i), "Data": b"x"} for i in range(100)], StreamName="load-test")
+        self.assertEqual(response["FailedRecordCount"], 80)
+        self.assertEqual({r["ShardId"] for r in response["Records"] if "ShardId" in r}, {"shardId-000000000000", "shardId-000000000001"})
+        self.assertTrue(all(r["ErrorCode"] == "ProvisionedThroughputExceededException" for r in response["Records"] if "ErrorCode" in r))
+        shards = kinesis_producer.describe_open_shards(kinesis_client, "load-test")
+        self.assertEqual([s["EndingHashKey"] for s in shards], [2**127 - 1, 2**128 - 1])
+
+    def test_connector_sends_every_record_of_the_stand_in_stream(self):
+        workload = benchmarks.WorkloadGenerator(sites=30, detectors_per_site=4, documents_per_stream=3)
+        summary = load_test.run_load_test(workload, documents_per_second=20, report_interval=1, timeout=20)
+        self.assertEqual((summary["documents_sent"], summary["records_accepted"]), (3, 90))
+        self.assertIn("lag_p99_seconds", summary)
+        self.assertTrue(summary["connector_stopped"])
+
+
+class MetricsTests(unittest.TestCase):
+    def test_registry_exposes_prometheus_text_and_summaries(self):
+        registry = metrics.Registry()
+        records = registry.counter("records_total", "Records", ("result",))
+        latency = registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1))
+        records.labels("sent").inc(3)
+        latency.observe(0.05)
+        latency.observe(0.5, count=2)
+        self.assertIn('records_total{result="sent"} 3\n', registry.expose())
+        self.assertIn('latency_seconds_bucket{le="1.0"} 3\nlatency_seconds_bucket{le="+Inf"} 3\nlatency_seconds_sum 1.05\nlatency_seconds_count 3\n',
+                      registry.expose())
+        self.assertEqual(registry.summarise()["latency_seconds"]["p50"], 1)
+        server = metrics.start_http_server(0, "127.0.0.1", registry)
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{server.server_address[1]}/metrics") as response:
+                self.assertEqual(response.read().decode("utf-8"), registry.expose())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_producer_records_put_records_results_and_freshness(self):
+        kinesis_client = load_test.ThrottlingKinesisClient(records_per_second=3)
+        producer = KinesisProducer("region_name","stream_name",kinesis_client,retry_policy=kinesis_retry.RetryPolicy(max_attempts=1))
+        sent = metrics.KINESIS_RECORDS.labels("sent").value
+        throttled = metrics.KINESIS_RECORDS.labels("throttled").value
+        dropped = metrics.KINESIS_RECORDS.labels("dropped").value
+        freshness_count = sum(metrics.FRESHNESS_LAG_SECONDS.snapshot()[0])
+        records = [{"siteId": str(i), "collectionendtimestamp_plus_3_mins": int(time.time()) - 60} for i in range(5)]
+        producer.push_transis_detector_count_records(records, Mock())
+        self.assertEqual(metrics.KINESIS_RECORDS.labels("sent").value - sent, 3)
+        self.assertEqual(metrics.KINESIS_RECORDS.labels("throttled").value - throttled, 2)
+        self.assertEqual(metrics.KINESIS_RECORDS.labels("dropped").value - dropped, 2)
+        self.assertEqual(sum(metrics.FRESHNESS_LAG_SECONDS.snapshot()[0]) - freshness_count, 3)
+
+    def test_acknowledged_aggregated_records_are_observed_without_decoding_their_data(self):
+        mocked_kinesis_client = Mock()
+        mocked_kinesis_client.put_records.return_value = {"FailedRecordCount": 0, "Records": [{"SequenceNumber": "1"}]}
+        aggregator = kinesis_aggregation.RecordAggregator(shards=[{"ShardId": "shardId-0", "StartingHashKey": 0, "EndingHashKey": 2**128 - 1}])
+        deduplicator = record_deduplication.DuplicateRecordFilter()
+        producer = KinesisProducer("region_name","stream_name",mocked_kinesis_client,aggregator=aggregator,deduplicator=deduplicator,compression="gzip")
+        freshness_count = sum(metrics.FRESHNESS_LAG_SECONDS.snapshot()[0])
+        records = [{"siteId": str(i), "collectionendtimestamp_plus_3_mins": int(time.time()) - 60, "detectorCounts": {}} for i in range(20)]
+        with patch.object(record_codecs, "decode_kinesis_data", side_effect=AssertionError("decoded")):
+            producer.push_transis_detector_count_records(records, Mock())
+        self.assertEqual(len(mocked_kinesis_client.put_records.call_args[1]["Records"]), 1)
+        self.assertEqual(sum(metrics.FRESHNESS_LAG_SECONDS.snapshot()[0]) - freshness_count, 20)
+        self.assertEqual(deduplicator.get_counters()["duplicate_keys"], 20)
+
+
+class UtilsTests(unittest.TestCase):
+    def test_get_epoc_from_timestamp_string_matches_strptime(self):
+        for timestamp in ["2019-10-03T15:43:00+10:00", "2019-04-07T02:30:00+11:00", "2020-02-29T23:59:59-03:30", "2019-10-03T05:43:00Z"]:
+            self.assertEqual(utils.get_epoc_from_timestamp_string(timestamp), utils.parse_epoc_with_strptime(timestamp))
+
+    def test_get_epoc_from_timestamp_string_falls_back_to_strptime(self):
+        self.assertIsNone(utils.parse_iso_8601_epoc("2019-10-03T15:43:00+1000"))
+        self.assertEqual(utils.get_epoc_from_timestamp_string("2019-10-03T15:43:00+1000"), 1570081380)
+        with self.assertRaises(ValueError):
+            utils.get_epoc_from_timestamp_string("2019-13-03T15:43:00+10:00")
+
+    def test_get_epoc_from_timestamp_string_rejects_what_strptime_rejects(self):
+        for timestamp in ["2019-10-03T15:43:00+99:99", "2019-10-03T15:43:00+24:00", "2019-10-03T15:43:00+10:60", "1_19-10-03T15:43:00+10:00",
+                          "2019-1_-03T15:43:00+10:00", "2019-10-03T15:4_:00+10:00", "2019-10-03T15:43:00+1_:00", "2019-10-03T15:43:00+-1:00",
+                          "2019-10-03T15:43:\u0661\u0662+10:00"]:
+            self.assertIsNone(utils.parse_iso_8601_epoc(timestamp), timestamp)
+            with self.assertRaises(ValueError):
+                utils.parse_epoc_with_strptime(timestamp)
+            with self.assertRaises(ValueError):
+                utils.get_epoc_from_timestamp_string(timestamp)
+
+    def test_get_epoc_from_timestamp_string_is_cached(self):
+        utils.get_epoc_from_timestamp_string.cache_clear()
+        for _ in range(100):
+            utils.get_epoc_from_timestamp_string("2019-10-03T15:43:00+10:00")
+        self.assertEqual(utils.get_epoc_from_timestamp_string.cache_info().hits, 99)
+
+def generate_detector_count_document(site_ids, date="2019-10-03T15:43:00+10:00", region="ROZ", num_detectors=24, error=False):
+    """Returns a transis DetectorCount xml document as bytes with one DetectorCountMessage per site id"""
+    messages = []
+    for site_id in site_ids:
+        detectors = "".join(f'<Detector Did="{d}" count="{d % 7}"/>' for d in range(1, num_detectors + 1))
+        messages.append(f'<ns2:DetectorCountMessage Sid="{site_id}" date="{date}" reg="{region}"><Detectors>{detectors}</Detectors></ns2:DetectorCountMessage>')
+    errors = '<Errors><Error msg="mock error message"/></Errors>' if error else ''
+    return (f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?><ns2:TransisResponse error="{str(error).lower()}" xmlns:ns2="http://model.transis.rta.nsw.gov.au/">'
+            f'{errors}<DetectorCountMessages>{"".join(messages)}</DetectorCountMessages></ns2:TransisResponse>').encode("utf-8")
+
+def generate_topology_response(site_layouts):
+    """Returns a TransisResponse with a SiteLayouts element holding the given SiteLayout xml"""
+    return transis_response_models.TransisResponse(
+        ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?><ns2:TransisResponse error="false" xmlns:ns2="http://model.transis.rta.nsw.gov.au/">'
+         f'<SiteLayouts>{site_layouts}</SiteLayouts></ns2:TransisResponse>').encode("utf-8"))
+
+def mock_shard(shard_id, starting_hash_key, ending_hash_key, closed=False):
+    """Returns a shard as it is described by the boto3.client.Kinesis describe_stream() method"""
+    sequence_number_range = {"StartingSequenceNumber": "1"}
+    if closed:
+        sequence_number_range["EndingSequenceNumber"] = "2"
+    return {"ShardId": shard_id, "HashKeyRange": {"StartingHashKey": str(starting_hash_key), "EndingHashKey": str(ending_hash_key)}, "SequenceNumberRange": sequence_number_range}
+
+def chunked_http_response(chunks):
+    """Returns a 200 HTTP response with the chunks sent using chunked transfer encoding"""
+    body = b"".join(b"%x\r\n%s\r\n" % (len(chunk), chunk) for chunk in chunks)
+    return b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n" + body + b"0\r\n\r\n"
+
+async def start_transis_stand_in(responses, username="user", password="password"):
+    """Starts a local asyncio server that stands in for transis
+
+    Arguments:
+        responses {dict} -- the raw HTTP response bytes, or a coroutine function that writes to the stream writer, for each request path
+    Returns:
+        {tuple} -- the asyncio server and a TransisConsumer connected to it
+    """
+    authorization = b"Authorization: Basic " + base64.b64encode(f"{username}:{password}".encode("utf-8"))
+    async def handle(reader, writer):
+        request = await reader.readuntil(b"\r\n\r\n")
+        path = request.split(b" ")[1].split(b"?")[0].decode("utf-8")
+        response = responses.get(path, b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\n\r\n")
+        if authorization not in request:
+            response = b"HTTP/1.1 401 Unauthorized\r\nContent-Length: 0\r\n\r\n"
+        if callable(response):
+            await response(writer)
+        else:
+            writer.write(response)
+        await writer.drain()
+        writer.close()
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    return server, TransisConsumer({"hostname": "127.0.0.1", "port": port, "username": username, "password": password})
 
 def mock_iter_content(byte_string,chunk_size=1):
     """A mock of the requests.Response.iter_content used in transis_consumer to read the stream in get_detector_counts()"""
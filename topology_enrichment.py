@@ -0,0 +1,173 @@
+r"""
+topology_enrichment.py adds the topology of each detector to detector count records, so consumers of the kinesis stream do not have
+to join the counts against the topology themselves.
+
+A DetectorLookup is a read only hash index of sId -> Did -> detector attributes (with the attributes of the detector's arm). The
+TopologyEnricher holds one lookup at a time and replaces it with a single reference assignment when the topology changes, so
+records that are being enriched are never blocked by a refresh.
+"""
+import logging
+import threading
+
+log = logging.getLogger(__name__)
+
+# The attribute of a SiteLayout's Detector element holding the detector number that the Did of a DetectorCount refers to
+DETECTOR_ID_ATTRIBUTE = "dId"
+
+class DetectorLookup:
+    """A read only index of the topology of every detector, keyed by site id and detector id.
+
+    Detectors are keyed by their DETECTOR_ID_ATTRIBUTE, detectors without one are left out. A detector is joined to the arm of its site
+    whose own id attribute, the first attribute of the Arm ending in Id or No other than the site's sId, the detector has with the
+    same value, such as an arm number.
+
+    Attributes:
+        version (int): the version of the topology the lookup was built from, None if it was not built from a topology
+    """
+    def __init__(self, detectors, arms=None, version=0):
+        """
+        Arguments:
+            detectors {dict} -- site id to a list of the attribute Dicts of its detectors
+        Keyword Arguments:
+            arms {dict} -- site id to a list of the attribute Dicts of its arms (default: {None})
+            version {int} -- the version of the topology (default: {0})
+        """
+        self.version = version
+        self.__sites = {}
+        arms = arms or {}
+        for site_id, site_detectors in detectors.items():
+            site_arms = self.__index_arms(arms.get(site_id, []))
+            site_lookup = {}
+            for detector in site_detectors:
+                detector_id = detector.get(DETECTOR_ID_ATTRIBUTE)
+                if detector_id is None:
+                    continue
+                detector_topology = dict(detector)
+                arm = self.__find_arm(detector, site_arms)
+                if arm is not None:
+                    detector_topology["arm"] = arm
+                site_lookup[str(detector_id)] = detector_topology
+            self.__sites[str(site_id)] = site_lookup
+
+    @staticmethod
+    def __index_arms(site_arms):
+        """Returns a Dict of (id attribute, value) to each arm that has an id attribute"""
+        arms_by_id = {}
+        for arm in site_arms:
+            for attribute, value in arm.items():
+                if attribute != "sId" and attribute.lower().endswith(("id", "no")):
+                    arms_by_id.setdefault((attribute, value), arm)
+                    break
+        return arms_by_id
+
+    @staticmethod
+    def __find_arm(detector, arms_by_id):
+        for attribute_value in detector.items():
+            arm = arms_by_id.get(attribute_value)
+            if arm is not None:
+                return arm
+        return None
+
+    @classmethod
+    def from_site_layouts(cls, site_layouts, version=0):
+        """Returns a DetectorLookup built from a transis_response_models.SiteLayouts"""
+        detectors, arms = {}, {}
+        for site_element in site_layouts.root:
+            site_id = site_element.get("sId")
+            for subcomponent_element in site_element:
+                if subcomponent_element.tag == "Detectors":
+                    detectors[site_id] = [dict(e.attrib) for e in subcomponent_element]
+                elif subcomponent_element.tag == "Arms":
+                    arms[site_id] = [dict(e.attrib) for e in subcomponent_element]
+        return cls(detectors, arms, version)
+
+    @classmethod
+    def from_topology_index(cls, topology_index):
+        """Returns a DetectorLookup built from a topology_index.TopologyIndex"""
+        version = topology_index.version
+        return cls(topology_index.get_all_components("detectors"), topology_index.get_all_components("arms"), version)
+
+    def get_site(self, site_id):
+        """Returns a Dict of detector id to detector topology for a site, None if the site is not in the lookup"""
+        return self.__sites.get(site_id)
+
+    def __len__(self):
+        return len(self.__sites)
+
+
+class TopologyEnricher:
+    """Adds the topology of each detector in a detector count record under the detectorTopology field.
+
+    Attributes:
+        lookup (DetectorLookup): the lookup records are enriched from, replaced as a whole by swap()
+        field  (str)           : the record field the topology is added under
+        enriched_records (int) : records that had at least one detector enriched
+        unknown_sites    (int) : records whose site was not in the lookup
+    """
+    def __init__(self, lookup=None, field="detectorTopology"):
+        self.lookup = lookup if lookup is not None else DetectorLookup({}, version=None)
+        self.field = field
+        self.enriched_records = 0
+        self.unknown_sites = 0
+        self.__counters_lock = threading.Lock()
+        self.__stop_refresh = threading.Event()
+
+    def swap(self, lookup):
+        """Replaces the lookup, records enriched after this call use the new lookup"""
+        self.lookup = lookup
+        log.info(f"Detector topology lookup swapped to version {lookup.version} with {len(lookup)} sites")
+
+    def enrich(self, record):
+        """Adds the topology of the record's detectors to the record Dict and returns it"""
+        return self.enrich_records([record])[0]
+
+    def enrich_records(self, records):
+        """Enriches a list of record Dicts in place and returns it, every record is enriched from the same lookup"""
+        lookup = self.lookup
+        enriched_records = unknown_sites = 0
+        for record in records:
+            site = lookup.get_site(record["siteId"])
+            if site is None:
+                unknown_sites += 1
+                continue
+            detector_topology = {}
+            for detector_id in record["detectorCounts"]:
+                topology = site.get(detector_id)
+                if topology is not None:
+                    detector_topology[detector_id] = topology
+            record[self.field] = detector_topology
+            if detector_topology:
+                enriched_records += 1
+        with self.__counters_lock:
+            self.enriched_records += enriched_records
+            self.unknown_sites += unknown_sites
+        return records
+
+    def refresh(self, topology_index, transis_consumer):
+        """Refreshes the topology index and swaps in a new lookup if the topology has changed
+
+        Returns:
+            {bool} -- True if the lookup was swapped
+        """
+        topology_index.refresh(transis_consumer)
+        if topology_index.version == self.lookup.version:
+            return False
+        self.swap(DetectorLookup.from_topology_index(topology_index))
+        return True
+
+    def start_refreshing(self, topology_index, transis_consumer, interval=3600):
+        """Starts a daemon thread that calls refresh() every interval seconds until stop_refreshing() is called"""
+        def refresh_periodically():
+            while not self.__stop_refresh.wait(interval):
+                try:
+                    self.refresh(topology_index, transis_consumer)
+                except Exception as e:
+                    log.error(f"Could not refresh the topology, records will be enriched with version {self.lookup.version}: {e}")
+        self.__stop_refresh.clear()
+        thread = threading.Thread(target=refresh_periodically, name="topology-refresh", daemon=True)
+        thread.start()
+        return thread
+
+    def stop_refreshing(self):
+        """Stops the thread started by start_refreshing()"""
+        self.__stop_refresh.set()
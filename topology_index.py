@@ -0,0 +1,217 @@
+r"""
+topology_index.py keeps the transis network topology in a SQLite file so it does not have to be downloaded and parsed at every start.
+
+The index is loaded from getCurrentTopology the first time, after that it is refreshed with the changes from getTopologyChangesFromDate
+since the last sync. The changes feed only has the sites that were added or changed, so once full_refresh_interval seconds have
+passed since the last full load the whole topology is loaded again, removing the sites that have left the network. The version
+stamp is incremented whenever a refresh changes a site, so consumers can tell when to reload.
+"""
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+import zlib
+import xml.etree.ElementTree as ET
+import utils
+from transis_response_models import SiteLayout, SITE_LAYOUT_CSV_SUBCOMPONENTS
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS sites (site_id TEXT PRIMARY KEY, attributes TEXT NOT NULL, layout BLOB NOT NULL, digest BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS components (
+    site_id TEXT NOT NULL, kind TEXT NOT NULL, position INTEGER NOT NULL, component_id TEXT NOT NULL, attributes TEXT NOT NULL,
+    PRIMARY KEY (site_id, kind, position)
+);
+CREATE INDEX IF NOT EXISTS components_by_id ON components (kind, site_id, component_id);
+"""
+
+def get_component_id(element, position):
+    """Returns the id of a site subcomponent, the value of its first attribute ending in Id or No, otherwise its position in the site"""
+    for attribute, value in element.attrib.items():
+        if attribute.lower().endswith(("id", "no")):
+            return value
+    return str(position)
+
+
+class TopologyIndex:
+    """A persistent index of the SiteLayouts of the network keyed by site id, with lookups of their arms, detectors and signal groups.
+
+    Attributes:
+        path                  (str)  : the SQLite file, ":memory:" for an index that is not kept
+        full_refresh_interval (float): seconds after a full load of the topology that the next refresh loads it all again
+        version               (int)  : incremented every time the sites in the index change, 0 for an empty index
+        last_sync             (str)  : the transis timestamp that the next refresh will request changes from, None if it has never been loaded
+    """
+    def __init__(self, path, full_refresh_interval=24*60*60):
+        self.path = path
+        self.full_refresh_interval = full_refresh_interval
+        self.__connection = sqlite3.connect(path, check_same_thread=False)
+        self.__lock = threading.Lock()
+        with self.__lock, self.__connection:
+            self.__connection.executescript(SCHEMA)
+
+    def __get_metadata(self, key):
+        row = self.__connection.execute("SELECT value FROM metadata WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    @property
+    def version(self):
+        with self.__lock:
+            return int(self.__get_metadata("version") or 0)
+
+    @property
+    def last_sync(self):
+        with self.__lock:
+            return self.__get_metadata("last_sync")
+
+    @property
+    def last_full_sync(self):
+        """The unix time of the last full load of the topology, None if it has never been loaded"""
+        with self.__lock:
+            last_full_sync = self.__get_metadata("last_full_sync")
+        return float(last_full_sync) if last_full_sync is not None else None
+
+    def refresh(self, transis_consumer):
+        """Loads the whole topology if the index has never been synced or full_refresh_interval has passed since it was last loaded,
+        otherwise applies the changes since the last sync
+
+        Arguments:
+            transis_consumer {TransisConsumer} -- used to request the topology from transis
+        Returns:
+            {int} -- the number of sites that were added, changed or removed
+        """
+        sync_timestamp = utils.get_formatted_current_timestamp()
+        last_sync = self.last_sync
+        last_full_sync = self.last_full_sync
+        if last_sync is None or last_full_sync is None or time.time() - last_full_sync >= self.full_refresh_interval:
+            log.info("Loading the whole topology into the topology index")
+            return self.apply_site_layouts(transis_consumer.get_current_topology().site_layouts, sync_timestamp, full_topology=True)
+        log.info(f"Refreshing the topology index with the changes since {last_sync}")
+        changes = [transis_response.site_layouts for transis_response in transis_consumer.iter_topology_changes_from(last_sync)]
+        return self.apply_site_layouts(changes, sync_timestamp)
+
+    def apply_site_layouts(self, site_layouts, sync_timestamp, full_topology=False):
+        """Adds or replaces the sites in a SiteLayouts, sites whose layout has not changed are left as they are
+
+        Arguments:
+            site_layouts {transis_response_models.SiteLayouts} -- the sites to apply, None if there are no changes, or a list of
+                                                                 them that are applied in order and in one transaction
+            sync_timestamp {str} -- the transis timestamp the sites are up to date to
+        Keyword Arguments:
+            full_topology {bool} -- the SiteLayouts is the whole network, sites that are not in it are removed (default: {False})
+        Returns:
+            {int} -- the number of sites that were added, changed or removed
+        """
+        if not isinstance(site_layouts, list):
+            site_layouts = [site_layouts]
+        site_elements = [site_element for layouts in site_layouts if layouts for site_element in layouts.root]
+        changed_sites = 0
+        with self.__lock, self.__connection:
+            digests = dict(self.__connection.execute("SELECT site_id, digest FROM sites"))
+            for site_element in site_elements:
+                site_id = site_element.get("sId")
+                layout = ET.tostring(site_element)
+                digest = hashlib.blake2b(layout, digest_size=16).digest()
+                if digests.pop(site_id, None) == digest:
+                    continue
+                self.__write_site(site_id, site_element, layout, digest)
+                changed_sites += 1
+            if full_topology and digests:
+                self.__connection.executemany("DELETE FROM sites WHERE site_id = ?", [(site_id,) for site_id in digests])
+                self.__connection.executemany("DELETE FROM components WHERE site_id = ?", [(site_id,) for site_id in digests])
+                changed_sites += len(digests)
+            if changed_sites:
+                version = int(self.__get_metadata("version") or 0) + 1
+                self.__connection.execute("INSERT OR REPLACE INTO metadata VALUES ('version', ?)", (str(version),))
+            self.__connection.execute("INSERT OR REPLACE INTO metadata VALUES ('last_sync', ?)", (sync_timestamp,))
+            if full_topology:
+                self.__connection.execute("INSERT OR REPLACE INTO metadata VALUES ('last_full_sync', ?)", (str(time.time()),))
+        if changed_sites:
+            log.info(f"{changed_sites} sites changed in the topology index, it is now version {version}")
+        return changed_sites
+
+    def __write_site(self, site_id, site_element, layout, digest):
+        self.__connection.execute("INSERT OR REPLACE INTO sites VALUES (?, ?, ?, ?)",
+                                  (site_id, json.dumps(dict(site_element.attrib)), zlib.compress(layout), digest))
+        self.__connection.execute("DELETE FROM components WHERE site_id = ?", (site_id,))
+        components = []
+        for subcomponent_element in site_element:
+            kind = SITE_LAYOUT_CSV_SUBCOMPONENTS.get(subcomponent_element.tag)
+            if kind is None:
+                continue
+            for position, element in enumerate(subcomponent_element):
+                components.append((site_id, kind, position, get_component_id(element, position), json.dumps(dict(element.attrib))))
+        self.__connection.executemany("INSERT INTO components VALUES (?, ?, ?, ?, ?)", components)
+
+    def get_site_ids(self):
+        """Returns the id of every site in the index"""
+        with self.__lock:
+            return [row[0] for row in self.__connection.execute("SELECT site_id FROM sites ORDER BY site_id")]
+
+    def get_site(self, site_id):
+        """Returns the attributes of a site as a Dict, None if it is not in the index"""
+        with self.__lock:
+            row = self.__connection.execute("SELECT attributes FROM sites WHERE site_id = ?", (str(site_id),)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_site_layout(self, site_id):
+        """Returns the SiteLayout of a site, None if it is not in the index"""
+        with self.__lock:
+            row = self.__connection.execute("SELECT layout FROM sites WHERE site_id = ?", (str(site_id),)).fetchone()
+        return SiteLayout(ET.fromstring(zlib.decompress(row[0]))) if row else None
+
+    def get_components(self, kind, site_id):
+        """Returns the attributes of each arm, detector, street, SG or phase of a site in the order they are in the layout
+
+        Arguments:
+            kind {str} -- one of "arms", "detectors", "streets", "sgs" or "phases"
+            site_id {str} -- the sId of the site
+        """
+        with self.__lock:
+            rows = self.__connection.execute("SELECT attributes FROM components WHERE site_id = ? AND kind = ? ORDER BY position",
+                                             (str(site_id), kind)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def get_all_components(self, kind):
+        """Returns a Dict of every site id to the attributes of its arms, detectors, streets, SGs or phases, see get_components()"""
+        components = {}
+        with self.__lock:
+            rows = self.__connection.execute("SELECT site_id, attributes FROM components WHERE kind = ? ORDER BY site_id, position",
+                                             (kind,)).fetchall()
+        for site_id, attributes in rows:
+            components.setdefault(site_id, []).append(json.loads(attributes))
+        return components
+
+    def get_component(self, kind, site_id, component_id):
+        """Returns the attributes of one arm, detector, street, SG or phase of a site, None if it is not in the index"""
+        with self.__lock:
+            row = self.__connection.execute("SELECT attributes FROM components WHERE kind = ? AND site_id = ? AND component_id = ?",
+                                            (kind, str(site_id), str(component_id))).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get_detectors(self, site_id):
+        return self.get_components("detectors", site_id)
+
+    def get_detector(self, site_id, detector_id):
+        return self.get_component("detectors", site_id, detector_id)
+
+    def get_arms(self, site_id):
+        return self.get_components("arms", site_id)
+
+    def get_arm(self, site_id, arm_id):
+        return self.get_component("arms", site_id, arm_id)
+
+    def get_sgs(self, site_id):
+        return self.get_components("sgs", site_id)
+
+    def get_sg(self, site_id, sg_id):
+        return self.get_component("sgs", site_id, sg_id)
+
+    def close(self):
+        """Closes the SQLite connection"""
+        with self.__lock:
+            self.__connection.close()
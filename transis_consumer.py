@@ -4,16 +4,92 @@ transis_consumer.py is responsible for managing the connection with and recievin
 
 import requests
 import logging
-from transis_response_models import TransisResponse
+import threading
+import metrics
+from transis_response_models import TransisResponse, DetectorCountStreamParser, DetectorCountDocumentEnd, DetectorCountStreamReset
 log = logging.getLogger(__name__)
 
+class TransisStreamFramer:
+    """Splits a byte stream of null byte delimited transis xml documents into complete documents.
+
+    Chunks are appended to a single reusable buffer and scanned for the delimiter, only the bytes after the scan
+    position are searched again so each byte is inspected once no matter how the stream is chunked.
+
+    Attributes:
+        max_document_size (int)  : the largest document in bytes that will be buffered before an exception is raised
+        delimiter         (bytes): the byte that transis uses to denote the end of a xml document
+    """
+
+    def __init__(self, max_document_size=256*1024*1024, delimiter=b"\x00"):
+        self.max_document_size = max_document_size
+        self.delimiter = delimiter
+        self.__buffer = bytearray()
+        self.__scan_position = 0
+
+    def feed(self, chunk):
+        """Adds a chunk of the stream to the buffer and returns the documents that it completed
+
+        Arguments:
+            chunk {bytes} -- the next part of the stream
+        Returns:
+            {list} -- the complete documents as bytes, empty documents are skipped
+        """
+        documents = []
+        if not chunk:
+            return documents
+        metrics.TRANSIS_BYTES_RECEIVED.inc(len(chunk))
+        buffer = self.__buffer
+        buffer += chunk
+        document_start = 0
+        end = buffer.find(self.delimiter, self.__scan_position)
+        if end != -1:
+            with memoryview(buffer) as view:
+                while end != -1:
+                    if end > document_start:
+                        documents.append(bytes(view[document_start:end]))
+                    document_start = end + 1
+                    end = buffer.find(self.delimiter, document_start)
+            del buffer[:document_start]
+            metrics.TRANSIS_DOCUMENTS_FRAMED.inc(len(documents))
+        self.__scan_position = len(buffer)
+        if len(buffer) > self.max_document_size:
+            self.reset()
+            raise Exception(f"A transis document exceeded the maximum document size of {self.max_document_size} bytes without a null byte terminator.")
+        return documents
+
+    def frame(self, chunks):
+        """Generator to yield every complete document in an iterable of chunks
+
+        Arguments:
+            chunks {iterable} -- the chunks of the stream e.g. requests.Response.iter_content()
+        Yields:
+            {bytes} -- a complete xml document without the null byte terminator
+        """
+        for chunk in chunks:
+            for document in self.feed(chunk):
+                yield document
+
+    def buffered_bytes(self):
+        """Returns the number of bytes of the incomplete document that is being buffered"""
+        return len(self.__buffer)
+
+    def reset(self):
+        """Discards any partially received document"""
+        self.__buffer = bytearray()
+        self.__scan_position = 0
+
 class TransisConsumer:
     """Represents the connector to Transis. Can create a connection and request streams of data"""
     
-    def __init__(self,connection_details,stream_timeout=20*60, max_transis_reconnects=3):
+    def __init__(self,connection_details,stream_timeout=20*60, max_transis_reconnects=3, stream_chunk_size=64*1024, max_document_size=256*1024*1024, keep_byte_string=False):
         self.connection_details = connection_details
         self.stream_timeout = stream_timeout
+        self.stream_chunk_size = stream_chunk_size
+        self.max_document_size = max_document_size
+        self.keep_byte_string = keep_byte_string
         self.set_max_transis_reconnects(max_transis_reconnects)
+        self.__stopped = threading.Event()
+        self.__stream = None
 
         domain  = "http://{hostname}:{port}/transis".format(hostname=self.connection_details["hostname"],port=self.connection_details["port"])
         # self.endpoints = {
@@ -43,9 +119,24 @@ class TransisConsumer:
         self.__max_reconnects = max_reconnects
         self.__reconnect_attempts_remaining = max_reconnects
 
+    @property
+    def max_transis_reconnects(self):
+        """The most times the stream is reconnected without recieving a document, see set_max_transis_reconnects()"""
+        return self.__max_reconnects
+
     def __reset_connection_attempt_counts(self):
         self.__reconnect_attempts_remaining = self.__max_reconnects          
 
+    def stop(self):
+        """Stops the detector count stream, the stream generators return instead of reconnecting and the open stream is closed"""
+        self.__stopped.set()
+        if self.__stream is not None:
+            self.__stream.close()
+
+    def __open_detector_count_stream(self):
+        self.__stream = self.__get_http_response("streamDetectorCount",stream=True)
+        return self.__stream
+
     def get_transis_detector_count_stream(self):
         """Returns the detector count stream from Transis 
         
@@ -79,14 +170,37 @@ class TransisConsumer:
         body = response.content.rstrip(b"\x00")
         return TransisResponse(body)
 
-    def __get_transis_responses(self, response):
-        """[summary]
-        
+    def iter_transis_responses(self, endpoint, **kwarg):
+        """Generator to yield a TransisResponse for each document of a REST endpoint as it is downloaded
+
+        The body is read in chunks with stream=True and split into documents by the framer, so only one document is held in memory
+        at a time. The connection is closed when the generator is closed, even if the body has not been read to the end.
+
         Arguments:
-            endpoint {[type]} -- [description]
+            endpoint {str} -- name of the endpoint in self.endpoints e.g. getFromDate
+            kwarg -- the query string paramaters of the request
+        Yields:
+            {transis_response_models.TransisResponse} -- each document in the body
         """
-        responses = response.content.split(b"\x00")
-        return [TransisResponse(r) for r in responses if r != b""]  
+        response = self.__get_http_response(endpoint,stream=True,**kwarg)
+        framer = TransisStreamFramer(max_document_size=self.max_document_size)
+        try:
+            for transis_response_byte_string in framer.frame(response.iter_content(chunk_size=self.stream_chunk_size)):
+                yield TransisResponse(transis_response_byte_string)
+            for transis_response_byte_string in framer.feed(b"\x00"):
+                yield TransisResponse(transis_response_byte_string)
+        finally:
+            response.close()
+
+    def __get_first_transis_response(self, endpoint, **kwarg):
+        """Returns the first document of a REST endpoint without downloading or parsing the rest of the body"""
+        responses = self.iter_transis_responses(endpoint, **kwarg)
+        try:
+            for transis_response in responses:
+                return transis_response
+        finally:
+            responses.close()
+        raise Exception(f"Transis did not return any documents from {endpoint}")
 
     def __get_http_response(self,endpoint,stream,**kwarg):
         """Returns the requests.Response object from a call to transis
@@ -120,39 +234,108 @@ class TransisConsumer:
         Yields:
             {transis_response_models.TransisResponse} -- Transis responses that have a a detector count messages
         """        
-        byte_string = b""
-        stream = self.__get_http_response("streamDetectorCount",stream=True)
+        for transis_response_byte_string in self.get_detector_count_documents():
+            transis_response = self.parse_detector_count_document(transis_response_byte_string)
+            if transis_response:
+                yield transis_response
+
+    def parse_detector_count_document(self, transis_response_byte_string):
+        """Returns the TransisResponse of a detector count document, or None if it does not have any detector count messages
+        
+        Arguments:
+            transis_response_byte_string {bytes} -- one xml document from the detector count stream
+        Raises:
+            Exception -- if transis has responded with an error
+        """
+        try:
+            with metrics.TRANSIS_PARSE_SECONDS.time():
+                transis_response = TransisResponse(transis_response_byte_string, keep_byte_string=self.keep_byte_string)
+            err_msg = transis_response.is_error()
+        except Exception as e:
+            log.error(f"An error occured when processing the transis detector counts stream:  {e}")
+            raise e
+        if(err_msg):
+            log.error(f"An error occured when processing the transis detector counts stream:  {err_msg}")
+            raise Exception(err_msg)
+        elif(transis_response.has_detector_count_messages()):
+            return transis_response
+        return None
+
+    def get_detector_count_documents(self):
+        """Generater to yield each raw xml document from the detector count stream, will try to reconnect to transis if there is no data recieved before the timeout is over.
+
+        Yields:
+            {bytes} -- a complete xml document without the null byte terminator
+        """
+        if self.__stopped.is_set():
+            return
+        stream = self.__open_detector_count_stream()
+        framer = TransisStreamFramer(max_document_size=self.max_document_size)
         try:
             log.info("Waiting for detector count stream to recieve data, this may take around 10 minutes.")
-            for chunk in stream.iter_content(chunk_size=1):
-                if chunk and chunk!=b'\x00': # null byte denotes end of xml document.
-                    byte_string+=chunk
-                elif chunk==b'\x00':
-                    transis_response_byte_string_list = byte_string.split(b'\x00')
-                    for transis_response_byte_string in transis_response_byte_string_list:
-                        transis_response = TransisResponse(transis_response_byte_string)
-                        err_msg = transis_response.is_error()
-                        if(err_msg):
-                            raise Exception(err_msg)
-                        elif(transis_response.detector_count_messages):
-                            yield TransisResponse(transis_response_byte_string)
-                    byte_string = b""
-                    self.__reset_connection_attempt_counts()
+            for transis_response_byte_string in framer.frame(stream.iter_content(chunk_size=self.stream_chunk_size)):
+                self.__reset_connection_attempt_counts()
+                yield transis_response_byte_string
         except requests.exceptions.ConnectionError as e:
+            if self.__stopped.is_set():
+                return
             if self.__reconnect_attempts_remaining > 0:
                 log.error(f"Transis has not responded for {self.stream_timeout} seconds, will attempt to reconnect {self.__reconnect_attempts_remaining} more time(s)")
                 self.__reconnect_attempts_remaining -= 1
-                for r in self.get_detector_counts():
+                for r in self.get_detector_count_documents():
                     yield r
             else:
                 raise Exception(f"{self.__max_reconnects} attempts to reconnect to transis were made without success.")
         except Exception as e:
+            if self.__stopped.is_set():
+                return
             log.error(f"An error occured when processing the transis detector counts stream:  {e}")
             raise e
     
+    def stream_detector_count_messages(self):
+        """Generater to yield each detector count message as soon as it has been parsed from the stream, will try to reconnect to transis if there is no data recieved before the timeout is over.
+
+        Note:
+            Unlike get_detector_counts the whole document is never held in memory, the messages are parsed while the rest of
+            the document is still being recieved.
+        Yields:
+            {transis_response_models.DetectorCountMessage} -- each site's detector counts
+            {transis_response_models.DetectorCountDocumentEnd} -- after the last message of each transis xml document
+            {transis_response_models.DetectorCountStreamReset} -- before the stream is reconnected, a document that was partly
+                                                                   recieved will not be ended
+        """
+        if self.__stopped.is_set():
+            return
+        stream = self.__open_detector_count_stream()
+        parser = DetectorCountStreamParser(max_document_size=self.max_document_size)
+        try:
+            log.info("Waiting for detector count stream to recieve data, this may take around 10 minutes.")
+            for chunk in stream.iter_content(chunk_size=self.stream_chunk_size):
+                metrics.TRANSIS_BYTES_RECEIVED.inc(len(chunk))
+                for item in parser.feed(chunk):
+                    yield item
+                    if isinstance(item, DetectorCountDocumentEnd):
+                        metrics.TRANSIS_DOCUMENTS_FRAMED.inc()
+                        self.__reset_connection_attempt_counts()
+        except requests.exceptions.ConnectionError as e:
+            if self.__stopped.is_set():
+                return
+            if self.__reconnect_attempts_remaining > 0:
+                log.error(f"Transis has not responded for {self.stream_timeout} seconds, will attempt to reconnect {self.__reconnect_attempts_remaining} more time(s)")
+                self.__reconnect_attempts_remaining -= 1
+                yield DetectorCountStreamReset(str(e))
+                for r in self.stream_detector_count_messages():
+                    yield r
+            else:
+                raise Exception(f"{self.__max_reconnects} attempts to reconnect to transis were made without success.")
+        except Exception as e:
+            if self.__stopped.is_set():
+                return
+            log.error(f"An error occured when processing the transis detector counts stream:  {e}")
+            raise e
+
     def get_current_topology(self):
-        res = self.__get_http_response("getCurrentTopology",False)
-        return self.__get_transis_responses(res)[0]
+        return self.__get_first_transis_response("getCurrentTopology")
 
     def get_topology_changes_from(self, from_date):
         """Returns all the topology change from the given date
@@ -160,8 +343,15 @@ class TransisConsumer:
         Arguments:
             from_date {str} -- get change from this date onwards e.g 2019-10-20T21:43:32.000+11:00
         """
-        res = self.__get_http_response("getTopologyChangesFromDate",stream=False,date=from_date)
-        return self.__get_transis_responses(res)[0]
+        return self.__get_first_transis_response("getTopologyChangesFromDate",date=from_date)
+
+    def iter_topology_changes_from(self, from_date):
+        """Generator to yield every document of the topology changes from the given date as it is downloaded, see iter_transis_responses()
+
+        Arguments:
+            from_date {str} -- get change from this date onwards e.g 2019-10-20T21:43:32.000+11:00
+        """
+        return self.iter_transis_responses("getTopologyChangesFromDate",date=from_date)
 
     def get_data_from(self,types,from_date):
         """Returns the data of the requested type from the given date
@@ -169,8 +359,57 @@ class TransisConsumer:
         Arguments:
             from_date {str} -- get change from this date onwards e.g 2019-10-20T21:43:32.000+11:00
         """        
-        res = self.__get_http_response("getFromDate",stream=False,startDate=from_date,types=types)
-        return self.__get_transis_responses(res)[0]        
+        return self.__get_first_transis_response("getFromDate",startDate=from_date,types=types)
+
+    def iter_data_from(self,types,from_date):
+        """Generator to yield every document of the requested type from the given date as it is downloaded, see iter_transis_responses()
+
+        Arguments:
+            types {str} -- the transis data types e.g. StrategicMonitor
+            from_date {str} -- get change from this date onwards e.g 2019-10-20T21:43:32.000+11:00
+        """
+        return self.iter_transis_responses("getFromDate",startDate=from_date,types=types)
+
+    def get_data_within_dates(self,types,start_date,end_date):
+        """Returns the data of the requested type between the given dates
+
+        Arguments:
+            types {str} -- the transis data types e.g. DetectorCount
+            start_date {str} -- get data from this date onwards e.g 2019-10-20T21:43:32.000+11:00
+            end_date {str} -- get data up to this date e.g 2019-10-20T22:43:32.000+11:00
+        """
+        return self.__get_first_transis_response("getWithinDates",startDate=start_date,endDate=end_date,types=types)
+
+    def iter_data_within_dates(self,types,start_date,end_date):
+        """Generator to yield every document of the requested type between the given dates as it is downloaded, see iter_transis_responses()
+
+        Arguments:
+            types {str} -- the transis data types e.g. DetectorCount
+            start_date {str} -- get data from this date onwards e.g 2019-10-20T21:43:32.000+11:00
+            end_date {str} -- get data up to this date e.g 2019-10-20T22:43:32.000+11:00
+        """
+        return self.iter_transis_responses("getWithinDates",startDate=start_date,endDate=end_date,types=types)
+
+    def get_raw_data_within_dates(self,types,start_date,end_date):
+        """Returns the body of a getWithinDates request as bytes, so it can be parsed somewhere else such as another process
+
+        Arguments:
+            types {str} -- the transis data types e.g. DetectorCount
+            start_date {str} -- get data from this date onwards e.g 2019-10-20T21:43:32.000+11:00
+            end_date {str} -- get data up to this date e.g 2019-10-20T22:43:32.000+11:00
+        Raises:
+            Exception -- if the body is larger than max_document_size
+        """
+        response = self.__get_http_response("getWithinDates",stream=True,startDate=start_date,endDate=end_date,types=types)
+        body = bytearray()
+        try:
+            for chunk in response.iter_content(chunk_size=self.stream_chunk_size):
+                body += chunk
+                if len(body) > self.max_document_size:
+                    raise Exception(f"The getWithinDates response from {start_date} to {end_date} is larger than {self.max_document_size} bytes, use a smaller window")
+        finally:
+            response.close()
+        return bytes(body)
 
     def get_strategic_monitor_from(self, from_date):
         """Returns all the StrategicMonitor records from the given date
@@ -178,8 +417,7 @@ class TransisConsumer:
         Arguments:
             from_date {str} -- get change from this date onwards e.g 2019-10-20T21:43:32.000+11:00
         """
-        res = self.__get_http_response("getFromDate",stream=False,startDate=from_date,types="StrategicMonitor")
-        return self.__get_transis_responses(res)[0]
+        return self.__get_first_transis_response("getFromDate",startDate=from_date,types="StrategicMonitor")
 
     def get_motorway_from(self, from_date):
         """Returns all the Motorway data from the given date
@@ -187,8 +425,7 @@ class TransisConsumer:
         Arguments:
             from_date {str} -- get change from this date onwards e.g 2019-10-20T21:43:32.000+11:00
         """
-        res = self.__get_http_response("getFromDate",stream=False,startDate=from_date,types="Motorway")
-        return self.__get_transis_responses(res)[0]
+        return self.__get_first_transis_response("getFromDate",startDate=from_date,types="Motorway")
 
     def get_site_alarm_from(self, from_date):
         """Returns all the Motorway data from the given date
@@ -197,14 +434,12 @@ class TransisConsumer:
             from_date {str} -- get change from this date onwards e.g 2019-10-20T21:43:32.000+11:00
             domain+"/rest/getFromDate?startDate={start_date}&types={types}",
         """
-        res = self.__get_http_response("getFromDate",stream=False,startDate=from_date,types="SiteAlarm")
-        return self.__get_transis_responses(res)[0]
+        return self.__get_first_transis_response("getFromDate",startDate=from_date,types="SiteAlarm")
 
     def get_all_open_tirf(self):
         """Returns all the current open Traffic Interuption Request Form (TIRF) incidents at the time of the request.        
         """
-        res = self.__get_http_response("getAllOpenTIRF",stream=False)
-        return self.__get_transis_responses(res)[0]
+        return self.__get_first_transis_response("getAllOpenTIRF")
 
     def get_all_closed_tirf(self,from_date):
         """Returns all the closed Traffic Interuption Request Form (TIRF) as of as of from_date
@@ -212,8 +447,15 @@ class TransisConsumer:
         Arguments:
             from_date {str} -- get change from this date onwards e.g 2019-10-20T21:43:32.000+11:00
         """
-        res = self.__get_http_response("getClosedTIRFFromDate",stream=False,date=from_date)
-        return self.__get_transis_responses(res)[0]
+        return self.__get_first_transis_response("getClosedTIRFFromDate",date=from_date)
+
+    def iter_all_closed_tirf(self,from_date):
+        """Generator to yield every document of the closed TIRF as of from_date as it is downloaded, see iter_transis_responses()
+
+        Arguments:
+            from_date {str} -- get change from this date onwards e.g 2019-10-20T21:43:32.000+11:00
+        """
+        return self.iter_transis_responses("getClosedTIRFFromDate",date=from_date)
 
     def get_all_vms(self):
         """Returns a transis response with the current Variable Messaging Sign(VMS) data
@@ -221,8 +463,7 @@ class TransisConsumer:
         Returns:
             {transis_response_models.TransisResponse} -- The response object that can be inpected for the data.
         """
-        res = self.__get_http_response("getAllVMS",stream=False)
-        return self.__get_transis_responses(res)[0]
+        return self.__get_first_transis_response("getAllVMS")
 
 
     def start_transis_http_session(self):
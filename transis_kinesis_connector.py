@@ -1,19 +1,25 @@
 import requests
 import boto3
-from transis_response_models import TransisResponse
+from transis_response_models import TransisResponse, DetectorCountDocumentEnd, DetectorCountStreamReset, DetectorCountBatch
 import di_framework
+import metrics
 import json
 import logging
+import queue
+import threading
+import time
 
 log = logging.getLogger(__name__)
 
 class TransisKinesisConnector:
     """ Represents the adaptor between transis and kinesis"""
 
-    def __init__(self,transis_consumer,kinesis_producer, di_framework_client):
+    def __init__(self,transis_consumer,kinesis_producer, di_framework_client, compact_records=False, enricher=None):
         self.transis_consumer = transis_consumer
         self.kinesis_producer = kinesis_producer
         self.di_framework_client = di_framework_client
+        self.compact_records = compact_records
+        self.enricher = enricher
 
 
     def run(self):
@@ -25,6 +31,193 @@ class TransisKinesisConnector:
             self.di_framework_client.log_job_status(json.dumps(response))
             self.di_framework_client.end_job()            
     
+    def run_streaming(self, flush_size=500):
+        """Processes detector count messages as they are parsed from the stream, pushing them to kinesis before the whole document has been recieved.
+
+        A DI job is started when the first message of a document arrives and ended once the document is complete. If the stream is
+        reconnected or fails part way through a document its job is ended with an error and its records that were not pushed yet
+        are discarded.
+
+        Keyword Arguments:
+            flush_size {int} -- the number of messages that are collected before they are pushed to kinesis (default: {500})
+        """
+        records = []
+        job_started = False
+        push_summary = {}
+        try:
+            for item in self.transis_consumer.stream_detector_count_messages():
+                if isinstance(item, DetectorCountStreamReset):
+                    if job_started:
+                        self.error_streaming_job(f"The detector count stream was reconnected part way through a document: {item.reason}", push_summary)
+                    records = []
+                    push_summary = {}
+                    job_started = False
+                elif isinstance(item, DetectorCountDocumentEnd):
+                    if records:
+                        self.add_push_summary(push_summary, self.kinesis_producer.push_transis_detector_count_records(records, self.di_framework_client))
+                        records = []
+                    response = {
+                        "records_in_xml_doc": item.num_sites,
+                        "collectionendtimestamp_plus_3_mins": item.collectionendtimestamp_plus_3_mins,
+                        "response_received_timestamp": item.response_received_timestamp
+                    }
+                    response.update(push_summary)
+                    log.info(response)
+                    push_summary = {}
+                    if job_started:
+                        self.di_framework_client.log_job_status(json.dumps(response))
+                        self.di_framework_client.end_job()
+                        job_started = False
+                else:
+                    if not job_started:
+                        self.di_framework_client.start_job()
+                        job_started = True
+                    record = item.to_dict()
+                    records.append(self.enricher.enrich(record) if self.enricher else record)
+                    if len(records) >= flush_size:
+                        self.add_push_summary(push_summary, self.kinesis_producer.push_transis_detector_count_records(records, self.di_framework_client))
+                        records = []
+        except Exception as e:
+            if job_started:
+                self.error_streaming_job(f"The detector count stream failed part way through a document: {e}", push_summary)
+            raise
+
+    def error_streaming_job(self, error_message, push_summary):
+        """Ends the DI job of a document that was only partly recieved with an error, logging what was pushed of it"""
+        log.error(f"{error_message} {push_summary}")
+        self.di_framework_client.error_job(f"{error_message} {json.dumps(push_summary)}")
+
+    def add_push_summary(self, totals, push_summary):
+        """Adds the counts in a summary returned by the kinesis producer to the running totals"""
+        for key, value in push_summary.items():
+            totals[key] = totals.get(key, 0) + value
+        return totals
+
+    def run_pipelined(self, documents_queue_size=12, records_queue_size=2, overflow_policy="block", queue_depth_log_interval=60,
+                      shutdown_timeout=10):
+        """Processes the transis responses in three stages connected by bounded queues, so a slow kinesis or DI framework does not stop the stream being read.
+
+        A receiver thread reads raw documents from the stream, a transform thread parses them into records and the calling thread
+        publishes the records to kinesis managing the starting, ending and logging of DI jobs.
+
+        Note:
+            When the documents queue is full the receiver applies the overflow_policy. "block" stops reading the stream until the
+            transform stage catches up, so no document is lost but the socket is not drained and a long stall can make transis
+            drop the connection. "drop_oldest" discards the oldest queued document so the stream is always being read, losing
+            that document's detector counts. The transform stage always blocks when the records queue is full.
+            When the pipeline ends the transis stream is stopped and both threads are joined.
+
+        Keyword Arguments:
+            documents_queue_size {int} -- the most raw documents waiting to be parsed, about 5 minutes of data each (default: {12})
+            records_queue_size {int} -- the most transformed documents waiting to be published (default: {2})
+            overflow_policy {str} -- "block" or "drop_oldest" (default: {"block"})
+            queue_depth_log_interval {int} -- seconds between logging the depth of the queues (default: {60})
+            shutdown_timeout {float} -- the longest that is waited for each thread to stop when the pipeline ends (default: {10})
+        """
+        if overflow_policy not in ("block", "drop_oldest"):
+            raise ValueError(f"Unknown overflow_policy {overflow_policy}, expected block or drop_oldest")
+        self.documents_queue = queue.Queue(maxsize=documents_queue_size)
+        self.records_queue = queue.Queue(maxsize=records_queue_size)
+        self.dropped_documents = 0
+        self.__stop_pipeline = threading.Event()
+        threads = [
+            threading.Thread(target=self.__receive_documents, args=(overflow_policy,), name="transis-receiver", daemon=True),
+            threading.Thread(target=self.__transform_documents, name="transis-transform", daemon=True)
+        ]
+        for thread in threads:
+            thread.start()
+        last_queue_depth_log = time.monotonic()
+        try:
+            while True:
+                try:
+                    item = self.records_queue.get(timeout=queue_depth_log_interval)
+                except queue.Empty:
+                    item = None
+                if time.monotonic() - last_queue_depth_log >= queue_depth_log_interval:
+                    log.info(self.get_queue_depths())
+                    last_queue_depth_log = time.monotonic()
+                if item is None:
+                    continue
+                if item is PIPELINE_END:
+                    break
+                if isinstance(item, PipelineError):
+                    raise item.exception
+                records, response = item
+                self.di_framework_client.start_job()
+                response = self.publish_records(records, response, self.di_framework_client)
+                response.update(self.get_queue_depths())
+                log.info(response)
+                self.di_framework_client.log_job_status(json.dumps(response))
+                self.di_framework_client.end_job()
+        finally:
+            self.__stop_pipeline.set()
+            self.transis_consumer.stop()
+            for thread in threads:
+                thread.join(shutdown_timeout)
+                if thread.is_alive():
+                    log.error(f"The {thread.name} thread did not stop within {shutdown_timeout} seconds")
+
+    def get_queue_depths(self):
+        """Returns the number of items waiting in each queue of the pipeline started by run_pipelined()"""
+        try:
+            return {
+                "documents_queue_depth": self.documents_queue.qsize(),
+                "records_queue_depth": self.records_queue.qsize(),
+                "dropped_documents": self.dropped_documents
+            }
+        except AttributeError:
+            return {}
+
+    def __put_in_pipeline(self, pipeline_queue, item):
+        while not self.__stop_pipeline.is_set():
+            try:
+                pipeline_queue.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __receive_documents(self, overflow_policy):
+        try:
+            for document in self.transis_consumer.get_detector_count_documents():
+                if self.__stop_pipeline.is_set():
+                    return
+                try:
+                    self.documents_queue.put_nowait(document)
+                    continue
+                except queue.Full:
+                    pass
+                if overflow_policy == "drop_oldest":
+                    try:
+                        self.documents_queue.get_nowait()
+                        self.dropped_documents += 1
+                        log.error(f"The documents queue is full, dropped the oldest document ({self.dropped_documents} dropped so far).")
+                    except queue.Empty:
+                        pass
+                else:
+                    log.warning("The documents queue is full, the transis stream will not be read until the transform stage catches up.")
+                if not self.__put_in_pipeline(self.documents_queue, document):
+                    return
+            self.__put_in_pipeline(self.documents_queue, PIPELINE_END)
+        except Exception as e:
+            self.__put_in_pipeline(self.documents_queue, PipelineError(e))
+
+    def __transform_documents(self):
+        try:
+            while not self.__stop_pipeline.is_set():
+                try:
+                    document = self.documents_queue.get(timeout=1)
+                except queue.Empty:
+                    continue
+                if document is PIPELINE_END or isinstance(document, PipelineError):
+                    self.__put_in_pipeline(self.records_queue, document)
+                    return
+                transis_response = self.transis_consumer.parse_detector_count_document(document)
+                if transis_response:
+                    self.__put_in_pipeline(self.records_queue, self.transform_transis_response(transis_response))
+        except Exception as e:
+            self.__put_in_pipeline(self.records_queue, PipelineError(e))
+
     def push_transis_response_to_kinesis(self, transis_response, di_framework_client):
         """Pushes the list of detector count messages after thier appropriate transformation, to be sent to kinesis
         
@@ -34,11 +227,60 @@ class TransisKinesisConnector:
         Returns:
             {Dict} -- Details about how many records where processed
         """
-        detector_count_messages = transis_response.detector_count_messages.detector_count_message_list
-        records = [e.to_dict() for e in detector_count_messages]
-        self.kinesis_producer.push_transis_detector_count_records(records, di_framework_client)
-        return {
-            "records_in_xml_doc": len(records),
-            "collectionendtimestamp_plus_3_mins": detector_count_messages[0].collectionendtimestamp_plus_3_mins,
-            "response_received_timestamp": transis_response.response_received_timestamp
-        }        
\ No newline at end of file
+        records, response = self.transform_transis_response(transis_response)
+        return self.publish_records(records, response, di_framework_client)
+
+    def transform_transis_response(self, transis_response):
+        """Returns the records to be sent to kinesis for a detector count response and the details of the response, see transform_transis_response()"""
+        return transform_transis_response(transis_response, self.compact_records, self.enricher)
+
+    def publish_records(self, records, response, di_framework_client):
+        """Pushes records returned by transform_transis_response() to kinesis and adds the producer's summary to the response details
+
+        Returns:
+            {Dict} -- Details about how many records where processed
+        """
+        if isinstance(records, DetectorCountBatch):
+            push_summary = self.kinesis_producer.push_transis_detector_count_batch(records, di_framework_client)
+        else:
+            push_summary = self.kinesis_producer.push_transis_detector_count_records(records, di_framework_client)
+        response.update(push_summary)
+        return response
+
+
+def transform_transis_response(transis_response, compact_records=False, enricher=None):
+    """Returns the records to be sent to kinesis for a detector count response and the details of the response
+    
+    Arguments:
+        transis_response {TransisResponse} -- the detector count response recieved from transis
+
+    Keyword Arguments:
+        compact_records {bool} -- return a DetectorCountBatch when the response can be stored in one (default: {False})
+        enricher {TopologyEnricher} -- adds the detector topology to the record Dicts, compact_records is ignored if set (default: {None})
+    Returns:
+        {tuple} -- a list of record Dicts (or a DetectorCountBatch if compact_records is set and there is no enricher) and a Dict of details about the response
+    """
+    with metrics.TRANSFORM_SECONDS.time():
+        records = transis_response.detector_count_batch if compact_records and not enricher else None
+        if records is not None:
+            collectionendtimestamp_plus_3_mins = records.date(0)
+        else:
+            detector_count_messages = transis_response.detector_count_messages.detector_count_message_list
+            records = [e.to_dict() for e in detector_count_messages]
+            if enricher:
+                enricher.enrich_records(records)
+            collectionendtimestamp_plus_3_mins = detector_count_messages[0].collectionendtimestamp_plus_3_mins
+    return records, {
+        "records_in_xml_doc": len(records),
+        "collectionendtimestamp_plus_3_mins": collectionendtimestamp_plus_3_mins,
+        "response_received_timestamp": transis_response.response_received_timestamp
+    }
+
+
+class PipelineError:
+    """Carries an exception raised in one stage of the pipeline to the thread running run_pipelined()"""
+    def __init__(self, exception):
+        self.exception = exception
+
+# Put in a pipeline queue after the last item
+PIPELINE_END = object()
@@ -3,6 +3,11 @@ kinesis_response_models.py creates a TransisResponse out of the bytesting that t
 """
 
 import xml.etree.ElementTree as ET
+from array import array
+import csv
+import os
+import json
+import sys
 import utils
 import pprint
 from xml.dom import minidom
@@ -79,6 +84,257 @@ class DetectorCountMessages:
 
 
 
+class DetectorCountBatch:
+    """A compact, array backed collection of the detector counts for many sites.
+
+    Every site's detectors are stored in flat arrays, the detectors of site i are at detector_ids[offsets[i]:offsets[i+1]].
+    Region names and timestamps repeat across the network so they are stored once in tables and referenced by index.
+
+    Note:
+        Detector numbers and counts are stored as signed 32 bit ints. A message with a Did or count that is not written as an int in
+        that range, such as "007" or " 5", or with the same Did twice cannot be stored in a batch as its records would differ from
+        DetectorCountMessage.to_dict(). TransisResponse.detector_count_batch is None for such a response so it is sent as Dicts.
+
+    Attributes:
+        site_ids      (list)       : interned site id of each site
+        regions       (list)       : table of the distinct region names
+        region_index  (array('H')) : index into regions for each site
+        dates         (list)       : table of the distinct transis timestamps e.g. 2019-10-03T15:43:00+10:00
+        date_index    (array('H')) : index into dates for each site
+        offsets       (array('I')) : start of each site's detectors, with one extra entry for the end of the last site
+        detector_ids  (array('i')) : detector number of every detector in the batch
+        counts        (array('i')) : count of every detector in the batch
+    """
+    __slots__ = ("site_ids", "regions", "region_index", "dates", "date_index", "offsets", "detector_ids", "counts",
+                 "_region_lookup", "_date_lookup", "_epocs")
+
+    def __init__(self):
+        self.site_ids = []
+        self.regions = []
+        self.region_index = array('H')
+        self.dates = []
+        self.date_index = array('H')
+        self.offsets = array('I', [0])
+        self.detector_ids = array('i')
+        self.counts = array('i')
+        self._region_lookup = {}
+        self._date_lookup = {}
+        self._epocs = []
+
+    @classmethod
+    def from_element(cls,detector_count_messages_element):
+        """Returns a DetectorCountBatch built from a DetectorCountMessages xml element"""
+        batch = cls()
+        for detector_count_message_element in detector_count_messages_element:
+            batch.append_element(detector_count_message_element)
+        return batch
+
+    def append_element(self,detector_count_message_element):
+        """Adds one site's DetectorCountMessage xml element to the batch
+
+        Raises:
+            ValueError -- if a Did or count is not written as an int the way str() writes it, or a Did is repeated
+            OverflowError -- if a Did or count does not fit in a signed 32 bit int
+        """
+        attrib = detector_count_message_element.attrib
+        self.site_ids.append(sys.intern(str(attrib['Sid'])))
+        self.region_index.append(self.__table_index(self.regions, self._region_lookup, str(attrib['reg'])))
+        self.date_index.append(self.__table_index(self.dates, self._date_lookup, str(attrib['date'])))
+        detector_ids = self.detector_ids
+        counts = self.counts
+        site_detector_ids = set()
+        for detector in detector_count_message_element.find('Detectors'):
+            detector_attrib = detector.attrib
+            if 'Did' in detector_attrib and 'count' in detector_attrib:
+                detector_id, count = detector_attrib['Did'], detector_attrib['count']
+                detector_id_int, count_int = int(detector_id), int(count)
+                if str(detector_id_int) != detector_id or str(count_int) != count:
+                    raise ValueError(f"Detector {detector_id!r} of site {attrib['Sid']} has a Did or count {count!r} that is not a canonical int")
+                if detector_id_int in site_detector_ids:
+                    raise ValueError(f"Detector {detector_id} of site {attrib['Sid']} is repeated")
+                site_detector_ids.add(detector_id_int)
+                detector_ids.append(detector_id_int)
+                counts.append(count_int)
+        self.offsets.append(len(detector_ids))
+
+    def __table_index(self,table,lookup,value):
+        try:
+            return lookup[value]
+        except KeyError:
+            lookup[value] = len(table)
+            table.append(sys.intern(value))
+            return lookup[value]
+
+    def __len__(self):
+        return len(self.site_ids)
+
+    def region(self,index):
+        return self.regions[self.region_index[index]]
+
+    def date(self,index):
+        return self.dates[self.date_index[index]]
+
+    def epoc(self,index):
+        """Returns the unix timestamp of a site's counts, each distinct timestamp in the batch is only converted once"""
+        date_index = self.date_index[index]
+        while len(self._epocs) <= date_index:
+            self._epocs.append(utils.get_epoc_from_timestamp_string(self.dates[len(self._epocs)]))
+        return self._epocs[date_index]
+
+    def detector_counts(self,index):
+        """Returns an iterator of (detector id, count) pairs for the site at index"""
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return zip(self.detector_ids[start:end], self.counts[start:end])
+
+    def record_header(self,index):
+        """Returns the site level fields of a site's record without its detector counts"""
+        return {
+            "collectionIntervalSecs": 300,
+            "region": self.region(index),
+            "siteId": self.site_ids[index],
+            "collectionendtimestamp_plus_3_mins": self.epoc(index)
+        }
+
+    def to_dict(self,index):
+        """Returns the same Dict as DetectorCountMessage.to_dict for the site at index"""
+        kinesis_record = self.record_header(index)
+        kinesis_record['detectorCounts'] = {str(detector_id): str(count) for detector_id, count in self.detector_counts(index)}
+        return kinesis_record
+
+    def encode_json_record(self,index):
+        """Returns the utf-8 json encoding of to_dict(index) without building the detector counts Dict
+
+        Note:
+            The bytes are identical to json.dumps(DetectorCountMessage.to_dict()).encode('utf-8')
+        """
+        detector_counts = ", ".join([f'"{detector_id}": "{count}"' for detector_id, count in self.detector_counts(index)])
+        return (f'{{"collectionIntervalSecs": 300, "region": {json.dumps(self.region(index))}, '
+                f'"siteId": {json.dumps(self.site_ids[index])}, '
+                f'"collectionendtimestamp_plus_3_mins": {self.epoc(index)}, '
+                f'"detectorCounts": {{{detector_counts}}}}}').encode('utf-8')
+
+    def iter_records(self):
+        """Generator to yield the Dict representation of every site in the batch"""
+        for index in range(len(self)):
+            yield self.to_dict(index)
+
+
+class DetectorCountDocumentEnd:
+    """Marks the end of one transis xml document when DetectorCountMessages are being streamed.
+
+    Attributes:
+        num_sites                          (int): total number of sites that were in the document
+        collectionendtimestamp_plus_3_mins (str): timestamp provided by transis to represent the period over which the counts represent.
+        response_received_timestamp        (str): The time that the entire document was recieved from transis.
+    """
+    def __init__(self,num_sites,collectionendtimestamp_plus_3_mins):
+        self.num_sites = num_sites
+        self.collectionendtimestamp_plus_3_mins = collectionendtimestamp_plus_3_mins
+        self.response_received_timestamp = utils.get_formatted_current_timestamp()
+
+
+class DetectorCountStreamReset:
+    """Marks that the detector count stream was reconnected, the messages of a document that was being recieved before it will not
+    be followed by a DetectorCountDocumentEnd.
+
+    Attributes:
+        reason (str): why the stream was reconnected
+    """
+    def __init__(self,reason):
+        self.reason = reason
+
+
+class DetectorCountStreamParser:
+    """Incrementally parses a stream of null byte delimited transis DetectorCount documents.
+
+    Bytes are fed in as they arrive, each DetectorCountMessage is returned as soon as its end tag has been parsed and is then
+    detached from the document tree so memory does not grow with the size of the network. A DetectorCountDocumentEnd is returned
+    after the last DetectorCountMessage of each document.
+
+    Attributes:
+        max_document_size (int)  : the largest document in bytes that will be parsed before an exception is raised
+        delimiter         (bytes): the byte that transis uses to denote the end of a xml document
+    """
+    def __init__(self,max_document_size=256*1024*1024,delimiter=b"\x00"):
+        self.max_document_size = max_document_size
+        self.delimiter = delimiter
+        self.__start_document()
+
+    def __start_document(self):
+        self.__parser = ET.XMLPullParser(events=("start","end"))
+        self.__document_size = 0
+        self.__depth = 0
+        self.__is_error = False
+        self.__error_message = None
+        self.__messages_element = None
+        self.__num_sites = 0
+        self.__collectionendtimestamp_plus_3_mins = None
+
+    def feed(self,chunk):
+        """Feeds the next chunk of the stream to the parser
+
+        Arguments:
+            chunk {bytes} -- the next part of the stream, it can contain any number of null byte delimiters
+        Returns:
+            {list} -- the DetectorCountMessage and DetectorCountDocumentEnd objects completed by this chunk
+        """
+        items = []
+        start = 0
+        end = chunk.find(self.delimiter)
+        while end != -1:
+            self.__feed_document_bytes(chunk[start:end], items)
+            self.__end_document(items)
+            start = end + 1
+            end = chunk.find(self.delimiter, start)
+        self.__feed_document_bytes(chunk[start:] if start else chunk, items)
+        return items
+
+    def __feed_document_bytes(self,data,items):
+        if not data:
+            return
+        self.__document_size += len(data)
+        if self.__document_size > self.max_document_size:
+            self.__start_document()
+            raise Exception(f"A transis document exceeded the maximum document size of {self.max_document_size} bytes without a null byte terminator.")
+        self.__parser.feed(data)
+        self.__read_events(items)
+
+    def __end_document(self,items):
+        if self.__document_size == 0:
+            return
+        self.__parser.close()
+        self.__read_events(items)
+        is_error, error_message = self.__is_error, self.__error_message
+        num_sites, timestamp = self.__num_sites, self.__collectionendtimestamp_plus_3_mins
+        self.__start_document()
+        if is_error:
+            raise Exception(error_message or "Transis returned an error response without an error message.")
+        if num_sites > 0:
+            items.append(DetectorCountDocumentEnd(num_sites, timestamp))
+
+    def __read_events(self,items):
+        for event, element in self.__parser.read_events():
+            tag = element.tag.rpartition("}")[2]
+            if event == "start":
+                self.__depth += 1
+                if self.__depth == 1:
+                    self.__is_error = element.get("error") in ["true", "True"]
+                elif tag == "DetectorCountMessages":
+                    self.__messages_element = element
+                continue
+            self.__depth -= 1
+            if tag == "Error" and self.__error_message is None:
+                self.__error_message = element.get("msg")
+            elif tag == "DetectorCountMessage" and self.__messages_element is not None:
+                self.__messages_element.remove(element)
+                if not self.__is_error:
+                    detector_count_message = DetectorCountMessage(element)
+                    if self.__num_sites == 0:
+                        self.__collectionendtimestamp_plus_3_mins = detector_count_message.collectionendtimestamp_plus_3_mins
+                    self.__num_sites += 1
+                    items.append(detector_count_message)
+
+
 # class SiteLayouts:
 
 #     def __init__(self,detector_layouts_element):
@@ -111,19 +367,13 @@ class TransisXMLElement():
         self.attributes = self.get_attributes()
 
     def to_string(self):
-        row = ''
-        for attr in self.attributes:
-            row = row + '"' + self.root.get(attr) + '"' + ','
-        return row[:-1]
+        return ",".join(['"' + self.root.get(attr).replace('"', '""') + '"' for attr in self.attributes])
 
     def get_attributes(self):
         return list(self.root.attrib.keys())
     
     def get_attributes_as_csv_header(self):
-        header = ""
-        for attr in self.attributes:
-            header = header + attr + ","
-        return header[:-1]
+        return ",".join(self.attributes)
 
 
 class SiteLayout(TransisXMLElement):
@@ -160,53 +410,126 @@ class SiteLayout(TransisXMLElement):
     #     }
     #     return subcomponents[subcomponent]
 
+class SiteLayoutsCSVWriter:
+    """Writes rows of the SiteLayouts subcomponents to a seperate file handle for each subcomponent with the csv module.
+
+    The header of a subcomponent is written before its first row, using the attributes of the first element. Values are always
+    quoted, the header is only quoted where the csv module needs to.
+
+    Attributes:
+        file_handles (dict): a text file handle for each subcomponent that is written, see SITE_LAYOUT_CSV_SUBCOMPONENTS
+        row_counts   (dict): the number of rows written for each subcomponent
+    """
+    def __init__(self, file_handles):
+        self.file_handles = file_handles
+        self.row_counts = {subcomponent: 0 for subcomponent in file_handles}
+        self.__row_writers = {subcomponent: csv.writer(fh, quoting=csv.QUOTE_ALL, lineterminator="\n") for subcomponent, fh in file_handles.items()}
+        self.__header_writers = {subcomponent: csv.writer(fh, lineterminator="\n") for subcomponent, fh in file_handles.items()}
+        self.__fields = {}
+
+    def write_row(self, subcomponent, element, site_id=None):
+        """Writes the attributes of an element, after the site id if one is given"""
+        fields = self.__fields.get(subcomponent)
+        if fields is None:
+            fields = self.__fields[subcomponent] = list(element.attrib.keys())
+            self.__header_writers[subcomponent].writerow(fields if site_id is None else ["sId"] + fields)
+        row = [element.get(field, "") for field in fields]
+        self.__row_writers[subcomponent].writerow(row if site_id is None else [site_id] + row)
+        self.row_counts[subcomponent] += 1
+
+    def write_phase_rows(self, site_id, phase_element):
+        """Writes a row for every signal group number of a phase"""
+        sgnos = phase_element.find("SGNos")
+        if sgnos is None:
+            return
+        if "phases" not in self.__fields:
+            self.__fields["phases"] = ["name", "sgno"]
+            self.__header_writers["phases"].writerow(["sId", "name", "sgno"])
+        for sgno in sgnos:
+            self.__row_writers["phases"].writerow([site_id, phase_element.get("name", ""), sgno.text or ""])
+            self.row_counts["phases"] += 1
+
+# The subcomponents of a SiteLayouts that can be exported to csv, by the tag of the element that holds them in a SiteLayout
+SITE_LAYOUT_CSV_SUBCOMPONENTS = {
+    "Arms": "arms",
+    "Detectors": "detectors",
+    "Streets": "streets",
+    "SGs": "sgs",
+    "Phases": "phases"
+}
+
 class SiteLayouts(TransisXMLElement):
     def __init__(self, site_layouts_root):
         super().__init__(site_layouts_root)
-        self.site_layout_list = [SiteLayout(e) for e in site_layouts_root]
         self.num_sites = self.get_num_sites()
+
+    @property
+    def site_layout_list(self):
+        """The SiteLayout of every site, built the first time it is used"""
+        try:
+            return self.__site_layout_list
+        except AttributeError:
+            self.__site_layout_list = [SiteLayout(e) for e in self.root]
+            return self.__site_layout_list
     
     def get_num_sites(self):
-        if(self.site_layout_list):
-            return len(self.site_layout_list)
-        else:
-            return 0
-    
-    def get_csv_string(self,subcomponent=None):
-        csv = io.StringIO()
-        header = self.get_csv_header(subcomponent)
-        csv.write(header)
-        for site in self.site_layout_list:
-            if subcomponent == "sites":
-                csv.write(site.to_string() + "\n")
-            if subcomponent == "arms" and site.arms:
-                for arm in site.arms.arms_list:
-                    csv.write('"' + site.root.get("sId")+ '",'+arm.to_string() + "\n")
-            elif subcomponent == "detectors" and site.detectors:
-                for detector in site.detectors.detectors_list:
-                    csv.write('"' + site.root.get("sId")+ '",'+ detector.to_string() + "\n")
-            elif subcomponent == "streets" and site.streets:
-                for street in site.streets.streets_list:
-                    csv.write('"' + site.root.get("sId")+ '",'+ street.to_string() + "\n")
-            elif subcomponent == "sgs" and site.sgs:
-                for sg in site.sgs.sgs_list:
-                    csv.write('"' + site.root.get("sId")+ '",'+ sg.to_string() + "\n")                    
-            elif subcomponent == "phases" and site.sgs:
-                for phase in site.phases.phases_list:
-                    for sngo in phase.root.find("SGNos"):
-                        csv.write(f'"{site.root.get("sId")}","{phase.root.get("name")}","{sngo.text}"\n')                          
-        return csv.getvalue()
-    
-    def get_csv_header(self, subcomponent):
-        csv_headers = {
-            "sites": self.site_layout_list[0].get_attributes_as_csv_header()+"\n",
-            "arms": 'sId,' + self.site_layout_list[0].arms.arms_list[0].get_attributes_as_csv_header()+"\n",
-            "detectors": 'sId,' + self.site_layout_list[0].detectors.detectors_list[0].get_attributes_as_csv_header()+"\n",
-            "streets": 'sId,' + self.site_layout_list[0].streets.streets_list[0].get_attributes_as_csv_header()+"\n",
-            "sgs": 'sId,' + self.site_layout_list[0].sgs.sgs_list[0].get_attributes_as_csv_header()+"\n",
-            "phases": 'sId,name,sgno\n'
-        }
-        return csv_headers[subcomponent]
+        return len(self.root)
+
+    def write_csv(self, file_handles):
+        """Writes the sites and their subcomponents to csv in one pass over the xml, without holding the csv in memory
+
+        Arguments:
+            file_handles {dict} -- a text file handle for any of "sites", "arms", "detectors", "streets", "sgs" and "phases",
+                                   files should be opened with newline=""
+        Returns:
+            {dict} -- the number of rows written for each subcomponent
+        Raises:
+            ValueError -- if a file handle is given for anything other than sites or a subcomponent
+        """
+        unknown = [subcomponent for subcomponent in file_handles if subcomponent != "sites" and subcomponent not in SITE_LAYOUT_CSV_SUBCOMPONENTS.values()]
+        if unknown:
+            raise ValueError(f"Unknown site layout subcomponent {unknown[0]}, expected sites, {', '.join(SITE_LAYOUT_CSV_SUBCOMPONENTS.values())}")
+        writer = SiteLayoutsCSVWriter(file_handles)
+        write_sites = "sites" in file_handles
+        for site_element in self.root:
+            site_id = site_element.get("sId")
+            if write_sites:
+                writer.write_row("sites", site_element)
+            for subcomponent_element in site_element:
+                subcomponent = SITE_LAYOUT_CSV_SUBCOMPONENTS.get(subcomponent_element.tag)
+                if subcomponent not in file_handles:
+                    continue
+                for element in subcomponent_element:
+                    if subcomponent == "phases":
+                        writer.write_phase_rows(site_id, element)
+                    else:
+                        writer.write_row(subcomponent, element, site_id)
+        return writer.row_counts
+
+    def write_csv_files(self, directory, subcomponents=("sites", "arms", "detectors", "streets", "sgs", "phases"), prefix=""):
+        """Writes each subcomponent to {directory}/{prefix}{subcomponent}.csv in one pass over the xml
+
+        Returns:
+            {dict} -- the number of rows written for each subcomponent
+        """
+        file_handles = {}
+        try:
+            for subcomponent in subcomponents:
+                file_handles[subcomponent] = open(os.path.join(directory, f"{prefix}{subcomponent}.csv"), "w", newline="", encoding="utf-8")
+            return self.write_csv(file_handles)
+        finally:
+            for file_handle in file_handles.values():
+                file_handle.close()
+
+    def get_csv_string(self,subcomponent):
+        """Returns the csv of the sites or one of their subcomponents, see write_csv()
+
+        Raises:
+            ValueError -- if subcomponent is not sites or one of the subcomponents
+        """
+        csv_string = io.StringIO()
+        self.write_csv({subcomponent: csv_string})
+        return csv_string.getvalue()
 
 
     
@@ -216,16 +539,10 @@ class Arms(TransisXMLElement):
         self.arms_list = [Arm(e) for e in arms_root]
     
     def to_string(self):
-        csv = io.StringIO()
+        csv_string = io.StringIO()
         for arm in self.arms_list:
-            csv.write(arm.to_string() + "\n") 
-        return csv.getvalue()
-    
-    def get_attributes_as_csv_header(self):
-        header = ""
-        for attr in self.attributes:
-            header = header + attr + ","
-        return header[:-1]
+            csv_string.write(arm.to_string() + "\n")
+        return csv_string.getvalue()
 
 class Arm(TransisXMLElement):
     def __init__(self, arms_root):
@@ -271,26 +588,63 @@ class Phase(TransisXMLElement):
 class TransisResponse:
     """A Response object from SCATS Transis API
 
+    The xml is parsed once when the response is created, the DetectorCountMessages and SiteLayouts objects are only built
+    the first time they are accessed.
+
     Attributes:
-        byte_string                 (bytes)                 : bytesstring recieved from transis api
+        byte_string                 (bytes)                 : bytesstring recieved from transis api, None if it was not kept after parsing
         root                        (xml.etree.ElementTree) : xml object of response
         detector_count_messages     (DetectorCountMessages) : The DetectorCountMessages object in the response if it exists
+        site_layouts                (SiteLayouts)           : The SiteLayouts object in the response if it exists
         response_received_timestamp (str)                   : The time that the entire response was recieved from the requestor service.
 
     """ 
-    def __init__(self,byte_string):
+    def __init__(self,byte_string,keep_byte_string=True):
         self.byte_string = byte_string
         self.root = self._xml_from_bytes()
-        self.detector_count_messages = self.get_detector_count_messages()
-        self.site_layouts = self.get_site_layouts()
         self.response_received_timestamp = utils.get_formatted_current_timestamp()
+        if not keep_byte_string:
+            self.byte_string = None
     
+    @property
+    def detector_count_messages(self):
+        try:
+            return self.__detector_count_messages
+        except AttributeError:
+            self.__detector_count_messages = self.get_detector_count_messages()
+            return self.__detector_count_messages
+
+    @property
+    def site_layouts(self):
+        try:
+            return self.__site_layouts
+        except AttributeError:
+            self.__site_layouts = self.get_site_layouts()
+            return self.__site_layouts
+
     def _xml_from_bytes(self):
         """Transform XML bytesting into a xml.etree.ElementTree object"""
-        xml_string = self.byte_string.decode("utf-8")
-        root = ET.fromstring(xml_string) 
-        return root
+        return ET.fromstring(self.byte_string)
     
+    def has_detector_count_messages(self):
+        """Returns True if the response has a non empty DetectorCountMessages element, without building the DetectorCountMessages object"""
+        return bool(self.root.find('DetectorCountMessages'))
+
+    @property
+    def detector_count_batch(self):
+        """The detector counts in the response as a compact DetectorCountBatch, None if there are no DetectorCountMessages or they
+        cannot be stored in a batch, in which case detector_count_messages should be used"""
+        try:
+            return self.__detector_count_batch
+        except AttributeError:
+            detector_count_message_element = self.root.find('DetectorCountMessages')
+            try:
+                self.__detector_count_batch = DetectorCountBatch.from_element(detector_count_message_element) if detector_count_message_element else None
+            except (ValueError, OverflowError) as e:
+                log.warning(f"The detector counts can not be stored in a DetectorCountBatch, they will be sent as Dicts: {e}")
+                self.__detector_count_batch = None
+            return self.__detector_count_batch
+
     def get_detector_count_messages(self):
         """Get the DetectorCountMessages in the xml response and return the DetectorCountMessages object"""
         detector_count_message_element = self.root.find('DetectorCountMessages')
@@ -322,4 +676,6 @@ class TransisResponse:
             f.write(xmlstr)
     
     def to_string(self):
-        return self.byte_string.decode("utf-8")
\ No newline at end of file
+        if self.byte_string is None:
+            return ET.tostring(self.root, encoding="unicode")
+        return self.byte_string.decode("utf-8")
@@ -2,24 +2,77 @@ r"""
 utils.py is a set of helper functions used throughout the transis-kinesis-connection service.
 """
 import datetime
+import calendar
+import functools
+import hashlib
 import pytz
 import os
 import boto3
 import base64
 import json
+import re
 import time
 from botocore.exceptions import ClientError
 import logging
 log = logging.getLogger(__name__)
 
+SYDNEY_TIMEZONE = pytz.timezone('Australia/Sydney')
+_formatted_current_timestamp_cache = [None, None]
+# only plain ascii digits and offsets that strptime's %z accepts, anything else is left to strptime so both give the same result
+_ISO_8601_PATTERN = re.compile(r"(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:Z|([+-])([01]\d|2[0-3]):([0-5]\d))", re.ASCII)
+
 def get_formatted_current_timestamp():
-    """returns a string representation the current timestamp in the sydney time e.g. 2019-10-18T21:43:32+11:00"""
-    now = datetime.datetime.now(pytz.timezone('Australia/Sydney')).strftime("%Y-%m-%dT%H:%M:%S%z")
-    now_reformatted = now[:-2] + ':' + now[-2:]
-    return now_reformatted
+    """returns a string representation the current timestamp in the sydney time e.g. 2019-10-18T21:43:32+11:00
+    
+    Note:
+        The timestamp only has a resolution of one second so the formatted string is reused for calls within the same second.
+    """
+    current_second = int(time.time())
+    cache = _formatted_current_timestamp_cache
+    if cache[0] != current_second:
+        now = datetime.datetime.fromtimestamp(current_second, SYDNEY_TIMEZONE).strftime("%Y-%m-%dT%H:%M:%S%z")
+        cache[1] = now[:-2] + ':' + now[-2:]
+        cache[0] = current_second
+    return cache[1]
 
+@functools.lru_cache(maxsize=1024)
 def get_epoc_from_timestamp_string(timestamp):
     """converts a utc epoc with a timezone into a unix timestamp
+
+    Note:
+        Every site in a transis batch has the same timestamp so results are memoised in a bounded LRU cache keyed on the raw string.
+    
+    Arguments:
+        timestamp {str} -- e.g. 2019-10-03T15:43:00+10:00
+    Returns:
+        epoc {int} -- the epoc respresentaion of the given timestamp
+    """
+    epoc = parse_iso_8601_epoc(timestamp)
+    if epoc is None:
+        epoc = parse_epoc_with_strptime(timestamp)
+    return epoc
+
+def parse_iso_8601_epoc(timestamp):
+    """Returns the unix timestamp of a YYYY-MM-DDTHH:MM:SS+HH:MM or YYYY-MM-DDTHH:MM:SSZ string, or None if it is in any other format
+    
+    Arguments:
+        timestamp {str} -- e.g. 2019-10-03T15:43:00+10:00
+    """
+    match = _ISO_8601_PATTERN.fullmatch(timestamp)
+    if not match:
+        return None
+    year, month, day, hour, minute, second, sign, offset_hours, offset_minutes = match.groups()
+    offset_seconds = int(offset_hours) * 3600 + int(offset_minutes) * 60 if sign else 0
+    if sign == '-':
+        offset_seconds = -offset_seconds
+    try:
+        timestamp_ = datetime.datetime(int(year), int(month), int(day), int(hour), int(minute), int(second))
+    except ValueError:
+        return None
+    return calendar.timegm(timestamp_.timetuple()) - offset_seconds
+
+def parse_epoc_with_strptime(timestamp):
+    """converts a utc epoc with a timezone into a unix timestamp using datetime.strptime
     
     Arguments:
         timestamp {str} -- e.g. 2019-10-03T15:43:00+10:00
@@ -30,6 +83,10 @@ def get_epoc_from_timestamp_string(timestamp):
     ts = (timestamp_ - datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)).total_seconds()
     return int(ts)
 
+def md5_hash_key(value):
+    """Returns the 128 bit integer that kinesis would use to place a partition key in a shard's hash key range"""
+    return int.from_bytes(hashlib.md5(str(value).encode('utf-8')).digest(), "big")
+
 def chunks(l, n):
     """Yield successive n-sized chunks from l."""
     for i in range(0, len(l), n):